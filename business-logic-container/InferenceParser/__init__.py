@@ -1 +1,2 @@
-from .inference_parser import Inferences, Inference, ObjectDetectionResult, ClassificationResult, CustomResult, SegmentationResult
\ No newline at end of file
+from .inference_parser import Inferences, Inference, ObjectDetectionResult, ClassificationResult, CustomResult, SegmentationResult
+from .message_decoder import MessageDecoder
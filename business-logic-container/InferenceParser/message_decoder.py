@@ -0,0 +1,89 @@
+import gzip
+import json
+try:
+    import zstandard
+except ImportError:
+    # only needed for the zstd encoded messages of the AI Pipeline
+    zstandard = None
+
+class MessageDecoder:
+    """
+    Decodes the messages of the AI Pipeline into the layout read by Inferences (schemaVersion 0.1).
+
+    schemaVersion 0.2 messages may be compressed (content encoding gzip or zstd), hold the detections
+    of every frame as columns of quantized values, and only carry the regions of interest of a pipeline
+    when they change: the last ones received for every pipeline (configId) are kept and filled in.
+    """
+    def __init__(self) -> None:
+        # {configId: regions of interest}
+        self.regions_of_interest = {}
+
+    def decode(self, data: bytes, content_encoding: str = None):
+        """ :return: the message as a dict, schemaVersion 0.2 messages converted to the 0.1 layout """
+        message = json.loads(self.decompress(data, content_encoding).decode("utf-8"))
+        if not isinstance(message, dict) or message.get("schemaVersion") != "0.2":
+            return message
+
+        config_id = message.get("configId")
+        if "regionsOfInterest" in message:
+            self.regions_of_interest[config_id] = message["regionsOfInterest"]
+        scales = message["quantization"]
+        return {
+            "schemaVersion": "0.2",
+            "events": message.get("events", []),
+            "regionsOfInterest": self.regions_of_interest.get(config_id, []),
+            "inferences": [self.expand_inference(inference, scales["rect"], scales["confidence"])
+                           for inference in message["inferences"]]
+        }
+
+    @staticmethod
+    def decompress(data: bytes, content_encoding: str = None):
+        if content_encoding == "gzip":
+            return gzip.decompress(data)
+        if content_encoding == "zstd":
+            if zstandard is None:
+                raise RuntimeError("zstd encoded message, but zstandard is not installed")
+            return zstandard.ZstdDecompressor().decompress(data)
+        if isinstance(data, str):
+            return data.encode("utf-8")
+        return data
+
+    @staticmethod
+    def expand_inference(inference: dict, rect_scale: int, confidence_scale: int):
+        """ :return: the inference with a list of detections, from its columns """
+        if inference["type"] != "detection" or "columns" not in inference:
+            return inference
+
+        columns = inference["columns"]
+        count = inference["count"]
+        labels = inference["labels"]
+        rects = columns["rect"]
+        tracking_ids = columns.get("trackingId", [-1] * count)
+        component_ids = columns["componentId"]
+        if not isinstance(component_ids, list):
+            component_ids = [component_ids] * count
+        custom_info = inference.get("customInfo", {})
+        extras = inference.get("extras", {})
+
+        detections = []
+        for i in range(count):
+            detection = {
+                "classId": columns["classId"][i],
+                "confidence": columns["confidence"][i] / confidence_scale,
+                "rect": [v / rect_scale for v in rects[4*i:4*i + 4]],
+                "label": labels[columns["label"][i]],
+                "unique_component_id": component_ids[i],
+                "tracking_id": tracking_ids[i]
+            }
+            if str(i) in custom_info:
+                detection["customInfo"] = custom_info[str(i)]
+            if str(i) in extras:
+                detection["extras"] = extras[str(i)]
+            detections.append(detection)
+
+        return {
+            "sourceInfo": inference["sourceInfo"],
+            "type": "detection",
+            "id": inference["id"],
+            "detections": detections
+        }
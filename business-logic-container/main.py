@@ -3,7 +3,7 @@
 # full license information.
 from azure.iot.device.aio import IoTHubModuleClient
 from azure.iot.device import  Message
-from InferenceParser import Inferences, Inference
+from InferenceParser import Inferences, Inference, MessageDecoder
 from TwinParser import Twin
 import asyncio
 import logging
@@ -18,6 +18,9 @@ OBJECTS_INSIDE_ROIS={}
 # parse the twin received from the controller
 twin = Twin.get_instance()
 
+# messages of the AI Pipeline, possibly compressed and columnar (schemaVersion 0.2)
+decoder = MessageDecoder()
+
 # Event indicating client stop
 stop_event = threading.Event()
 
@@ -89,8 +92,7 @@ def create_client():
         logging.debug(f"Message received: {message.data}; Properties: {message.custom_properties}")
 
         # Decode the bitstream into JSON
-        message_text = message.data.decode('utf-8')
-        message_json = json.loads(message_text)
+        message_json = decoder.decode(message.data, message.content_encoding)
 
         # Check the endpoint of the message and respond appropriately.
         match message.input_name:
@@ -1,48 +1,90 @@
-from .yolov4_parser import Yolov4Parser
-from .yolov3_parser import Yolov3Parser
-from .ssd_mobilenet_v1 import SSDMobilenetV1
-from .body_pose_parser import BodyPoseParser2D
+from .base_custom_parser import BaseCustomParser, BoundingBox
+from .detections import DetectionBatch
 from .user_parser import UserParser
+from .registry import parser_registry
+from .capture import TensorCapture, read_capture
+from .hot_swap import ParserSlot
+from .stage_timers import StageTimers, format_stage_report
+from .motion_gate import MotionGate, SourceGate
+from .sgie_cache import SgieResultCache
 import sys 
 import importlib
+import importlib.util
 import os 
 
-def create_parser_from_user_pyfile(pyFile):
+def import_user_pyfile(pyFile, reload=False):
+    """
+    Imports the module of a user parser file. With reload, a new copy of the module is loaded
+    from pyFile; the module already loaded is left untouched for the parsers still using it.
+    Only the parser module itself is reloaded: the helper modules it imports are shared with the
+    rest of the process and stay as they are.
+    """
+    directory = os.path.dirname(pyFile)
+    module_name = os.path.basename(pyFile).split(".")[0]
+    if not reload:
+        sys.path.append(directory)
+        return importlib.import_module(module_name)
+
+    sys.modules.pop(module_name, None)
+    directory = os.path.abspath(directory)
+    if directory not in sys.path:
+        sys.path.append(directory)
+    importlib.invalidate_caches()
+
+    spec = importlib.util.spec_from_file_location(module_name, pyFile)
+    m = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = m
+    spec.loader.exec_module(m)
+    return m
+
+def create_parser_from_user_pyfile(pyFile, reload=False):
     try:
-        sys.path.append(os.path.dirname(pyFile))
-        m = importlib.import_module(os.path.basename(pyFile).split(".")[0])        
+        m = import_user_pyfile(pyFile, reload=reload)
         uparser = UserParser(user_funct=m)
     except Exception as e:
         print("Error creating parser from user pyfile: {}".format(e))
         return None
     return uparser
 
-def create_sgie_parser_from_user_pyfile(pyFile):
-
+def create_sgie_parser_from_user_pyfile(pyFile, reload=False):
+    """
+    :return: gie_unique_id, parse_sgie_model, the optional parse_sgie_batch of the parser file, and
+    its copy_tensors flag (the parsers receive copies of the output tensors instead of views)
+    """
     try:
-        sys.path.append(os.path.dirname(pyFile))
-        m = importlib.import_module(os.path.basename(pyFile).split(".")[0])        
+        m = import_user_pyfile(pyFile, reload=reload)
         sgie_id = m.gie_unique_id
         parse_sgie_model = m.parse_sgie_model
+        parse_sgie_batch = getattr(m, "parse_sgie_batch", None)
+        copy_tensors = bool(getattr(m, "copy_tensors", False))
     except Exception as e:
         print("Error creating parser from user pyfile: {}".format(e))
-        return None, None
-    return sgie_id, parse_sgie_model
+        return None, None, None, False
+    return sgie_id, parse_sgie_model, parse_sgie_batch, copy_tensors
 
 def get_parser_by_name(parser_name: str):
-    if parser_name == "yolov4":
-        return Yolov4Parser()
+    return parser_registry.create(parser_name)
 
-    if parser_name in ("tiny_yolov3"):
-        return Yolov3Parser()
-    
-    if parser_name == "ssd_mobilenet_v1":
-        return SSDMobilenetV1()
+def get_available_parsers():
+    return parser_registry.names()
 
-    if parser_name == "bodypose2d":
-        return BodyPoseParser2D()
+def get_parser_import_metrics():
+    return parser_registry.import_metrics()
 
-    return None 
+# The built-in parser classes are imported on first access (PEP 562)
+_lazy_classes = {
+    "Yolov4Parser": "yolov4",
+    "Yolov3Parser": "tiny-yolov3",
+    "SSDMobilenetV1": "ssd_mobilenet_v1",
+    "BodyPoseParser2D": "bodypose2d",
+    "ClassificationParser": "classification",
+}
 
-def get_available_parsers():
-    return ["yolov4", "tiny-yolov3", "ssd_mobilenet_v1", "bodypose2d"]
\ No newline at end of file
+def __getattr__(name):
+    if name in _lazy_classes:
+        return parser_registry.get_parser_class(_lazy_classes[name])
+    if name == "AsyncParsingStage":
+        # needs GStreamer, the parsers alone can be used without it
+        from .async_parsing import AsyncParsingStage
+        return AsyncParsingStage
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
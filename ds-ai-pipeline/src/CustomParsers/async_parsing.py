@@ -0,0 +1,219 @@
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst
+
+import pyds
+import numpy as np
+import logging
+import multiprocessing
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from multiprocessing import shared_memory
+
+from .base_custom_parser import BaseCustomParser
+from .tensors import get_numpy_layers
+
+# pending results that attach_probe did not claim this long (s) after their deadline are dropped,
+# e.g. for frames removed between the two probes
+PENDING_EXPIRY = 5.0
+
+# state of every worker process
+_worker_parser = None
+_worker_shms = {}
+
+def _init_worker(parser):
+    global _worker_parser
+    _worker_parser = parser
+
+def _start_worker():
+    """ No-op task, run once per worker to start the pool """
+    return None
+
+def _parse_slot(shm_name, slot_offset, layout):
+    """
+    Runs in a worker process: parses the tensors stored in one slot of the ring.
+    :return: the parser results and the StageTimers split of the parsing, recorded by attach_probe
+    """
+    shm = _worker_shms.get(shm_name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker_shms[shm_name] = shm
+
+    raw_outputs = {name: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=slot_offset + offset)
+                   for name, dtype, shape, offset in layout}
+    timers = _worker_parser.timers
+    start = timers.start()
+    if _worker_parser.model_type == BaseCustomParser.DET_MODEL:
+        result = _worker_parser.parse_det_model(raw_outputs=raw_outputs)
+    else:
+        result = _worker_parser.parse_custom_model(raw_outputs=raw_outputs)
+    return result, timers.split(start)
+
+class AsyncParsingStage:
+    """
+    Moves the parsing of the primary model outputs out of the GStreamer streaming thread.
+
+    submit_probe (pgie src pad) copies the output tensors of every frame into a slot of a
+    shared-memory ring and hands the slot to a pool of worker processes running the parser.
+    attach_probe (placed later in the pipeline, after a queue) waits for the results of each
+    frame, at most latency_budget_ms after the frame was submitted, and adds them to the
+    frame metadata. Frames whose results miss the budget get no detections.
+    """
+    def __init__(self, parser: BaseCustomParser, workers: int = 2, latency_budget_ms: int = 100, slots: int = 8) -> None:
+        self.parser = parser
+        self.latency_budget = latency_budget_ms / 1000.0
+        self.nslots = slots
+        self.shm = None
+        self.layout = None
+        self.slot_size = 0
+        self.free_slots = queue.Queue()
+        # {(pad index, frame number): (future, inline result, deadline)}
+        self.pending = {}
+        self.dropped_frames = 0
+        self.inline_frames = 0
+
+        # the pool only forks its workers when tasks are submitted: they are started now, before the
+        # pipeline starts its streaming and CUDA threads, instead of on the first frame
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                                            initializer=_init_worker, initargs=(parser,))
+        for future in [self.executor.submit(_start_worker) for _ in range(workers)]:
+            future.result()
+
+    def create_ring(self, raw_outputs: dict):
+        """ Sizes the ring from the first frame, every slot holds all the output layers of one frame """
+        self.layout = []
+        offset = 0
+        for name, arr in raw_outputs.items():
+            self.layout.append((name, arr.dtype.str, arr.shape, offset))
+            # keep every layer 64-byte aligned
+            offset += (arr.nbytes + 63) // 64 * 64
+        self.slot_size = offset
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, self.slot_size * self.nslots))
+        for i in range(self.nslots):
+            self.free_slots.put(i)
+        logging.info(f"AsyncParsingStage: created a {self.nslots} x {self.slot_size} bytes shared-memory ring")
+
+    def submit_frame(self, raw_outputs: dict, key):
+        if self.shm is None:
+            self.create_ring(raw_outputs)
+
+        try: slot = self.free_slots.get_nowait()
+        except queue.Empty: return False
+
+        slot_offset = slot * self.slot_size
+        for name, dtype, shape, offset in self.layout:
+            dst = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=slot_offset + offset)
+            np.copyto(dst, raw_outputs[name])
+
+        future = self.executor.submit(_parse_slot, self.shm.name, slot_offset, self.layout)
+        future.add_done_callback(lambda _: self.free_slots.put(slot))
+        self.pending[key] = (future, None, time.monotonic() + self.latency_budget)
+        return True
+
+    def submit_probe(self, pad, info, u_data):
+        gst_buffer = info.get_buffer()
+        if not gst_buffer:
+            return Gst.PadProbeReturn.OK
+
+        batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(gst_buffer))
+        l_frame = batch_meta.frame_meta_list
+        while l_frame is not None:
+            try: frame_meta = pyds.NvDsFrameMeta.cast(l_frame.data)
+            except StopIteration: break
+
+            key = (frame_meta.pad_index, frame_meta.frame_num)
+            l_user = frame_meta.frame_user_meta_list
+            # static frames are not parsed, attach_probe gives them the previous results
+            if self.parser.motion_gate is not None and self.parser.motion_gate.is_static(*key):
+                l_user = None
+            while l_user is not None:
+                try: user_meta = pyds.NvDsUserMeta.cast(l_user.data)
+                except StopIteration: break
+
+                if user_meta.base_meta.meta_type == pyds.NvDsMetaType.NVDSINFER_TENSOR_OUTPUT_META:
+                    start = self.parser.timers.start()
+                    tensor_meta = pyds.NvDsInferTensorMeta.cast(user_meta.user_meta_data)
+                    raw_outputs = get_numpy_layers(tensor_meta, copy=False)
+                    self.parser.timers.lap("fetch", start)
+                    self.parser.capture_frame(raw_outputs, frame_meta)
+                    if raw_outputs is not None and not self.submit_frame(raw_outputs, key):
+                        # the ring is full: parse this frame in the streaming thread
+                        self.inline_frames += 1
+                        self.pending[key] = (None, self.parse_inline(raw_outputs), time.monotonic() + self.latency_budget)
+
+                try: l_user = l_user.next
+                except StopIteration: break
+
+            try:
+                frame_meta.bInferDone = True
+                l_frame = l_frame.next
+            except StopIteration: break
+        return Gst.PadProbeReturn.OK
+
+    def parse_inline(self, raw_outputs: dict):
+        """ Same results as _parse_slot """
+        timers = self.parser.timers
+        start = timers.start()
+        if self.parser.model_type == BaseCustomParser.DET_MODEL:
+            result = self.parser.parse_det_model(raw_outputs=raw_outputs)
+        else:
+            result = self.parser.parse_custom_model(raw_outputs=raw_outputs)
+        return result, timers.split(start)
+
+    def attach_probe(self, pad, info, u_data):
+        gst_buffer = info.get_buffer()
+        if not gst_buffer:
+            return Gst.PadProbeReturn.OK
+
+        batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(gst_buffer))
+        l_frame = batch_meta.frame_meta_list
+        while l_frame is not None:
+            try: frame_meta = pyds.NvDsFrameMeta.cast(l_frame.data)
+            except StopIteration: break
+
+            stream_index = frame_meta.pad_index
+            frame_number = frame_meta.frame_num
+            entry = self.pending.pop((stream_index, frame_number), None)
+            if self.parser.motion_gate is not None and self.parser.motion_gate.take_static(stream_index, frame_number):
+                self.parser.add_previous_results(batch_meta, frame_meta, stream_index, frame_number)
+            elif entry is not None:
+                future, result, deadline = entry
+                if future is not None:
+                    try:
+                        result = future.result(timeout=max(0.0, deadline - time.monotonic()))
+                    except TimeoutError:
+                        self.dropped_frames += 1
+                        logging.debug(f"AsyncParsingStage: results of frame {frame_number} (source {stream_index}) missed the latency budget")
+                        result = None
+                    except Exception as e:
+                        logging.error(f"AsyncParsingStage: parser failed on frame {frame_number} (source {stream_index}): {e}")
+                        result = None
+                if result is not None:
+                    (outputs, custom_msg), split = result
+                    self.parser.timers.record_split("decode", split)
+                    self.parser.add_frame_results(outputs, custom_msg, batch_meta, frame_meta, stream_index, frame_number)
+
+            try: l_frame = l_frame.next
+            except StopIteration: break
+
+        self.expire_pending()
+        return Gst.PadProbeReturn.OK
+
+    def expire_pending(self):
+        """ Drops the results that attach_probe never claimed """
+        expired_before = time.monotonic() - PENDING_EXPIRY
+        for key in [key for key, (_, _, deadline) in self.pending.items() if deadline < expired_before]:
+            future = self.pending.pop(key)[0]
+            if future is not None:
+                future.cancel()
+            self.dropped_frames += 1
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+        if self.dropped_frames or self.inline_frames:
+            logging.info(f"AsyncParsingStage: {self.dropped_frames} frames missed the latency budget, {self.inline_frames} frames were parsed inline")
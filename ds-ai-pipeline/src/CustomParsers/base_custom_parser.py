@@ -1,13 +1,20 @@
-from cgi import print_arguments
-import gi
-gi.require_version("Gst", "1.0")
-from gi.repository import GObject, Gst
+try:
+    import gi
+    gi.require_version("Gst", "1.0")
+    from gi.repository import GObject, Gst
+    import pyds
+except ImportError:
+    # parsers also run offline, without DeepStream (see parser_benchmark)
+    Gst = pyds = None
 
-import pyds
 import numpy as np
-import ctypes
 import logging
 
+from .tensors import get_numpy_layers
+from .detections import as_detection_batch, EXTRAS_INDEX_FIELD
+from .osd_style import DEFAULT_OSD_STYLE
+from .stage_timers import StageTimers
+
 UNTRACKED_OBJECT_ID = 0xffffffffffffffff
 
 class BoundingBox:
@@ -31,20 +38,127 @@ class BaseCustomParser:
         self.labels = []
         self.det_th = 0.5        
         self.mns_th = 0.213
+        # score threshold of every class id (inf for the classes left out), None to use det_th
+        # for all the classes. Set with set_class_filter, applied by the detection parsers before NMS
+        self.class_th = None
         self.msg_helper = msg_helper
+        # parsers that keep output arrays after returning must work on copies
+        self.copy_tensors = False
+        # display-only fields (styles, display_text, lines) are only written when the OSD draws them
+        self.osd_enabled = True
+        self.osd_style = DEFAULT_OSD_STYLE
+        # TensorCapture recording the raw outputs of every frame, set from the twin
+        self.capture = None
+        # copy of the raw outputs of the first frame, to validate a replacement parser (see ParserSlot)
+        self.sample_outputs = None
+        # per-stage time histograms of the probes (and of the nested stages the parser measures)
+        self.timers = StageTimers()
+        # MotionGate of the pipeline, its static frames get the results of the last parsed frame again
+        self.motion_gate = None
 
     def get_name(self):
         return self.name
 
+    def load_model_config(self, config_file: str):
+        """ Called once with the nvinfer/nvinferserver config file of the model, before the pipeline starts """
+        pass
+
+    def set_class_filter(self, classes=None, class_thresholds=None):
+        """
+        :param classes: allow-list of class labels or ids, the detections of the other classes are dropped
+        :param class_thresholds: {class label or id: score threshold}, the other classes keep the
+        threshold of the parser (see default_class_threshold)
+        """
+        self.class_th = None
+        if classes is None and not class_thresholds:
+            return
+        default_th = self.default_class_threshold()
+        if default_th is None or not self.labels:
+            logging.warning(f"CustomParser. Parser '{self.get_name()}' has no class filter, classes and classThresholds are ignored")
+            return
+
+        class_th = np.full(len(self.labels), default_th, dtype=np.float32)
+        for key, threshold in (class_thresholds or {}).items():
+            class_id = self.get_class_id(key)
+            if class_id is not None:
+                class_th[class_id] = threshold
+        if classes is not None:
+            allowed = np.zeros(len(self.labels), dtype=bool)
+            for key in classes:
+                class_id = self.get_class_id(key)
+                if class_id is not None:
+                    allowed[class_id] = True
+            class_th[~allowed] = np.inf
+        self.class_th = class_th
+
+    def default_class_threshold(self):
+        """
+        :return: score threshold of the classes without one in the class filter, i.e. the one the
+        parser applies without a filter. None for the parsers that don't apply the class filter.
+        """
+        return None
+
+    def get_class_id(self, key):
+        """ :return: class id of a label or id (int or numeric string), None if the parser has no such class """
+        if isinstance(key, int) or (isinstance(key, str) and key.isdigit()):
+            class_id = int(key)
+        elif key in self.labels:
+            class_id = self.labels.index(key)
+        else:
+            class_id = -1
+        if not 0 <= class_id < len(self.labels):
+            logging.error(f"CustomParser. Error: unknown class '{key}' in the class filter of '{self.get_name()}'")
+            return None
+        return class_id
+
+    def get_class_thresholds(self, class_ids):
+        """ :return: score threshold of every class id (class_th must be set), inf for the ids out of the label range """
+        class_th = self.class_th
+        in_range = (class_ids >= 0) & (class_ids < len(class_th))
+        return np.where(in_range, class_th[np.clip(class_ids, 0, len(class_th) - 1)], np.inf)
+
     def parse_det_model(self, raw_outputs: dict):       
         pass 
 
     def parse_custom_model(self, raw_outputs: dict):
         pass
 
+    def parse_det_batch(self, raw_outputs: dict):
+        """
+        Optional batch-level version of parse_det_model. Every entry in raw_outputs holds the
+        outputs of all the frames in the batch, stacked along a new first axis.
+        Must return a list of detections and a list of custom messages, one item per frame.
+        Only called when overridden (see has_batch_parser).
+        """
+        logging.error(f"CustomParser. Error: '{self.get_name()}' has no batch-level detection parser")
+        return [], []
+
+    def parse_custom_batch(self, raw_outputs: dict):
+        """
+        Optional batch-level version of parse_custom_model (see parse_det_batch).
+        Must return a list of outputs and a list of custom messages, one item per frame.
+        """
+        logging.error(f"CustomParser. Error: '{self.get_name()}' has no batch-level custom parser")
+        return [], []
+
+    def has_batch_parser(self):
+        """ True if this parser overrides the batch-level hook for its model type """
+        if self.model_type == BaseCustomParser.DET_MODEL:
+            return type(self).parse_det_batch is not BaseCustomParser.parse_det_batch
+        return type(self).parse_custom_batch is not BaseCustomParser.parse_custom_batch
+
     def add_custom_to_meta(self, outputs, batch_meta, frame_meta):
         pass
 
+    def capture_frame(self, raw_outputs: dict, frame_meta):
+        """ Records the raw outputs of a frame when the tensor capture is on, keeps the first one as sample """
+        if raw_outputs is None:
+            return
+        if self.sample_outputs is None:
+            self.sample_outputs = {name: np.array(arr, copy=True) for name, arr in raw_outputs.items()}
+        if self.capture is not None:
+            self.capture.record(raw_outputs, frame_meta.frame_num, frame_meta.pad_index, frame_meta.buf_pts)
+
     def pgie_src_pad_buffer_probe(self, pad, info, u_data):
         gst_buffer = info.get_buffer()
         
@@ -56,6 +170,13 @@ class BaseCustomParser:
         batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(gst_buffer))
         l_frame = batch_meta.frame_meta_list
 
+        # with a batch-level parser, the tensors of all frames are collected first
+        # and parsed with a single call
+        use_batch_parser = self.has_batch_parser()
+        batch_frames = []
+        timers = self.timers
+        motion_gate = self.motion_gate
+
         # iterate through the frames    
         while l_frame is not None:
             try: frame_meta = pyds.NvDsFrameMeta.cast(l_frame.data)
@@ -65,6 +186,9 @@ class BaseCustomParser:
             stream_index = frame_meta.pad_index
 
             l_user = frame_meta.frame_user_meta_list
+            if motion_gate is not None and motion_gate.take_static(stream_index, frame_number):
+                self.add_previous_results(batch_meta, frame_meta, stream_index, frame_number)
+                l_user = None
             while l_user is not None:
                 try: user_meta = pyds.NvDsUserMeta.cast(l_user.data)
                 except StopIteration: break
@@ -73,23 +197,26 @@ class BaseCustomParser:
                     except StopIteration: break
                     continue               
 
+                start = timers.start()
                 tensor_meta = pyds.NvDsInferTensorMeta.cast(user_meta.user_meta_data)
                 raw_outputs = self.get_numpy_layers(tensor_meta=tensor_meta) 
+                timers.lap("fetch", start)
+                self.capture_frame(raw_outputs, frame_meta)
 
+                if use_batch_parser and raw_outputs is not None:
+                    batch_frames.append((frame_meta, stream_index, frame_number, raw_outputs))
                 # process detection model 
-                if self.model_type == BaseCustomParser.DET_MODEL:
+                elif self.model_type == BaseCustomParser.DET_MODEL:
+                    start = timers.start()
                     detections, custom_msg = self.parse_det_model(raw_outputs=raw_outputs)
-                    # passing custom message to IotMSGHelper
-                    if custom_msg and self.msg_helper:
-                        self.msg_helper.add_custom_msg_from_pgie(stream_index, frame_number, custom_msg)
-                    self.add_detections_to_meta(detections=detections, batch_meta=batch_meta, frame_meta=frame_meta, labels=self.labels)
+                    timers.lap("decode", start)
+                    self.add_frame_results(detections, custom_msg, batch_meta, frame_meta, stream_index, frame_number)
                 
                 elif self.model_type == BaseCustomParser.CUSTOM_MODEL:
+                    start = timers.start()
                     outputs, custom_msg = self.parse_custom_model(raw_outputs=raw_outputs)                    
-                    # passing custom message to IotMSGHelper
-                    if custom_msg and self.msg_helper:
-                        self.msg_helper.add_custom_msg_from_pgie(stream_index, frame_number, custom_msg)
-                    self.add_custom_to_meta(outputs, batch_meta, frame_meta)
+                    timers.lap("decode", start)
+                    self.add_frame_results(outputs, custom_msg, batch_meta, frame_meta, stream_index, frame_number)
 
 
                 try: l_user = l_user.next
@@ -99,82 +226,108 @@ class BaseCustomParser:
                 frame_meta.bInferDone = True
                 l_frame = l_frame.next
             except StopIteration: break
+
+        if batch_frames:
+            self.parse_batch(batch_frames, batch_meta)
         return Gst.PadProbeReturn.OK
 
+    def parse_batch(self, batch_frames, batch_meta):
+        """ Stacks the tensors of all frames, calls the batch-level hook once and fans the results back out """
+        # the decode time of a batch is recorded once, for all its frames
+        start = self.timers.start()
+        layer_names = batch_frames[0][3].keys()
+        raw_outputs = {name: np.stack([frame[3][name] for frame in batch_frames]) for name in layer_names}
+
+        if self.model_type == BaseCustomParser.DET_MODEL:
+            results, custom_msgs = self.parse_det_batch(raw_outputs=raw_outputs)
+        else:
+            results, custom_msgs = self.parse_custom_batch(raw_outputs=raw_outputs)
+        self.timers.lap("decode", start)
+
+        for (frame_meta, stream_index, frame_number, _), result, custom_msg in zip(batch_frames, results, custom_msgs):
+            self.add_frame_results(result, custom_msg, batch_meta, frame_meta, stream_index, frame_number)
+
+    def add_frame_results(self, outputs, custom_msg, batch_meta, frame_meta, stream_index, frame_number):
+        """ Attaches the parsed outputs of one frame to its metadata """
+        timers = self.timers
+        start = timers.start()
+        # passing custom message to IotMSGHelper
+        if custom_msg and self.msg_helper:
+            self.msg_helper.add_custom_msg_from_pgie(stream_index, frame_number, custom_msg)
+
+        if self.model_type == BaseCustomParser.DET_MODEL:
+            detections = as_detection_batch(outputs)
+            # the extras of the detections go to the IoT message
+            if detections.extras is not None and self.msg_helper:
+                self.msg_helper.add_detections_from_pgie(stream_index, frame_number, detections)
+            start = timers.lap("message", start)
+            self.add_detections_to_meta(detections=detections, batch_meta=batch_meta, frame_meta=frame_meta, labels=self.labels,
+                                        osd_style=self.osd_style if self.osd_enabled else None)
+        elif self.model_type == BaseCustomParser.CUSTOM_MODEL:
+            start = timers.lap("message", start)
+            self.add_custom_to_meta(outputs, batch_meta, frame_meta)
+        timers.lap("meta", start)
+        if self.motion_gate is not None:
+            self.motion_gate.remember(stream_index, outputs, custom_msg)
+
+    def add_previous_results(self, batch_meta, frame_meta, stream_index, frame_number):
+        """ Attaches the results of the last parsed frame of the source to a static frame (see MotionGate) """
+        previous = self.motion_gate.previous_results(stream_index)
+        if previous is not None:
+            outputs, custom_msg = previous
+            self.add_frame_results(outputs, custom_msg, batch_meta, frame_meta, stream_index, frame_number)
+
     @staticmethod
-    def add_detections_to_meta(detections, labels, batch_meta, frame_meta):
-        """ Inserts an object into the metadata """
+    def add_detections_to_meta(detections, labels, batch_meta, frame_meta, osd_style=DEFAULT_OSD_STYLE):
+        """
+        Inserts the detections (a DetectionBatch or a list of BoundingBox) into the metadata.
+        With osd_style None (OSD disabled) only the box, class, label and confidence are set.
+        Detections with extras get their index in misc_obj_info (see EXTRAS_INDEX_FIELD).
+        """
         # this is a good place to insert objects into the metadata.
+        detections = as_detection_batch(detections)
+        data = detections.data
+        if len(data) == 0:
+            return
+        with_extras = detections.extras is not None
 
-        for obj in detections:
+        # all the columns are converted to Python numbers at once
+        valid_class = (data["class_id"] >= 0) & (data["class_id"] < len(labels))
+        if not valid_class.all():
+            logging.warning("CustomParser. Warning: class_id has wrong value!")
+        obj_labels = [labels[c] if v else "---" for c, v in zip(data["class_id"].tolist(), valid_class.tolist())]
+        scores = data["score"].tolist()
+        display_texts = [f"{label} {score:04.3f}" for label, score in zip(obj_labels, scores)] if osd_style is not None else obj_labels
+
+        for index, (x, y, w, h, score, class_id, obj_label, display_text) in enumerate(zip(
+                data["x"].tolist(), data["y"].tolist(), data["w"].tolist(), data["h"].tolist(),
+                scores, data["class_id"].tolist(), obj_labels, display_texts)):
             obj_meta = pyds.nvds_acquire_obj_meta_from_pool(batch_meta)
             # Set bbox properties. These are in input resolution.
             rect_params = obj_meta.rect_params
-            rect_params.left   = obj.x
-            rect_params.top    = obj.y
-            rect_params.width  = obj.w
-            rect_params.height = obj.h
+            rect_params.left   = x
+            rect_params.top    = y
+            rect_params.width  = w
+            rect_params.height = h
 
             # Set object info including class, detection confidence, etc.
-            obj_meta.confidence = obj.score
-            obj_meta.class_id = obj.class_id
+            obj_meta.confidence = score
+            obj_meta.class_id = class_id
     
             # There is no tracking ID upon detection. The tracker will assign an ID.
             obj_meta.object_id = UNTRACKED_OBJECT_ID
+            obj_meta.obj_label = obj_label
+            if with_extras:
+                obj_meta.misc_obj_info[EXTRAS_INDEX_FIELD] = index + 1
 
-            if not 0 <= obj.class_id < len(labels):
-                logging.warning("CustomParser. Warning: class_id has wrong value!")
-                obj_meta.obj_label = "---"
-            else:    
-                obj_meta.obj_label = labels[obj.class_id]
-
-            # Semi-transparent yellow backgroud
-            rect_params.has_bg_color = 0
-            rect_params.bg_color.set(1, 1, 0, 0.4)
-    
-            # Red border of width 3
-            rect_params.border_width = 3
-            rect_params.border_color.set(1, 0, 0, 1)
-    
-    
-            # Set display text for the object.
-            txt_params = obj_meta.text_params
-            if txt_params.display_text:
-                pyds.free_buffer(txt_params.display_text)
-    
-            txt_params.x_offset = int(rect_params.left)
-            txt_params.y_offset = max(0, int(rect_params.top) - 10)
-            txt_params.display_text = obj_meta.obj_label + " " + "{:04.3f}".format(obj.score)
-
-            # Font , font-color and font-size
-            txt_params.font_params.font_name = "Serif"
-            txt_params.font_params.font_size = 10
-            # set(red, green, blue, alpha); set to White
-            txt_params.font_params.font_color.set(1.0, 1.0, 1.0, 1.0)
-
-            # Text background color
-            txt_params.set_bg_clr = 1
-            # set(red, green, blue, alpha); set to Black
-            txt_params.text_bg_clr.set(0.0, 0.0, 0.0, 1.0)
+            # Border, text and colors, only needed when the OSD draws the objects
+            if osd_style is not None:
+                osd_style.apply(obj_meta, display_text)
     
             # Inser the object into current frame meta
             # This object has no parent
             pyds.nvds_add_obj_meta_to_frame(frame_meta, obj_meta, None)
 
-    @staticmethod
-    def get_numpy_layers(tensor_meta):
-        result={}
-        for i in range(tensor_meta.num_output_layers):
-            layer = pyds.get_nvds_LayerInfo(tensor_meta, i)
-
-            dtype=None
-            if layer.dataType == 0: dtype = ctypes.c_float
-            elif layer.dataType == 2: dtype = ctypes.c_int8
-            elif layer.dataType == 3: dtype = ctypes.c_int32           
-            else: return None 
-
-            dims = np.trim_zeros(layer.dims.d, 'b') #.tolist()
-            ptr = ctypes.cast(pyds.get_ptr(layer.buffer), ctypes.POINTER(dtype))
-            arr = np.ctypeslib.as_array(ptr, shape=dims)
-            result[layer.layerName] = arr.copy() if arr is not None else None            
-        return result
\ No newline at end of file
+    def get_numpy_layers(self, tensor_meta):
+        """ Zero-copy views on the output layers, unless the parser asked for copies """
+        return get_numpy_layers(tensor_meta, copy=self.copy_tensors)
\ No newline at end of file
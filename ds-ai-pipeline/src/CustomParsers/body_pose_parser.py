@@ -1,10 +1,17 @@
 from .base_custom_parser import BaseCustomParser
 from .pose import pose_decode, pose_plot, get_bboxes_and_lines
-import pyds
+from .kernels import warm_up
+try:
+    import pyds
+except ImportError:
+    # parsers also run offline, without DeepStream (see parser_benchmark)
+    pyds = None
 
 class BodyPoseParser2D(BaseCustomParser):
     def __init__(self) -> None:
         super().__init__(model_type=BaseCustomParser.CUSTOM_MODEL, name="bodypose2d")
+        # compiles the JIT kernels (if numba is installed) before the first frame
+        warm_up("find_peaks", "refine_peaks", "feasible_limbs")
 
     def parse_custom_model(config, raw_outputs: dict):
         try:
@@ -46,39 +53,16 @@ class BodyPoseParser2D(BaseCustomParser):
             obj_meta.obj_label = "person"
 
 
-            ### Customize how show the bbox    #
-            # Semi-transparent yellow backgroud
-            rect_params.has_bg_color = 0
-            rect_params.bg_color.set(1, 1, 0, 0.4)
-    
-            # Red border of width 3
-            rect_params.border_width = 3
-            rect_params.border_color.set(1, 0, 0, 1)
-    
-            # Set display text for the object.
-            txt_params = obj_meta.text_params
-            if txt_params.display_text:
-                pyds.free_buffer(txt_params.display_text)
-    
-            txt_params.x_offset = int(rect_params.left)
-            txt_params.y_offset = max(0, int(rect_params.top) - 10)
-            txt_params.display_text = obj_meta.obj_label 
+            ### Customize how show the bbox, only when the OSD draws it
+            if config.osd_enabled:
+                config.osd_style.apply(obj_meta, obj_meta.obj_label)
 
-            # Font , font-color and font-size
-            txt_params.font_params.font_name = "Serif"
-            txt_params.font_params.font_size = 10
-            # set(red, green, blue, alpha); set to White
-            txt_params.font_params.font_color.set(1.0, 1.0, 1.0, 1.0)
-
-            # Text background color
-            txt_params.set_bg_clr = 1
-            # set(red, green, blue, alpha); set to Black
-            txt_params.text_bg_clr.set(0.0, 0.0, 0.0, 1.0)
-    
             ### Finally, add metadata of the detected object 
             pyds.nvds_add_obj_meta_to_frame(frame_meta, obj_meta, None)            
 
-        # draw lines 
+        # draw lines, display-only
+        if not config.osd_enabled:
+            return
         ND = len(all_lines)//16
         lineIndex=0
         for i in range(ND):
@@ -0,0 +1,83 @@
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+# every record is an npz file with one array per output layer and a META_KEY entry
+# holding a JSON string: {"seq", "frameNumber", "padIndex", "bufPts", "timestamp"}
+META_KEY = "__meta__"
+RECORD_PATTERN = "record-{:06d}.npz"
+
+class TensorCapture:
+    """
+    Records the raw output tensors of the primary model into an on-disk ring of `frames` records,
+    so that the parser (and the messages) can be replayed offline with real traffic (see
+    parser_benchmark.replay). Once the ring is full the oldest record is overwritten, so the
+    directory always holds the last `frames` frames.
+
+    The tensors are copied in the streaming thread and written by a background thread; frames
+    arriving while `queue_size` records are waiting to be written are not captured.
+    """
+    def __init__(self, directory: str, frames: int = 300, queue_size: int = 32) -> None:
+        self.directory = directory
+        self.frames = frames
+        self.seq = 0
+        self.skipped_frames = 0
+        self.records = queue.Queue(maxsize=queue_size)
+
+        os.makedirs(directory, exist_ok=True)
+        # records of a previous capture are replaced, not mixed with the new ones
+        for path in glob.glob(os.path.join(directory, "record-*.npz")):
+            os.remove(path)
+        self.writer = threading.Thread(target=self.write_records, name="TensorCapture", daemon=True)
+        self.writer.start()
+        logging.info(f"TensorCapture: capturing the last {frames} frames into {directory}")
+
+    def record(self, raw_outputs: dict, frame_number: int, pad_index: int, buf_pts: int = 0):
+        meta = {"seq": self.seq, "frameNumber": frame_number, "padIndex": pad_index,
+                "bufPts": buf_pts, "timestamp": time.time()}
+        layers = {name: np.array(arr, copy=True) for name, arr in raw_outputs.items()}
+        try:
+            self.records.put_nowait((meta, layers))
+            self.seq += 1
+        except queue.Full:
+            self.skipped_frames += 1
+
+    def write_records(self):
+        while True:
+            item = self.records.get()
+            if item is None:
+                break
+            meta, layers = item
+            path = os.path.join(self.directory, RECORD_PATTERN.format(meta["seq"] % self.frames))
+            layers[META_KEY] = np.array(json.dumps(meta))
+            try:
+                # readers never see a partially written record
+                with open(path + ".tmp", "wb") as f:
+                    np.savez(f, **layers)
+                os.replace(path + ".tmp", path)
+            except Exception as e:
+                logging.error(f"TensorCapture: error writing {path}: {e}")
+
+    def close(self):
+        self.records.put(None)
+        self.writer.join()
+        if self.skipped_frames:
+            logging.info(f"TensorCapture: {self.skipped_frames} frames were not captured (writer too slow)")
+
+def read_capture(directory: str):
+    """ :return: list of (meta, {layer name: array}) tuples, in capture order """
+    records = []
+    for path in glob.glob(os.path.join(directory, "record-*.npz")):
+        with np.load(path) as data:
+            meta = json.loads(str(data[META_KEY]))
+            records.append((meta, {name: data[name] for name in data.files if name != META_KEY}))
+    records.sort(key=lambda record: record[0]["seq"])
+    return records
+
+if '__main__' == __name__:
+    pass
@@ -0,0 +1,142 @@
+try:
+    import pyds
+except ImportError:
+    # parsers also run offline, without DeepStream (see parser_benchmark)
+    pyds = None
+
+import logging
+import numpy as np
+
+from .base_custom_parser import BaseCustomParser, UNTRACKED_OBJECT_ID
+from .common import get_labels, read_label_file, get_infer_config_labelfile
+from .osd_style import OsdStyle
+
+def top_k(scores, k):
+    """
+    :param scores: B x num_classes array
+    :return: B x k arrays of the class indices and scores of the k best classes of every row,
+    by decreasing score. Only the k selected scores of a row are sorted.
+    """
+    num_classes = scores.shape[1]
+    k = min(k, num_classes)
+    if k < num_classes:
+        idx = np.argpartition(scores, num_classes - k, axis=1)[:, num_classes - k:]
+    else:
+        idx = np.broadcast_to(np.arange(num_classes), scores.shape)
+    top_scores = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+def softmax(logits):
+    e = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+class ClassificationParser(BaseCustomParser):
+    """
+    Full-frame classification: the top_k classes of every frame, from the scores of output_layer
+    (the only output layer of the model when None). The scores of all the frames of a batch go
+    through a single top-k.
+
+    Every frame gets an object covering the whole frame, labeled with the best class and holding
+    a NvDsClassifierMeta with the top_k classes, and a custom message with the top_k classes.
+    Labels are read once, from the labelfile of the model config (ImageNet labels by default).
+    """
+    def __init__(self) -> None:
+        super().__init__(model_type=BaseCustomParser.CUSTOM_MODEL, name="classification")
+        self.labels = get_labels("imagenet1000")
+        self.output_layer = None
+        self.top_k = 5
+        # classes scoring less are not reported
+        self.cls_th = 0.0
+        # set for models that output logits instead of probabilities
+        self.apply_softmax = False
+        self.unique_component_id = 1
+        # the label goes to the top-left corner of the frame, without a border around the frame
+        self.osd_style = OsdStyle(border_width=0)
+
+    def load_model_config(self, config_file: str):
+        labelfile = get_infer_config_labelfile(config_file)
+        if labelfile is None:
+            return
+        try:
+            self.labels = read_label_file(labelfile)
+            logging.info(f"ClassificationParser: {len(self.labels)} labels read from {labelfile}")
+        except Exception as e:
+            logging.error(f"ClassificationParser: error reading labels from {labelfile}: {e}")
+
+    def get_scores(self, raw_outputs: dict):
+        """ :return: B x num_classes float32 scores of the batch, None if the layer is missing """
+        if self.output_layer is not None:
+            layer = raw_outputs.get(self.output_layer)
+        elif len(raw_outputs) == 1:
+            layer = next(iter(raw_outputs.values()))
+        else:
+            logging.error(f"ClassificationParser. Error: the model has {len(raw_outputs)} output layers, set output_layer")
+            return None
+        if layer is None:
+            logging.error(f"ClassificationParser. Error: layer {self.output_layer} missing in output tensors")
+            return None
+        scores = np.asarray(layer, dtype=np.float32).reshape(len(layer), -1)
+        return softmax(scores) if self.apply_softmax else scores
+
+    def parse_custom_batch(self, raw_outputs: dict):
+        scores = self.get_scores(raw_outputs)
+        if scores is None:
+            return [], []
+
+        class_ids, class_scores = top_k(scores, self.top_k)
+        passed = (class_scores >= self.cls_th).tolist()
+        labels = self.labels
+        outputs, custom_msgs = [], []
+        for ids, frame_scores, frame_passed in zip(class_ids.tolist(), class_scores.tolist(), passed):
+            classes = [(c, score, labels[c] if c < len(labels) else str(c))
+                       for c, score, p in zip(ids, frame_scores, frame_passed) if p]
+            outputs.append(classes)
+            custom_msgs.append({"classifications": [{"classId": c, "label": label, "confidence": score}
+                                                    for c, score, label in classes]} if classes else None)
+        return outputs, custom_msgs
+
+    def parse_custom_model(self, raw_outputs: dict):
+        outputs, custom_msgs = self.parse_custom_batch({name: arr[np.newaxis] for name, arr in raw_outputs.items()})
+        if not outputs:
+            return None, None
+        return outputs[0], custom_msgs[0]
+
+    def add_custom_to_meta(self, outputs, batch_meta, frame_meta):
+        """ outputs: list of (class id, score, label) of the frame, by decreasing score """
+        if not outputs:
+            return
+        class_id, score, label = outputs[0]
+        width, height = self.image_size
+
+        obj_meta = pyds.nvds_acquire_obj_meta_from_pool(batch_meta)
+        rect_params = obj_meta.rect_params
+        rect_params.left   = 0
+        rect_params.top    = 0
+        rect_params.width  = width
+        rect_params.height = height
+
+        obj_meta.confidence = score
+        obj_meta.class_id = class_id
+        obj_meta.object_id = UNTRACKED_OBJECT_ID
+        obj_meta.obj_label = label
+        if self.osd_enabled:
+            self.osd_style.apply(obj_meta, f"{label} {score:04.3f}")
+
+        classifier_meta = pyds.nvds_acquire_classifier_meta_from_pool(batch_meta)
+        classifier_meta.unique_component_id = self.unique_component_id
+        for class_id, score, label in outputs:
+            label_info = pyds.nvds_acquire_label_info_meta_from_pool(batch_meta)
+            # a single attribute, holding the top_k classes
+            label_info.label_id = 0
+            label_info.num_classes = len(self.labels)
+            label_info.result_class_id = class_id
+            label_info.result_prob = score
+            label_info.result_label = label
+            pyds.nvds_add_label_info_meta_to_classifier(classifier_meta, label_info)
+        pyds.nvds_add_classifier_meta_to_object(obj_meta, classifier_meta)
+
+        pyds.nvds_add_obj_meta_to_frame(frame_meta, obj_meta, None)
+
+if '__main__' == __name__:
+    pass
@@ -1,5 +1,6 @@
-from cgitb import reset
-from os.path import abspath, dirname, join
+import json
+import re
+from os.path import abspath, dirname, isabs, join
 
 CURR_DIR=dirname(abspath(__file__))
 
@@ -12,5 +13,35 @@ def get_labels(name, background_label=None):
         return result
     return []
 
+def read_label_file(path):
+    """
+    Labels of a label file: a JSON list, a JSON {"class index": label} dict (as the labels_map.txt of
+    the ONNX model zoo), one label per line, or ';'-separated labels (DeepStream classifier label files).
+    """
+    with open(path) as ifile:
+        text = ifile.read()
+    if text.lstrip().startswith(("{", "[")):
+        labels = json.loads(text)
+        if isinstance(labels, dict):
+            indexed = {int(k): v for k, v in labels.items()}
+            labels = [indexed.get(i, "") for i in range(max(indexed, default=-1) + 1)]
+        return [str(l) for l in labels]
+    lines = [l.strip() for l in text.splitlines() if l.strip()]
+    if len(lines) == 1 and ";" in lines[0]:
+        return [l.strip() for l in lines[0].split(";") if l.strip()]
+    return lines
+
+def get_infer_config_labelfile(config_file):
+    """ :return: labelfile path of a nvinfer (labelfile-path=) or nvinferserver (labelfile_path:) config file, or None """
+    try:
+        with open(config_file) as ifile:
+            match = re.search(r'^\s*labelfile[-_]path\s*[=:]\s*"?([^"\n#]+?)"?\s*$', ifile.read(), re.MULTILINE)
+    except OSError:
+        return None
+    if match is None:
+        return None
+    path = match.group(1)
+    return path if isabs(path) else join(dirname(abspath(config_file)), path)
+
 if __name__ == "__main__":
     pass
@@ -0,0 +1,101 @@
+import numpy as np
+
+# One detection: box in image pixels, detection score and class id
+DETECTION_DTYPE = np.dtype([
+    ("x", np.float32),
+    ("y", np.float32),
+    ("w", np.float32),
+    ("h", np.float32),
+    ("score", np.float32),
+    ("class_id", np.int32),
+])
+
+# field of NvDsObjectMeta.misc_obj_info holding 1 + the index of the detection in its DetectionBatch
+# (0: none), so its extras follow the object through the tracker, which may move or drop objects
+EXTRAS_INDEX_FIELD = 0
+
+class DetectionBatch:
+    """
+    The detections of one frame, stored in a structured array of DETECTION_DTYPE, plus an
+    optional extras column (one item per detection, added to the detections of the IoT message).
+
+    Iterating over a DetectionBatch yields records with the attributes of BoundingBox
+    (x, y, w, h, score, class_id), so code written for lists of BoundingBox keeps working.
+    """
+    __slots__ = ("data", "extras")
+
+    def __init__(self, data=None, extras=None) -> None:
+        self.data = np.zeros(0, dtype=DETECTION_DTYPE) if data is None else data
+        if extras is not None and len(extras) != len(self.data):
+            raise ValueError(f"DetectionBatch: {len(extras)} extras for {len(self.data)} detections")
+        self.extras = extras
+
+    @classmethod
+    def from_arrays(cls, boxes, scores, class_ids, extras=None):
+        """
+        :param boxes: Nx4 array, (x, y, w, h) in image pixels
+        :param scores: N detection scores
+        :param class_ids: N class ids
+        """
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        data = np.empty(len(boxes), dtype=DETECTION_DTYPE)
+        data["x"] = boxes[:, 0]
+        data["y"] = boxes[:, 1]
+        data["w"] = boxes[:, 2]
+        data["h"] = boxes[:, 3]
+        data["score"] = scores
+        data["class_id"] = class_ids
+        return cls(data, extras)
+
+    @classmethod
+    def from_xyxy(cls, boxes, scores, class_ids, extras=None):
+        """ Same as from_arrays, with (xmin, ymin, xmax, ymax) boxes """
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        return cls.from_arrays(np.concatenate([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]], axis=1),
+                               scores, class_ids, extras)
+
+    @classmethod
+    def from_bounding_boxes(cls, bboxes):
+        """ Converts a list of BoundingBox (or of any objects with the same attributes) """
+        data = np.array([(b.x, b.y, b.w, b.h, b.score, b.class_id) for b in bboxes], dtype=DETECTION_DTYPE)
+        return cls(data)
+
+    @property
+    def boxes(self):
+        """ Nx4 float32 array, (x, y, w, h) """
+        return np.stack([self.data["x"], self.data["y"], self.data["w"], self.data["h"]], axis=1)
+
+    @property
+    def scores(self):
+        return self.data["score"]
+
+    @property
+    def class_ids(self):
+        return self.data["class_id"]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data.view(np.recarray))
+
+    def __getitem__(self, index):
+        """ A record for an integer index, a DetectionBatch for a slice, mask or index array """
+        if isinstance(index, (int, np.integer)):
+            return self.data.view(np.recarray)[index]
+        extras = None if self.extras is None else [self.extras[i] for i in np.arange(len(self.data))[index]]
+        return DetectionBatch(self.data[index], extras)
+
+    def __repr__(self):
+        return f"DetectionBatch({len(self)} detections)"
+
+def as_detection_batch(detections):
+    """ Returns detections as a DetectionBatch (None or a list of BoundingBox are converted) """
+    if isinstance(detections, DetectionBatch):
+        return detections
+    if detections is None:
+        return DetectionBatch()
+    return DetectionBatch.from_bounding_boxes(detections)
+
+if '__main__' == __name__:
+    pass
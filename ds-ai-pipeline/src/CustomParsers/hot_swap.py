@@ -0,0 +1,98 @@
+try:
+    import gi
+    gi.require_version("Gst", "1.0")
+    from gi.repository import Gst
+except ImportError:
+    # parsers also run offline, without DeepStream (see parser_benchmark)
+    Gst = None
+
+import logging
+import numpy as np
+
+from .base_custom_parser import BaseCustomParser
+from .detections import as_detection_batch
+
+# attributes set on the parser by the pipeline, handed over to the parser replacing it
+# (the class filter is not: it is indexed by class id, set it again with set_class_filter for the labels of the new parser)
+PIPELINE_ATTRIBUTES = ("image_size", "msg_helper", "osd_enabled", "osd_style", "capture", "sample_outputs", "motion_gate")
+
+def validate_parser(parser, raw_outputs: dict):
+    """ Raises if parser fails on raw_outputs or returns results the pipeline can't use """
+    if raw_outputs is None:
+        return
+    if parser.model_type == BaseCustomParser.DET_MODEL:
+        detections, _ = parser.parse_det_model(raw_outputs=raw_outputs)
+        as_detection_batch(detections)
+    else:
+        parser.parse_custom_model(raw_outputs=raw_outputs)
+
+    if not parser.has_batch_parser():
+        return
+    # the probe uses the batch-level hook instead, on a batch of one frame here
+    batch = {name: arr[np.newaxis] for name, arr in raw_outputs.items()}
+    if parser.model_type == BaseCustomParser.DET_MODEL:
+        detections, custom_msgs = parser.parse_det_batch(batch)
+        for dets in detections:
+            as_detection_batch(dets)
+    else:
+        detections, custom_msgs = parser.parse_custom_batch(batch)
+    if len(detections) != 1 or len(custom_msgs) != 1:
+        raise ValueError(f"batch parser returned {len(detections)} results and {len(custom_msgs)} messages for 1 frame")
+
+class ParserSlot:
+    """
+    Holds the pgie parser of a running pipeline, so that it can be replaced without rebuilding
+    the pipeline. The probe reads the parser once per batch, so a swap takes effect between batches.
+
+    swap() validates the new parser on the outputs of a frame seen by the pipeline before putting
+    it in place. If the new parser raises during its first probation_batches batches, the previous
+    parser is put back.
+    """
+    def __init__(self, parser: BaseCustomParser, probation_batches: int = 30) -> None:
+        self.parser = parser
+        self.previous = None
+        self.probation_batches = probation_batches
+        self.probation = 0
+
+    def swap(self, new_parser: BaseCustomParser):
+        """ :return: True if new_parser replaced the current parser """
+        old_parser = self.parser
+        if new_parser.model_type != old_parser.model_type:
+            logging.error(f"Parser '{new_parser.get_name()}' has a different model_type than '{old_parser.get_name()}'. Keeping '{old_parser.get_name()}'.")
+            return False
+
+        for attr in PIPELINE_ATTRIBUTES:
+            setattr(new_parser, attr, getattr(old_parser, attr))
+        try:
+            validate_parser(new_parser, old_parser.sample_outputs)
+        except Exception as e:
+            logging.error(f"Parser '{new_parser.get_name()}' failed on a sample of the model outputs: {e}. Keeping '{old_parser.get_name()}'.")
+            return False
+
+        self.previous = old_parser
+        self.probation = self.probation_batches
+        self.parser = new_parser
+        logging.info(f"Parser '{old_parser.get_name()}' replaced by '{new_parser.get_name()}'")
+        return True
+
+    def pgie_src_pad_buffer_probe(self, pad, info, u_data):
+        parser = self.parser
+        if self.probation == 0:
+            return parser.pgie_src_pad_buffer_probe(pad, info, u_data)
+
+        try:
+            ret = parser.pgie_src_pad_buffer_probe(pad, info, u_data)
+            self.probation -= 1
+            if self.probation == 0:
+                self.previous = None
+            return ret
+        except Exception as e:
+            logging.error(f"Parser '{parser.get_name()}' failed after replacing '{self.previous.get_name()}': {e}. Rolling back.")
+            self.parser = self.previous
+            self.previous = None
+            self.probation = 0
+            # the frames of this batch that were not parsed yet get no results
+            return Gst.PadProbeReturn.OK
+
+if '__main__' == __name__:
+    pass
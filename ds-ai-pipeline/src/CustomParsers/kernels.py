@@ -0,0 +1,292 @@
+"""
+Optional JIT-compiled versions of the heaviest post-processing loops of the parsers (YOLO cell
+selection, greedy NMS, pose peak search and refinement, limb candidate filtering).
+
+When numba is installed the kernels are compiled the first time they are needed, or earlier with
+warm_up() (the parsers warm up the kernels they use when they are constructed, so the compile time
+doesn't hit the first frames of the stream). Otherwise, or with AI_PIPELINE_DISABLE_JIT=1,
+get_kernel() returns None and the parsers use their NumPy code paths. So does get_kernel() for
+tensors of other dtypes than float32 and float64 (float16 outputs for instance), which the kernels
+are not compiled for.
+
+The kernels compute the same values as the NumPy code paths, with the same float32/float64
+arithmetic, so both give the same detections. The only exception is the upsampling of the peak
+refinement: its sums are not added in the order BLAS adds them, so the pose joint scores can
+differ in the last bits.
+"""
+import logging
+import os
+import threading
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    # the parsers use their NumPy code paths
+    numba = None
+
+# set to 1 to use the NumPy code paths even when numba is installed
+DISABLE_JIT_ENV_VAR = "AI_PIPELINE_DISABLE_JIT"
+JIT_ENABLED = numba is not None and os.environ.get(DISABLE_JIT_ENV_VAR, "0") in ("", "0")
+
+EPS32 = float(np.finfo(np.float32).eps)
+# dtypes of the tensors the kernels can be called with
+JIT_DTYPES = (np.dtype(np.float32), np.dtype(np.float64))
+
+def _greedy_nms(coords, iou_threshold, diou):
+    """
+    Same as nms._greedy_nms.
+    :param coords: Nx4 float64 class-offset boxes, sorted by decreasing score
+    :param diou: use the Distance-IoU instead of the IoU
+    :return: indices of the kept boxes, sorted by decreasing score
+    """
+    n = coords.shape[0]
+    areas = (coords[:, 2] - coords[:, 0]) * (coords[:, 3] - coords[:, 1])
+    suppressed = np.zeros(n, dtype=np.bool_)
+    keep = np.empty(n, dtype=np.int64)
+    num_keep = 0
+    for i in range(n):
+        if suppressed[i]:
+            continue
+        keep[num_keep] = i
+        num_keep += 1
+        x1, y1, x2, y2 = coords[i, 0], coords[i, 1], coords[i, 2], coords[i, 3]
+        for j in range(i + 1, n):
+            if suppressed[j]:
+                continue
+            inter_w = np.maximum(np.minimum(coords[j, 2], x2) - np.maximum(coords[j, 0], x1), 0.0)
+            inter_h = np.maximum(np.minimum(coords[j, 3], y2) - np.maximum(coords[j, 1], y1), 0.0)
+            inter_area = inter_w * inter_h
+            overlap = np.maximum(1.0 * inter_area / (areas[j] + areas[i] - inter_area), EPS32)
+            if diou:
+                center_dist = (((x1 + x2) - (coords[j, 0] + coords[j, 2])) ** 2 +
+                               ((y1 + y2) - (coords[j, 1] + coords[j, 3])) ** 2) * 0.25
+                enclose_w = np.maximum(x2, coords[j, 2]) - np.minimum(x1, coords[j, 0])
+                enclose_h = np.maximum(y2, coords[j, 3]) - np.minimum(y1, coords[j, 1])
+                overlap = overlap - center_dist / np.maximum(enclose_w ** 2 + enclose_h ** 2, EPS32)
+            if overlap > iou_threshold:
+                suppressed[j] = True
+    return keep[:num_keep]
+
+def _yolo_select(rows, score_threshold):
+    """
+    The cells of a YOLO head whose objectness and objectness * best class probability pass
+    score_threshold (of the same dtype as rows, as NumPy compares them).
+    :param rows: (B, cells, 5 + num_classes) head
+    :return: frame, cell, score and class of every cell passing, in (frame, cell) order
+    """
+    batch_size, num_cells, num_values = rows.shape
+    # few cells pass: the outputs start small and grow when they are full
+    frames = np.empty(64, dtype=np.int64)
+    cells = np.empty(64, dtype=np.int64)
+    scores = np.empty(64, dtype=rows.dtype)
+    classes = np.empty(64, dtype=np.int64)
+    n = 0
+    for b in range(batch_size):
+        for i in range(num_cells):
+            objectness = rows[b, i, 4]
+            if not objectness > score_threshold:
+                continue
+            best = 5
+            for c in range(6, num_values):
+                if rows[b, i, c] > rows[b, i, best]:
+                    best = c
+            score = rows[b, i, best] * objectness
+            if score > score_threshold:
+                if n == len(frames):
+                    frames = np.concatenate((frames, np.empty_like(frames)))
+                    cells = np.concatenate((cells, np.empty_like(cells)))
+                    scores = np.concatenate((scores, np.empty_like(scores)))
+                    classes = np.concatenate((classes, np.empty_like(classes)))
+                frames[n], cells[n], scores[n], classes[n] = b, i, score, best - 5
+                n += 1
+    return frames[:n], cells[:n], scores[:n], classes[:n]
+
+def _find_peaks(heatmaps, threshold):
+    """
+    Same as pose.find_all_peaks: cells above threshold that are not lower than their 4 neighbors.
+    :return: joint type, x and y of every peak, sorted by joint type, then by y and x
+    """
+    height, width, num_joints = heatmaps.shape
+    is_peak = np.zeros((num_joints, height, width), dtype=np.bool_)
+    count = 0
+    for y in range(height):
+        for x in range(width):
+            for j in range(num_joints):
+                value = heatmaps[y, x, j]
+                if not value > threshold:
+                    continue
+                if y > 0 and heatmaps[y - 1, x, j] > value:
+                    continue
+                if y < height - 1 and heatmaps[y + 1, x, j] > value:
+                    continue
+                if x > 0 and heatmaps[y, x - 1, j] > value:
+                    continue
+                if x < width - 1 and heatmaps[y, x + 1, j] > value:
+                    continue
+                is_peak[j, y, x] = True
+                count += 1
+
+    joint = np.empty(count, dtype=np.int64)
+    peak_x = np.empty(count, dtype=np.int64)
+    peak_y = np.empty(count, dtype=np.int64)
+    n = 0
+    for j in range(num_joints):
+        for y in range(height):
+            for x in range(width):
+                if is_peak[j, y, x]:
+                    joint[n], peak_x[n], peak_y[n] = j, x, y
+                    n += 1
+    return joint, peak_x, peak_y
+
+def _refine_peaks(heatmaps, joint, peak_x, peak_y, win_size, kernels_h, rows_h, kernels_w, rows_w):
+    """
+    Upsamples the patch around every peak (as pose.NMS does, kernel_h @ patch @ kernel_w.T) and
+    finds its maximum.
+    :param kernels_h: kernels_h[h][:rows_h[h], :h] is the interpolation kernel of patches of height h
+    :param kernels_w: same, for the patch widths
+    :return: row and column of the maximum in every upsampled patch, and its value
+    """
+    height, width = heatmaps.shape[0], heatmaps.shape[1]
+    n = len(joint)
+    max_row = np.empty(n, dtype=np.int64)
+    max_col = np.empty(n, dtype=np.int64)
+    max_value = np.empty(n, dtype=np.float64)
+    rows_tmp = np.empty((kernels_h.shape[1], 2 * win_size + 1), dtype=np.float64)
+    for p in range(n):
+        x_min = max(0, peak_x[p] - win_size)
+        y_min = max(0, peak_y[p] - win_size)
+        w = min(width - 1, peak_x[p] + win_size) - x_min + 1
+        h = min(height - 1, peak_y[p] + win_size) - y_min + 1
+        up_h, up_w = rows_h[h], rows_w[w]
+        # kernel_h @ patch
+        for a in range(up_h):
+            for c in range(w):
+                acc = 0.0
+                for k in range(h):
+                    acc += kernels_h[h, a, k] * heatmaps[y_min + k, x_min + c, joint[p]]
+                rows_tmp[a, c] = acc
+        # @ kernel_w.T, keeping the first maximum in row-major order, as argmax does
+        best_value = -np.inf
+        best_row, best_col = 0, 0
+        for a in range(up_h):
+            for b in range(up_w):
+                acc = 0.0
+                for c in range(w):
+                    acc += rows_tmp[a, c] * kernels_w[w, b, c]
+                if acc > best_value:
+                    best_value, best_row, best_col = acc, a, b
+        max_row[p], max_col[p], max_value[p] = best_row, best_col, best_value
+    return max_row, max_col, max_value
+
+def _feasible_limbs(paf_flat, paf_shape, joint_src, joint_dst, pair_limb, limb_dir, long_dist_penalty,
+                    num_intermed_pts, min_pts_over, threshold):
+    """
+    Pre-filter of pose._score_limb_candidates: the pairs whose PAF projection passes threshold at
+    min_pts_over intermediate points or more, and whose penalized mean projection can be positive.
+    The projections are not rounded as the final scores are, so they are compared with a small
+    tolerance. Pairs with joints outside the PAFs are kept, for the NumPy scoring to handle them.
+    :return: indices of the feasible pairs
+    """
+    paf_height, paf_width, paf_channels = paf_shape[0], paf_shape[1], paf_shape[2]
+    feasible = np.empty(len(pair_limb), dtype=np.int64)
+    n = 0
+    for p in range(len(pair_limb)):
+        src_x, src_y = joint_src[p, 0], joint_src[p, 1]
+        dst_x, dst_y = joint_dst[p, 0], joint_dst[p, 1]
+        # intermediate points are rounded between the rounded joints
+        if min(np.rint(src_x), np.rint(dst_x)) < 0 or max(np.rint(src_x), np.rint(dst_x)) >= paf_width or \
+                min(np.rint(src_y), np.rint(dst_y)) < 0 or max(np.rint(src_y), np.rint(dst_y)) >= paf_height:
+            feasible[n] = p
+            n += 1
+            continue
+
+        step_x = (dst_x - src_x) / (num_intermed_pts - 1)
+        step_y = (dst_y - src_y) / (num_intermed_pts - 1)
+        count, total, max_tol = 0, 0.0, 0.0
+        for t in range(num_intermed_pts):
+            if t == num_intermed_pts - 1:
+                x, y = dst_x, dst_y
+            else:
+                x, y = t * step_x + src_x, t * step_y + src_y
+            index = (np.int64(np.rint(y)) * paf_width + np.int64(np.rint(x))) * paf_channels + 2 * pair_limb[p]
+            weighted_x = paf_flat[index] * limb_dir[p, 0]
+            weighted_y = paf_flat[index + 1] * limb_dir[p, 1]
+            score = weighted_x + weighted_y
+            tol = 1e-9 * (1 + abs(weighted_x) + abs(weighted_y))
+            if score > threshold - tol:
+                count += 1
+            elif count + num_intermed_pts - 1 - t < min_pts_over:
+                break
+            total += score
+            max_tol = max(max_tol, tol)
+        else:
+            if count >= min_pts_over and total / num_intermed_pts + long_dist_penalty[p] + max_tol > 0:
+                feasible[n] = p
+                n += 1
+    return feasible[:n]
+
+def _warm_up_args(name):
+    """ Small inputs with the types and memory layouts the parsers call the kernel name with """
+    if name == "greedy_nms":
+        return np.array([[0., 0., 10., 10.], [1., 1., 11., 11.], [20., 20., 30., 30.]]), 0.5, False
+    if name == "yolo_select":
+        return np.full((1, 4, 7), 0.9, dtype=np.float32), np.float32(0.5)
+    if name == "find_peaks":
+        # pose.NMS passes a view of the joint channels of the heatmaps
+        return np.ones((4, 4, 20), dtype=np.float32)[:, :, :18], np.float32(0.05)
+    if name == "refine_peaks":
+        index = np.zeros(1, dtype=np.int64)
+        kernels = np.ones((6, 5, 5))
+        rows = np.full(6, 5, dtype=np.int64)
+        return np.ones((4, 4, 20), dtype=np.float32)[:, :, :18], index, index, index, 2, kernels, rows, kernels, rows
+    if name == "feasible_limbs":
+        joints = np.ones((2, 4))
+        pair_limb = np.zeros(2, dtype=np.int64)
+        return np.ones(4 * 4 * 2, dtype=np.float32), (4, 4, 2), joints, joints, pair_limb, np.ones((2, 2)), \
+            np.zeros(2), 10, 9, 0.05
+
+KERNELS = {
+    "greedy_nms": _greedy_nms,
+    "yolo_select": _yolo_select,
+    "find_peaks": _find_peaks,
+    "refine_peaks": _refine_peaks,
+    "feasible_limbs": _feasible_limbs,
+}
+
+_compiled = {}
+_lock = threading.Lock()
+
+def warm_up(*names):
+    """
+    Compiles the kernels names (all the kernels if none is given) and runs them once, so that they
+    are ready before the first frame. Compiled kernels are cached on disk by numba, later processes
+    only load them. Does nothing without numba.
+    """
+    if not JIT_ENABLED:
+        return
+    with _lock:
+        for name in names or KERNELS:
+            if name in _compiled:
+                continue
+            try:
+                kernel = numba.njit(cache=True, nogil=True, error_model='numpy')(KERNELS[name])
+                kernel(*_warm_up_args(name))
+            except Exception as e:
+                logging.warning(f"JIT kernel '{name}' not available, using the NumPy code path: {e}")
+                kernel = None
+            _compiled[name] = kernel
+
+def get_kernel(name, dtype=None):
+    """
+    :param dtype: dtype of the tensors passed to the kernel, if it depends on the model outputs
+    :return: the compiled kernel name, or None to use the NumPy code path
+    """
+    if not JIT_ENABLED or (dtype is not None and dtype not in JIT_DTYPES):
+        return None
+    if name not in _compiled:
+        warm_up(name)
+    return _compiled[name]
+
+if '__main__' == __name__:
+    pass
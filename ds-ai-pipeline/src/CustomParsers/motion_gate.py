@@ -0,0 +1,167 @@
+try:
+    import gi
+    gi.require_version("Gst", "1.0")
+    from gi.repository import Gst
+    import pyds
+except ImportError:
+    # the motion scores can also be computed offline, without DeepStream
+    Gst = pyds = None
+
+import logging
+import numpy as np
+
+# nvinfer skips a batch when (batch counter % (interval + 1)) > 0: with this interval it skips
+# every batch, with interval 0 it infers every batch
+SKIP_ALL_INTERVAL = 2147483647
+
+def downscale_luma(frame, width: int):
+    """ :return: int16 green channel (a cheap luma) of an RGBA frame, subsampled to about width columns """
+    step = max(1, frame.shape[1] // width)
+    return frame[::step, ::step, 1].astype(np.int16)
+
+def motion_score(frame, reference, pixel_threshold: int):
+    """ :return: fraction of the pixels of frame that differ from reference by more than pixel_threshold """
+    return np.count_nonzero(np.abs(frame - reference) > pixel_threshold) / frame.size
+
+def copy_views(value):
+    """
+    :return: value with a copy of the arrays (in lists, tuples and dicts) that are views on other
+    memory, such as the output tensors of nvinfer returned as is by a parser
+    """
+    if isinstance(value, np.ndarray):
+        return value.copy() if value.base is not None else value
+    if isinstance(value, list):
+        return [copy_views(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(copy_views(v) for v in value)
+    if isinstance(value, dict):
+        return {k: copy_views(v) for k, v in value.items()}
+    return value
+
+class SourceGate:
+    """
+    Motion gating of one source. A frame is static when less than threshold of its (downscaled)
+    pixels changed since the last inferred frame, so slow changes add up until they trigger an
+    inference. At most max_skip_frames frames in a row are skipped.
+    """
+    def __init__(self, name: str, threshold: float = 0.005, pixel_threshold: int = 20,
+                 max_skip_frames: int = 30, width: int = 160) -> None:
+        self.name = name
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.max_skip_frames = max_skip_frames
+        self.width = width
+        self.reference = None
+        self.skip_run = 0
+        self.frames = 0
+        self.skipped = 0
+
+    def update(self, frame):
+        """ :return: True if the inference of frame (RGBA) can be skipped """
+        small = downscale_luma(frame, self.width)
+        self.frames += 1
+        if self.reference is not None and self.reference.shape == small.shape and self.skip_run < self.max_skip_frames \
+                and motion_score(small, self.reference, self.pixel_threshold) < self.threshold:
+            self.skip_run += 1
+            self.skipped += 1
+            return True
+        # the frame is inferred, the next ones are compared with it
+        self.reference = small
+        self.skip_run = 0
+        return False
+
+class MotionGate:
+    """
+    Skips the primary inference of the sources whose scene does not change, and gives their
+    frames the results of the last inferred frame of the same source.
+
+    sink_probe (pgie sink pad) scores the motion of every frame of the gated sources, on the
+    RGBA frames of the batch. nvinfer can only skip whole batches, so the inference is turned
+    off (through its interval) for the batches where every frame is static; in the other
+    batches the static frames are still inferred, but not parsed. The parser of the primary
+    model (see BaseCustomParser.motion_gate) keeps the results of the last parsed frame of every
+    source and attaches them again to the static frames. Those results are kept across frames,
+    after nvinfer reused its output buffers: the arrays of the results that are views (of parsers
+    returning output layers as is, without copy_tensors) are copied when they are kept.
+    """
+    def __init__(self, sources: dict, pgie=None) -> None:
+        # {pad index: SourceGate} of the gated sources
+        self.sources = sources
+        self.pgie = pgie
+        self.infer_interval = 0
+        if pgie is not None:
+            configured_interval = pgie.get_property("interval")
+            if configured_interval != 0:
+                logging.warning(f"MotionGate: the primary model has interval={configured_interval}, static frames will only skip the parser")
+                self.pgie = None
+        self.static_frames = set()
+        self.previous = {}
+        self.skipped_batches = 0
+
+    def sink_probe(self, pad, info, u_data):
+        gst_buffer = info.get_buffer()
+        if not gst_buffer:
+            return Gst.PadProbeReturn.OK
+
+        batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(gst_buffer))
+        all_static = True
+        l_frame = batch_meta.frame_meta_list
+        while l_frame is not None:
+            try: frame_meta = pyds.NvDsFrameMeta.cast(l_frame.data)
+            except StopIteration: break
+
+            gate = self.sources.get(frame_meta.pad_index)
+            if gate is not None and gate.update(pyds.get_nvds_buf_surface(hash(gst_buffer), frame_meta.batch_id)):
+                self.static_frames.add((frame_meta.pad_index, frame_meta.frame_num))
+            else:
+                all_static = False
+
+            try: l_frame = l_frame.next
+            except StopIteration: break
+
+        if all_static and batch_meta.num_frames_in_batch > 0:
+            self.skipped_batches += 1
+            self.set_interval(SKIP_ALL_INTERVAL)
+        else:
+            self.set_interval(0)
+        return Gst.PadProbeReturn.OK
+
+    def set_interval(self, interval: int):
+        if self.pgie is not None and interval != self.infer_interval:
+            self.pgie.set_property("interval", interval)
+            self.infer_interval = interval
+
+    def is_static(self, stream_index: int, frame_number: int):
+        return (stream_index, frame_number) in self.static_frames
+
+    def take_static(self, stream_index: int, frame_number: int):
+        """ :return: True if the frame was static, forgetting it """
+        key = (stream_index, frame_number)
+        if key in self.static_frames:
+            self.static_frames.discard(key)
+            return True
+        return False
+
+    def remember(self, stream_index: int, outputs, custom_msg):
+        """ Keeps the results of the last parsed frame of a source """
+        self.previous[stream_index] = (copy_views(outputs), copy_views(custom_msg))
+
+    def previous_results(self, stream_index: int):
+        """ :return: (outputs, custom_msg) of the last parsed frame of the source, None before the first one """
+        return self.previous.get(stream_index)
+
+    def snapshot(self, reset: bool = False):
+        """ :return: {sensor name: {"frames", "skipped", "skipRate"}} since the last reset """
+        sensors = {}
+        for gate in self.sources.values():
+            sensors[gate.name] = {
+                "frames": gate.frames,
+                "skipped": gate.skipped,
+                "skipRate": gate.skipped / gate.frames if gate.frames else 0.0,
+            }
+            if reset:
+                gate.frames = gate.skipped = 0
+        return sensors
+
+if '__main__' == __name__:
+    pass
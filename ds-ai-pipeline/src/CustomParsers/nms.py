@@ -1,5 +1,9 @@
 import numpy as np
 
+from .kernels import get_kernel
+
+NMS_METHODS = ('nms', 'soft-nms', 'diou-nms')
+
 def bboxes_iou(boxes1, boxes2):
     '''calculate the Intersection Over Union value'''
     boxes1 = np.array(boxes1)
@@ -18,39 +22,126 @@ def bboxes_iou(boxes1, boxes2):
 
     return ious
 
-def nms(bboxes, iou_threshold, sigma=0.3, method='nms'):
+def bboxes_diou(boxes1, boxes2):
+    '''calculate the Distance-IoU value (IoU minus the normalized distance between box centers)'''
+    boxes1 = np.array(boxes1)
+    boxes2 = np.array(boxes2)
+
+    ious          = bboxes_iou(boxes1, boxes2)
+    center_dist   = np.sum(((boxes1[..., :2] + boxes1[..., 2:]) - (boxes2[..., :2] + boxes2[..., 2:])) ** 2, axis=-1) * 0.25
+
+    enclose_lu    = np.minimum(boxes1[..., :2], boxes2[..., :2])
+    enclose_rd    = np.maximum(boxes1[..., 2:], boxes2[..., 2:])
+    enclose_diag  = np.sum((enclose_rd - enclose_lu) ** 2, axis=-1)
+
+    return ious - center_dist / np.maximum(enclose_diag, np.finfo(np.float32).eps)
+
+def nms(bboxes, iou_threshold, sigma=0.3, method='nms', topk=None, max_dets=None):
     """
     :param bboxes: (xmin, ymin, xmax, ymax, score, class)
+    :param topk: if given, only the topk highest scored boxes go into the suppression step
+    :param max_dets: if given, at most max_dets boxes (the highest scored ones) are returned
+    :return: Nx6 array of the kept boxes, grouped by class and sorted by score inside every class
+
+    All classes are processed in a single pass. Every class is shifted to its own region of
+    the coordinate space (class-offset trick), so boxes of different classes never overlap and
+    each kept box only needs one vectorized overlap computation against the remaining boxes.
+    Boxes with a non-positive score are discarded.
 
     Note: soft-nms, https://arxiv.org/pdf/1704.04503.pdf
           https://github.com/bharatsingh430/soft-nms
+          diou-nms, https://arxiv.org/pdf/1911.08287.pdf
     """
-    classes_in_img = list(set(bboxes[:, 5]))
-    best_bboxes = []
+    assert method in NMS_METHODS
+
+    bboxes = np.asarray(bboxes)
+    if len(bboxes) == 0:
+        return np.zeros((0, 6), dtype=np.float32)
 
-    for cls in classes_in_img:
-        cls_mask = (bboxes[:, 5] == cls)
-        cls_bboxes = bboxes[cls_mask]
+    scores = bboxes[:, 4]
+    order = np.argsort(-scores, kind='stable')
+    order = order[scores[order] > 0.]
+    if topk is not None:
+        order = order[:topk]
+    cand_bboxes = bboxes[order]
+    if len(cand_bboxes) == 0:
+        return cand_bboxes
 
-        while len(cls_bboxes) > 0:
-            max_ind = np.argmax(cls_bboxes[:, 4])
-            best_bbox = cls_bboxes[max_ind]
-            best_bboxes.append(best_bbox)
-            cls_bboxes = np.concatenate([cls_bboxes[: max_ind], cls_bboxes[max_ind + 1:]])
-            iou = bboxes_iou(best_bbox[np.newaxis, :4], cls_bboxes[:, :4])
-            weight = np.ones((len(iou),), dtype=np.float32)
+    # offsets are computed in float64 so large class ids don't cost float32 precision
+    coords = cand_bboxes[:, :4].astype(np.float64)
+    span = coords.max() - coords.min() + 1.
+    coords += (cand_bboxes[:, 5] * span)[:, np.newaxis]
 
-            assert method in ['nms', 'soft-nms']
+    if method == 'soft-nms':
+        keep, kept_scores = _soft_nms(coords, cand_bboxes[:, 4], sigma)
+    else:
+        keep = _greedy_nms(coords, iou_threshold, method)
+        kept_scores = cand_bboxes[keep, 4]
 
-            if method == 'nms':
-                iou_mask = iou > iou_threshold
-                weight[iou_mask] = 0.0
+    if max_dets is not None:
+        keep, kept_scores = keep[:max_dets], kept_scores[:max_dets]
 
-            if method == 'soft-nms':
-                weight = np.exp(-(1.0 * iou ** 2 / sigma))
+    best_bboxes = cand_bboxes[keep]
+    best_bboxes[:, 4] = kept_scores
+    return best_bboxes[np.argsort(best_bboxes[:, 5], kind='stable')]
 
-            cls_bboxes[:, 4] = cls_bboxes[:, 4] * weight
-            score_mask = cls_bboxes[:, 4] > 0.
-            cls_bboxes = cls_bboxes[score_mask]
+def _greedy_nms(coords, iou_threshold, method):
+    """
+    :param coords: Nx4 class-offset boxes, sorted by decreasing score
+    :return: indices of the kept boxes, sorted by decreasing score
+    """
+    kernel = get_kernel("greedy_nms")
+    if kernel is not None:
+        return kernel(np.ascontiguousarray(coords, dtype=np.float64), float(iou_threshold), method == 'diou-nms')
+
+    if method == 'diou-nms':
+        overlap_fn = lambda best, rest: bboxes_diou(coords[best], coords[rest])
+    else:
+        overlap_fn = _iou_one_to_many(coords)
+
+    alive = np.arange(len(coords))
+    keep = []
+    while len(alive) > 0:
+        best, alive = alive[0], alive[1:]
+        keep.append(best)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            overlap = overlap_fn(best, alive)
+        alive = alive[~(overlap > iou_threshold)]
+    return np.array(keep, dtype=np.int64)
+
+def _soft_nms(coords, scores, sigma):
+    """
+    :param coords: Nx4 class-offset boxes
+    :param scores: N initial scores
+    :return: indices of the kept boxes in selection order and their decayed scores
+    """
+    iou_fn = _iou_one_to_many(coords)
+    scores = np.array(scores, dtype=np.float64)
+    alive = np.arange(len(coords))
+    keep, kept_scores = [], []
+    while len(alive) > 0:
+        i = np.argmax(scores[alive])
+        best, alive = alive[i], np.delete(alive, i)
+        keep.append(best)
+        kept_scores.append(scores[best])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            iou = iou_fn(best, alive)
+        scores[alive] *= np.exp(-(1.0 * iou ** 2 / sigma))
+        alive = alive[scores[alive] > 0.]
+    return np.array(keep, dtype=np.int64), np.array(kept_scores)
+
+def _iou_one_to_many(coords):
+    """
+    Same values as bboxes_iou, with the box areas and coordinate columns computed only once.
+    :return: function (best, rest) -> IoU between box best and every box in rest
+    """
+    x1, y1, x2, y2 = [np.ascontiguousarray(c) for c in coords.T]
+    areas = (x2 - x1) * (y2 - y1)
+    eps = np.finfo(np.float32).eps
 
-    return best_bboxes
+    def iou_fn(best, rest):
+        inter_w = np.maximum(np.minimum(x2[rest], x2[best]) - np.maximum(x1[rest], x1[best]), 0.0)
+        inter_h = np.maximum(np.minimum(y2[rest], y2[best]) - np.maximum(y1[rest], y1[best]), 0.0)
+        inter_area = inter_w * inter_h
+        return np.maximum(1.0 * inter_area / (areas[rest] + areas[best] - inter_area), eps)
+    return iou_fn
@@ -0,0 +1,56 @@
+try:
+    import pyds
+except ImportError:
+    # parsers also run offline, without DeepStream (see parser_benchmark)
+    pyds = None
+
+class OsdStyle:
+    """
+    How the On Screen Display draws the objects added by a parser: border, background and text
+    parameters, set once and written to the metadata of every object only when the OSD is enabled.
+    Colors are (red, green, blue, alpha) tuples in [0, 1].
+    """
+    def __init__(self, border_width: int = 3, border_color=(1.0, 0.0, 0.0, 1.0), bg_color=None,
+                 font_name: str = "Serif", font_size: int = 10, font_color=(1.0, 1.0, 1.0, 1.0),
+                 text_bg_color=(0.0, 0.0, 0.0, 1.0)) -> None:
+        self.border_width = border_width
+        self.border_color = tuple(border_color)
+        self.has_bg_color = 0 if bg_color is None else 1
+        self.bg_color = None if bg_color is None else tuple(bg_color)
+        self.font_name = font_name
+        self.font_size = font_size
+        self.font_color = tuple(font_color)
+        self.set_bg_clr = 0 if text_bg_color is None else 1
+        self.text_bg_color = None if text_bg_color is None else tuple(text_bg_color)
+
+    def apply(self, obj_meta, display_text: str):
+        """ Writes the style and display_text to obj_meta, whose rect_params must already be set """
+        rect_params = obj_meta.rect_params
+        rect_params.has_bg_color = self.has_bg_color
+        if self.has_bg_color:
+            rect_params.bg_color.set(*self.bg_color)
+        rect_params.border_width = self.border_width
+        rect_params.border_color.set(*self.border_color)
+
+        # Set display text for the object.
+        txt_params = obj_meta.text_params
+        if txt_params.display_text:
+            pyds.free_buffer(txt_params.display_text)
+
+        txt_params.x_offset = int(rect_params.left)
+        txt_params.y_offset = max(0, int(rect_params.top) - 10)
+        txt_params.display_text = display_text
+
+        txt_params.font_params.font_name = self.font_name
+        txt_params.font_params.font_size = self.font_size
+        txt_params.font_params.font_color.set(*self.font_color)
+
+        txt_params.set_bg_clr = self.set_bg_clr
+        if self.set_bg_clr:
+            txt_params.text_bg_clr.set(*self.text_bg_color)
+
+# Red border, white text on black background
+DEFAULT_OSD_STYLE = OsdStyle()
+
+if '__main__' == __name__:
+    pass
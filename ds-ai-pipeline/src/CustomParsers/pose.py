@@ -6,6 +6,8 @@ import yaml
 from yaml.loader import SafeLoader
 from os.path import abspath, dirname, join
 
+from .kernels import get_kernel
+
 CURR_DIR=dirname(abspath(__file__))
 config = yaml.load(stream=open(join(CURR_DIR, './sample_bodypose2d_model_config.yml')), Loader=SafeLoader)
 jointEdges = config['jointEdges']
@@ -76,6 +78,67 @@ def compute_resized_coords(coords, resizeFactor):
     return (np.array(coords, dtype=float) + 0.5) * resizeFactor - 0.5
 
 
+def find_all_peaks(param, heatmaps):
+    """
+    Same as find_peaks, for all the joint channels of heatmaps in a single filter pass
+    :param heatmaps: 3d np.array, image_height x image_width x num_heatmaps
+    :return: 1d np.arrays joint, x and y with the joint type and the [x,y] coordinates of each
+    peak found, sorted by joint type and, inside every joint type, as find_peaks sorts them
+    """
+    kernel = get_kernel("find_peaks", heatmaps.dtype)
+    if kernel is not None:
+        return kernel(heatmaps, heatmaps.dtype.type(param['thre1']))
+
+    # The footprint only spans the two image axes, so every channel is filtered independently
+    footprint = generate_binary_structure(2, 1)[:, :, np.newaxis]
+    peaks_binary = (maximum_filter(heatmaps, footprint=footprint) == heatmaps) & (heatmaps > param['thre1'])
+    y, x, joint = np.nonzero(peaks_binary)
+    order = np.argsort(joint, kind='stable')
+    return joint[order], x[order], y[order]
+
+
+# (patch size, upsampling factor, gaussian filtering) -> interpolation kernel
+_refine_kernels = {}
+
+def _get_refine_kernel(size, upsamp_factor, gaussian_filt):
+    """
+    zoom (and gaussian_filter) are linear and separable: upsampling a h x w patch is
+    kernel(h) @ patch @ kernel(w).T, with kernel(n) the result of applying them to the
+    n unit vectors of length n.
+    :return: round(size*upsamp_factor) x size np.array
+    """
+    key = (size, upsamp_factor, gaussian_filt)
+    kernel = _refine_kernels.get(key)
+    if kernel is None:
+        kernel = np.stack([zoom(unit, upsamp_factor) for unit in np.eye(size)], axis=1)
+        if gaussian_filt:
+            kernel = np.stack([gaussian_filter(unit, sigma=3) for unit in np.eye(len(kernel))], axis=1) @ kernel
+        _refine_kernels[key] = kernel
+    return kernel
+
+
+# (window size, upsampling factor, gaussian filtering) -> kernels of every patch size
+_refine_tables = {}
+
+def _get_refine_tables(win_size, upsamp_factor, gaussian_filt):
+    """
+    The _get_refine_kernel of every patch size up to 2*win_size+1, zero-padded into a single
+    array for the refine_peaks JIT kernel.
+    :return: table and rows np.arrays: table[size][:rows[size], :size] is the kernel of that size
+    """
+    key = (win_size, upsamp_factor, gaussian_filt)
+    tables = _refine_tables.get(key)
+    if tables is None:
+        sizes = range(1, 2*win_size + 2)
+        kernels = [_get_refine_kernel(size, upsamp_factor, gaussian_filt) for size in sizes]
+        rows = np.array([0] + [len(kernel) for kernel in kernels])
+        table = np.zeros((len(rows), rows.max(), 2*win_size + 1))
+        for size, kernel in zip(sizes, kernels):
+            table[size, :len(kernel), :size] = kernel
+        tables = _refine_tables[key] = (table, rows)
+    return tables
+
+
 def NMS(param, heatmaps, upsampFactor=(1,1), bool_refine_center=False, bool_gaussian_filt=False):
     """
     NonMaximaSuppression: find peaks (local maxima) in a set of grayscale images
@@ -101,9 +164,11 @@ def NMS(param, heatmaps, upsampFactor=(1,1), bool_refine_center=False, bool_gaus
     # fine-tune the position of the actual maximum.
     #  '-> That's equivalent to having found the peak on heatmap_avg, but much faster because we only
     #      upsample and scan the 5x5 patch instead of the full (e.g.) 480x640
-
-    joint_list_per_joint_type = []
-    cnt_total_joints = 0
+    # All the joint channels are filtered in one pass, and all the patches of the same size
+    # are upsampled together with precomputed interpolation kernels.
+    heatmaps = heatmaps[:, :, :NUM_JOINTS]
+    joint, peak_x, peak_y = find_all_peaks(param, heatmaps)
+    peak_coords = np.stack([peak_x, peak_y], axis=1)
 
     # For every peak found, win_size specifies how many pixels in each
     # direction from the peak we take to obtain the patch that will be
@@ -111,48 +176,56 @@ def NMS(param, heatmaps, upsampFactor=(1,1), bool_refine_center=False, bool_gaus
     # (for BICUBIC interpolation to be accurate, win_size needs to be >=2!)
 
     win_size=2
-    for joint in range(NUM_JOINTS):
-        map_orig = heatmaps[:, :, joint]
-        peak_coords = find_peaks(param, map_orig)
-        peaks = np.zeros((len(peak_coords), 4))
-        for i, peak in enumerate(peak_coords):
-            if bool_refine_center:
-                x_min, y_min = np.maximum(0, peak - win_size)
-                x_max, y_max = np.minimum(
-                    np.array(map_orig.T.shape) - 1, peak + win_size)
-
-                # Take a small patch around each peak and only upsample that
-                # tiny region
-                patch = map_orig[y_min:y_max + 1, x_min:x_max + 1]
-                map_upsamp = zoom(patch, upsampFactor)
-
-                # Gaussian filtering takes an average of 0.8ms/peak (and there might be
-                # more than one peak per joint!) -> For now, skip it (it's
-                # accurate enough)
-                map_upsamp = gaussian_filter(
-                    map_upsamp, sigma=3) if bool_gaussian_filt else map_upsamp
-
-                # Obtain the coordinates of the maximum value in the patch
-                location_of_max = np.unravel_index(
-                    map_upsamp.argmax(), map_upsamp.shape)
+    refined_center = np.zeros((len(joint), 2))
+    if bool_refine_center:
+        x_min = np.maximum(0, peak_x - win_size)
+        y_min = np.maximum(0, peak_y - win_size)
+        x_max = np.minimum(heatmaps.shape[1] - 1, peak_x + win_size)
+        y_max = np.minimum(heatmaps.shape[0] - 1, peak_y + win_size)
+        patch_h = y_max - y_min + 1
+        patch_w = x_max - x_min + 1
+
+        refine = get_kernel("refine_peaks", heatmaps.dtype)
+        if refine is not None:
+            # Same upsampling, one peak at a time, without the intermediate arrays
+            table_h, rows_h = _get_refine_tables(win_size, upsampFactor[0], bool_gaussian_filt)
+            table_w, rows_w = _get_refine_tables(win_size, upsampFactor[1], bool_gaussian_filt)
+            max_row, max_col, peak_score = refine(heatmaps, joint, peak_x, peak_y, win_size,
+                                                  table_h, rows_h, table_w, rows_w)
+            location_of_patch_center = compute_resized_coords(
+                np.stack([peak_y - y_min, peak_x - x_min], axis=1), upsampFactor)
+            refined_center = np.stack([max_row, max_col], axis=1) - location_of_patch_center
+        else:
+            peak_score = np.zeros(len(joint))
+            # Peaks near the borders have smaller patches: every patch size is a batch
+            for h, w in set(zip(patch_h.tolist(), patch_w.tolist())):
+                batch = np.flatnonzero((patch_h == h) & (patch_w == w))
+                patch_rows = y_min[batch, np.newaxis, np.newaxis] + np.arange(h)[:, np.newaxis]
+                patch_cols = x_min[batch, np.newaxis, np.newaxis] + np.arange(w)
+                patches = heatmaps[patch_rows, patch_cols, joint[batch, np.newaxis, np.newaxis]]
+                kernel_h = _get_refine_kernel(h, upsampFactor[0], bool_gaussian_filt)
+                kernel_w = _get_refine_kernel(w, upsampFactor[1], bool_gaussian_filt)
+                map_upsamp = kernel_h @ patches @ kernel_w.T
+
+                # Obtain the coordinates of the maximum value in every patch
+                flat_max = map_upsamp.reshape(len(batch), -1).argmax(axis=1)
+                location_of_max = np.stack(np.unravel_index(flat_max, map_upsamp.shape[1:]), axis=1)
                 # Remember that peaks indicates [x,y] -> need to reverse it for
                 # [y,x]
                 location_of_patch_center = compute_resized_coords(
-                    peak[::-1] - [y_min, x_min], upsampFactor)
+                    np.stack([peak_y[batch] - y_min[batch], peak_x[batch] - x_min[batch]], axis=1), upsampFactor)
                 # Calculate the offset wrt to the patch center where the actual
                 # maximum is
-                refined_center = (location_of_max - location_of_patch_center)
-                peak_score = map_upsamp[location_of_max]
-            else:
-                refined_center = [0, 0]
-                # Flip peak coordinates since they are [x,y] instead of [y,x]
-                peak_score = map_orig[tuple(peak[::-1])]
-            peaks[i, :] = tuple([int(round(x)) for x in compute_resized_coords(
-                peak_coords[i], upsampFactor) + refined_center[::-1]]) + (peak_score, cnt_total_joints)
-            cnt_total_joints += 1
-        joint_list_per_joint_type.append(peaks)
-
-    return joint_list_per_joint_type
+                refined_center[batch] = location_of_max - location_of_patch_center
+                peak_score[batch] = map_upsamp.reshape(len(batch), -1)[np.arange(len(batch)), flat_max]
+    else:
+        peak_score = heatmaps[peak_y, peak_x, joint]
+
+    peaks = np.zeros((len(joint), 4))
+    peaks[:, :2] = np.round(compute_resized_coords(peak_coords, upsampFactor) + refined_center[:, ::-1])
+    peaks[:, 2] = peak_score
+    peaks[:, 3] = np.arange(len(joint))
+    return np.split(peaks, np.searchsorted(joint, np.arange(1, NUM_JOINTS)))
 
 def find_connected_joints(param, paf_upsamp, joint_list_per_joint_type, num_intermed_pts=10):
     """
@@ -172,94 +245,146 @@ def find_connected_joints(param, paf_upsamp, joint_list_per_joint_type, num_inte
     # {joint_src_index,joint_dst_index}: the index of the joint within
     all the joints of that type found (eg: the 3rd right elbow found)
     """
-    connected_limbs = []
+    # Gather every (joint_src, joint_dst) pair of every limb type, so the PAFs of
+    # all candidate limbs are evaluated in a single vectorized pass
+    pair_limb, pair_src, pair_dst = [], [], []
+    for limb_type in range(NUM_LIMBS):
+        num_src = len(joint_list_per_joint_type[joint_to_limb_heatmap_relationship[limb_type][0]])
+        num_dst = len(joint_list_per_joint_type[joint_to_limb_heatmap_relationship[limb_type][1]])
+        # Pairs are enumerated src-major, the order the candidates are ranked in
+        src_idx, dst_idx = np.divmod(np.arange(num_src * num_dst), num_dst)
+        pair_limb.append(np.full(len(src_idx), limb_type))
+        pair_src.append(src_idx)
+        pair_dst.append(dst_idx)
+    pair_limb = np.concatenate(pair_limb)
+    pair_src = np.concatenate(pair_src)
+    pair_dst = np.concatenate(pair_dst)
+
+    if len(pair_limb) > 0:
+        score_mid, valid = _score_limb_candidates(param, paf_upsamp, joint_list_per_joint_type,
+                                                  pair_limb, pair_src, pair_dst, num_intermed_pts)
+    limb_start = np.searchsorted(pair_limb, np.arange(NUM_LIMBS + 1))
 
-    # Auxiliary array to access paf_upsamp quickly
-    limb_intermed_coords = np.empty((4, num_intermed_pts), dtype=np.intp)
+    connected_limbs = []
     for limb_type in range(NUM_LIMBS):
-        # List of all joints of type A found, where A is specified by limb_type
-        # (eg: a right forearm starts in a right elbow)
         joints_src = joint_list_per_joint_type[joint_to_limb_heatmap_relationship[limb_type][0]]
-        # List of all joints of type B found, where B is specified by limb_type
-        # (eg: a right forearm ends in a right wrist)
         joints_dst = joint_list_per_joint_type[joint_to_limb_heatmap_relationship[limb_type][1]]
         if len(joints_src) == 0 or len(joints_dst) == 0:
             # No limbs of this type found (eg: no right forearms found because
             # we didn't find any right wrists or right elbows)
             connected_limbs.append([])
-        else:
-            connection_candidates = []
-            # Specify the paf index that contains the x-coord of the paf for
-            # this limb
-            limb_intermed_coords[2, :] = 2*limb_type
-            # And the y-coord paf index
-            limb_intermed_coords[3, :] = 2*limb_type + 1
-            for i, joint_src in enumerate(joints_src):
-                # Try every possible joints_src[i]-joints_dst[j] pair and see
-                # if it's a feasible limb
-                for j, joint_dst in enumerate(joints_dst):
-                    # Subtract the position of both joints to obtain the
-                    # direction of the potential limb
-                    limb_dir = joint_dst[:2] - joint_src[:2]
-                    # Compute the distance/length of the potential limb (norm
-                    # of limb_dir)
-                    limb_dist = np.sqrt(np.sum(limb_dir ** 2)) + 1e-8
-                    limb_dir = limb_dir / limb_dist  # Normalize limb_dir to be a unit vector
-
-                    # Linearly distribute num_intermed_pts points from the x
-                    # coordinate of joint_src to the x coordinate of joint_dst
-                    limb_intermed_coords[1, :] = np.round(np.linspace(
-                        joint_src[0], joint_dst[0], num=num_intermed_pts))
-                    limb_intermed_coords[0, :] = np.round(np.linspace(
-                        joint_src[1], joint_dst[1], num=num_intermed_pts))  # Same for the y coordinate
-                    intermed_paf = paf_upsamp[limb_intermed_coords[0, :],
-                                              limb_intermed_coords[1, :], limb_intermed_coords[2:4, :]].T
-
-                    score_intermed_pts = intermed_paf.dot(limb_dir)
-                    score_penalizing_long_dist = score_intermed_pts.mean(
-                    ) + min(0.5 * paf_upsamp.shape[0] / limb_dist - 1, 0)
-                    # Criterion 1: At least 80% of the intermediate points have
-                    # a score higher than thre2
-                    criterion1 = (np.count_nonzero(
-                        score_intermed_pts > param['thre2']) > 0.8 * num_intermed_pts)
-                    # Criterion 2: Mean score, penalized for large limb
-                    # distances (larger than half the image height), is
-                    # positive
-                    criterion2 = (score_penalizing_long_dist > 0)
-                    if criterion1 and criterion2:
-                        # Last value is the combined paf(+limb_dist) + heatmap
-                        # scores of both joints
-                        connection_candidates.append(
-                            [i, j, score_penalizing_long_dist,
-                             score_penalizing_long_dist + joint_src[2] + joint_dst[2]])
-
-            # Sort connection candidates based on their
-            # score_penalizing_long_dist
-            connection_candidates = sorted(
-                connection_candidates, key=lambda x: x[2], reverse=True)
-            connections = np.empty((0, 5))
-            # There can only be as many limbs as the smallest number of source
-            # or destination joints (eg: only 2 forearms if there's 5 wrists
-            # but 2 elbows)
-            max_connections = min(len(joints_src), len(joints_dst))
-            # Traverse all potential joint connections (sorted by their score)
-            for potential_connection in connection_candidates:
-                i, j, s = potential_connection[0:3]
-                # Make sure joints_src[i] or joints_dst[j] haven't already been
-                # connected to other joints_dst or joints_src
-                if i not in connections[:, 3] and j not in connections[:, 4]:
-                    # [joint_src_id, joint_dst_id, limb_score_penalizing_long_dist, joint_src_index, joint_dst_index]
-                    connections = np.vstack(
-                        [connections, [joints_src[i][3], joints_dst[j][3], s, i, j]])
-                    # Exit if we've already established max_connections
-                    # connections (each joint can't be connected to more than
-                    # one joint)
-                    if len(connections) >= max_connections:
-                        break
-            connected_limbs.append(connections)
+            continue
+
+        limb_pairs = slice(limb_start[limb_type], limb_start[limb_type + 1])
+        candidates = np.flatnonzero(valid[limb_pairs])
+        # Sort connection candidates based on their score_penalizing_long_dist
+        # (stable, so ties keep the src-major order)
+        candidates = candidates[np.argsort(-score_mid[limb_pairs][candidates], kind='stable')]
+        cand_src = pair_src[limb_pairs][candidates]
+        cand_dst = pair_dst[limb_pairs][candidates]
+        cand_score = score_mid[limb_pairs][candidates]
+
+        # There can only be as many limbs as the smallest number of source
+        # or destination joints (eg: only 2 forearms if there's 5 wrists
+        # but 2 elbows)
+        max_connections = min(len(joints_src), len(joints_dst))
+        src_used = np.zeros(len(joints_src), dtype=bool)
+        dst_used = np.zeros(len(joints_dst), dtype=bool)
+        selected = []
+        # Traverse all potential joint connections (sorted by their score) and keep
+        # those whose joints haven't already been connected to other joints
+        for k, (i, j) in enumerate(zip(cand_src.tolist(), cand_dst.tolist())):
+            if not src_used[i] and not dst_used[j]:
+                src_used[i] = dst_used[j] = True
+                selected.append(k)
+                if len(selected) >= max_connections:
+                    break
+
+        # [joint_src_id, joint_dst_id, limb_score_penalizing_long_dist, joint_src_index, joint_dst_index]
+        connections = np.empty((len(selected), 5))
+        connections[:, 0] = joints_src[cand_src[selected], 3]
+        connections[:, 1] = joints_dst[cand_dst[selected], 3]
+        connections[:, 2] = cand_score[selected]
+        connections[:, 3] = cand_src[selected]
+        connections[:, 4] = cand_dst[selected]
+        connected_limbs.append(connections)
 
     return connected_limbs
 
+# margin of the probe scores of _score_limb_candidates, far above their rounding differences
+PROBE_MARGIN = 1e-6
+
+def _score_limb_candidates(param, paf_upsamp, joint_list_per_joint_type, pair_limb, pair_src, pair_dst, num_intermed_pts):
+    """
+    Evaluates the PAFs along every candidate limb (one row per joint pair).
+    :return: score_penalizing_long_dist of every pair, and whether the pair is a feasible limb
+    """
+    # Position and score of the src and dst joint of every pair
+    joints = [np.asarray(j, dtype=float).reshape(-1, 4) for j in joint_list_per_joint_type]
+    offsets = np.cumsum([0] + [len(j) for j in joints])
+    all_joints = np.concatenate(joints)
+    limb_joint_types = np.array(joint_to_limb_heatmap_relationship)
+    joint_src = all_joints[offsets[limb_joint_types[pair_limb, 0]] + pair_src]
+    joint_dst = all_joints[offsets[limb_joint_types[pair_limb, 1]] + pair_dst]
+
+    # Direction and length of every potential limb
+    limb_dir = joint_dst[:, :2] - joint_src[:, :2]
+    limb_dist = np.sqrt(np.sum(limb_dir ** 2, axis=1)) + 1e-8
+    limb_dir = limb_dir / limb_dist[:, np.newaxis]
+
+    long_dist_penalty = np.minimum(0.5 * paf_upsamp.shape[0] / limb_dist - 1, 0)
+    paf_flat = paf_upsamp.reshape(-1)
+
+    # Criterion 1 below tolerates only a few intermediate points under thre2 (max_misses), so most
+    # pairs of joints of different people can be discarded before computing their scores
+    min_pts_over = int(np.floor(0.8 * num_intermed_pts)) + 1
+    max_misses = num_intermed_pts - min_pts_over
+    kernel = get_kernel("feasible_limbs", paf_flat.dtype)
+    if kernel is not None:
+        # the kernel looks at the points of every pair until it is discarded
+        feasible = kernel(paf_flat, paf_upsamp.shape, joint_src, joint_dst, pair_limb, limb_dir, long_dist_penalty,
+                          num_intermed_pts, min_pts_over, float(param['thre2']))
+    else:
+        # a limb cannot be under thre2 at max_misses + 1 points, look at that many points of every pair
+        # (the projection is not rounded as the final scores are, hence the margin)
+        probe_pts = np.linspace(0, num_intermed_pts - 1, max_misses + 3)[1:-1].round().astype(np.intp)
+        probe_index = _intermed_paf_index(paf_upsamp.shape, joint_src, joint_dst, pair_limb, probe_pts, num_intermed_pts)
+        probe_score = paf_flat[probe_index] * limb_dir[:, 0:1] + paf_flat[probe_index + 1] * limb_dir[:, 1:2]
+        feasible = np.flatnonzero((probe_score > param['thre2'] - PROBE_MARGIN).any(axis=1))
+    paf_index = _intermed_paf_index(paf_upsamp.shape, joint_src[feasible], joint_dst[feasible], pair_limb[feasible],
+                                    np.arange(num_intermed_pts), num_intermed_pts)
+
+    # The dot product of every feasible pair, on float64 copies laid out channel-major like the
+    # per-limb dot product, so it rounds exactly the same way
+    intermed_paf = paf_flat[paf_index[:, np.newaxis, :] + np.arange(2)[:, np.newaxis]]
+    intermed_paf = intermed_paf.astype(np.float64).swapaxes(1, 2)
+    score_intermed_pts = np.ascontiguousarray(
+        np.matmul(intermed_paf, limb_dir[feasible, :, np.newaxis])[..., 0])
+
+    score_penalizing_long_dist = np.zeros(len(pair_limb))
+    score_penalizing_long_dist[feasible] = score_intermed_pts.mean(axis=1) + long_dist_penalty[feasible]
+    valid = np.zeros(len(pair_limb), dtype=bool)
+    # Criterion 1: At least 80% of the intermediate points have
+    # a score higher than thre2
+    criterion1 = np.count_nonzero(score_intermed_pts > param['thre2'], axis=1) > 0.8 * num_intermed_pts
+    # Criterion 2: Mean score, penalized for large limb
+    # distances (larger than half the image height), is positive
+    criterion2 = score_penalizing_long_dist[feasible] > 0
+    valid[feasible] = criterion1 & criterion2
+    return score_penalizing_long_dist, valid
+
+def _intermed_paf_index(paf_shape, joint_src, joint_dst, limb_types, pts, num_intermed_pts):
+    """
+    :return: index in the flattened PAFs of the x channel of every limb at its intermediate
+    points pts (out of num_intermed_pts, linearly distributed from joint_src to joint_dst with
+    the same values np.linspace gives, including the exact end point). The y channel is next.
+    """
+    step_size = (joint_dst[:, :2] - joint_src[:, :2]) / (num_intermed_pts - 1)
+    intermed = pts[np.newaxis, :, np.newaxis] * step_size[:, np.newaxis, :] + joint_src[:, np.newaxis, :2]
+    intermed[:, pts == num_intermed_pts - 1, :] = joint_dst[:, np.newaxis, :2]
+    intermed = np.round(intermed).astype(np.intp)
+    return (intermed[..., 1] * paf_shape[1] + intermed[..., 0]) * paf_shape[2] + 2 * limb_types[:, np.newaxis]
+
 def group_limbs_of_same_person(connected_limbs, joint_list):
     """
     Associate limbs belonging to the same person together.
@@ -271,80 +396,92 @@ def group_limbs_of_same_person(connected_limbs, joint_list):
     # 2nd-to-last column: Overall score of the joints+limbs that belong to this person
     # Last column: Total count of joints found for this person
     """
-    person_to_joint_assoc = []
+    # The limbs are grouped one at a time, by limb type and score: whether a limb starts a person,
+    # extends one or merges two depends on the limbs grouped before it, so this greedy pass stays a
+    # loop (the candidate scoring of find_connected_joints is the vectorized part).
+    # People are kept in creation order (a dict keyed by a creation counter, so removing a
+    # person keeps the order of the others), and joint_owners maps every joint id to the
+    # people that have it: finding the people that claimed the joints of a limb is a lookup
+    # instead of a scan over all the people found so far
+    person_to_joint_assoc = {}
+    joint_owners = {}
+    person_counter = 0
+    scores = joint_list[:, 2].tolist() if len(joint_list) else []
+
+    def set_joint(person, person_limbs, joint_type, joint_id):
+        old_id = person_limbs[joint_type]
+        if old_id >= 0:
+            joint_owners[old_id].discard(person)
+        person_limbs[joint_type] = joint_id
+        joint_owners.setdefault(joint_id, set()).add(person)
 
     for limb_type in range(NUM_LIMBS):
         joint_src_type, joint_dst_type = joint_to_limb_heatmap_relationship[limb_type]
 
-        for limb_info in connected_limbs[limb_type]:
-            person_assoc_idx = []
-            for person, person_limbs in enumerate(person_to_joint_assoc):
-                if person_limbs[joint_src_type] == limb_info[0] or person_limbs[joint_dst_type] == limb_info[1]:
-                    person_assoc_idx.append(person)
+        for joint_src_id, joint_dst_id, limb_score in (limb[:3] for limb in np.asarray(connected_limbs[limb_type]).tolist()):
+            person_assoc_idx = sorted(joint_owners.get(joint_src_id, set()) | joint_owners.get(joint_dst_id, set()))
 
             # If one of the joints has been associated to a person, and either
             # the other joint is also associated with the same person or not
             # associated to anyone yet:
             if len(person_assoc_idx) == 1:
-                person_limbs = person_to_joint_assoc[person_assoc_idx[0]]
+                person = person_assoc_idx[0]
+                person_limbs = person_to_joint_assoc[person]
                 # If the other joint is not associated to anyone yet,
-                if person_limbs[joint_dst_type] != limb_info[1]:
+                if person_limbs[joint_dst_type] != joint_dst_id:
                     # Associate it with the current person
-                    person_limbs[joint_dst_type] = limb_info[1]
+                    set_joint(person, person_limbs, joint_dst_type, joint_dst_id)
                     # Increase the number of limbs associated to this person
                     person_limbs[-1] += 1
                     # And update the total score (+= heatmap score of joint_dst
                     # + score of connecting joint_src with joint_dst)
-                    person_limbs[-2] += joint_list[limb_info[1]
-                                                       .astype(int), 2] + limb_info[2]
+                    person_limbs[-2] += scores[int(joint_dst_id)] + limb_score
             elif len(person_assoc_idx) == 2:  # if found 2 and disjoint, merge them
-                person1_limbs = person_to_joint_assoc[person_assoc_idx[0]]
-                person2_limbs = person_to_joint_assoc[person_assoc_idx[1]]
-                membership = ((person1_limbs >= 0) & (person2_limbs >= 0))[:-2]
-                if not membership.any():  # If both people have no same joints connected, merge them into a single person
+                person1, person2 = person_assoc_idx
+                person1_limbs = person_to_joint_assoc[person1]
+                person2_limbs = person_to_joint_assoc[person2]
+                membership = any(a >= 0 and b >= 0 for a, b in zip(person1_limbs[:-2], person2_limbs[:-2]))
+                if not membership:  # If both people have no same joints connected, merge them into a single person
                     # Update which joints are connected
-                    person1_limbs[:-2] += (person2_limbs[:-2] + 1)
+                    for joint_type, joint_id in enumerate(person2_limbs[:-2]):
+                        if joint_id >= 0:
+                            joint_owners[joint_id].discard(person2)
+                            set_joint(person1, person1_limbs, joint_type, joint_id)
                     # Update the overall score and total count of joints
                     # connected by summing their counters
-                    person1_limbs[-2:] += person2_limbs[-2:]
+                    person1_limbs[-2] += person2_limbs[-2]
+                    person1_limbs[-1] += person2_limbs[-1]
                     # Add the score of the current joint connection to the
                     # overall score
-                    person1_limbs[-2] += limb_info[2]
-                    person_to_joint_assoc.pop(person_assoc_idx[1])
+                    person1_limbs[-2] += limb_score
+                    del person_to_joint_assoc[person2]
                 else:  # Same case as len(person_assoc_idx)==1 above
-                    person1_limbs[joint_dst_type] = limb_info[1]
+                    set_joint(person1, person1_limbs, joint_dst_type, joint_dst_id)
                     person1_limbs[-1] += 1
-                    person1_limbs[-2] += joint_list[limb_info[1]
-                                                        .astype(int), 2] + limb_info[2]
+                    person1_limbs[-2] += scores[int(joint_dst_id)] + limb_score
             else:  # No person has claimed any of these joints, create a new person
                 # Initialize person info to all -1 (no joint associations)
-                row = -1 * np.ones(NUM_JOINTS+2)
+                row = [-1.0] * (NUM_JOINTS+2)
+                person_to_joint_assoc[person_counter] = row
                 # Store the joint info of the new connection
-                row[joint_src_type] = limb_info[0]
-                row[joint_dst_type] = limb_info[1]
+                set_joint(person_counter, row, joint_src_type, joint_src_id)
+                set_joint(person_counter, row, joint_dst_type, joint_dst_id)
                 # Total count of connected joints for this person: 2
-                row[-1] = 2
+                row[-1] = 2.0
                 # Compute overall score: score joint_src + score joint_dst + score connection
                 # {joint_src,joint_dst}
-                row[-2] = sum(joint_list[limb_info[:2].astype(int), 2]
-                              ) + limb_info[2]
-                person_to_joint_assoc.append(row)
+                row[-2] = scores[int(joint_src_id)] + scores[int(joint_dst_id)] + limb_score
+                person_counter += 1
 
     # Delete people who have very few parts connected
-    people_to_delete = []
-    for person_id, person_info in enumerate(person_to_joint_assoc):
-        if person_info[-1] < 3 or person_info[-2] / person_info[-1] < 0.2:
-            people_to_delete.append(person_id)
-    # Traverse the list in reverse order so we delete indices starting from the
-    # last one (otherwise, removing item for example 0 would modify the indices of
-    # the remaining people to be deleted!)
-    for index in people_to_delete[::-1]:
-        person_to_joint_assoc.pop(index)
-
-    # Appending items to a np.array can be very costly (allocating new memory, copying over the array, then adding new row)
-    # Instead, we treat the set of people as a list (fast to append items) and
-    # only convert to np.array at the end
-    return np.array(person_to_joint_assoc)
+    people = np.array(list(person_to_joint_assoc.values()))
+    if len(people) == 0:
+        return people
+    few_parts = (people[:, -1] < 3) | (people[:, -2] / people[:, -1] < 0.2)
+    people = people[~few_parts]
+    if len(people) == 0:
+        return np.array([])
+    return people
 
 def pose_plot(display_meta, joint_list, person_to_joint_assoc, limb_thickness = 4, outsize=(1280, 720)):
     j = 0
@@ -381,6 +518,11 @@ param['thre2'] = 0.05 #config['threshVectorScore']
 #param['win_size'] = 2 #config['nmsWindowSize']
 
 def pose_decode(heatmaps, pafs, param=param, refine_center=False, gaussian_filt=False):
+    # scipy.ndimage has no float16 filters: half precision outputs are decoded in float32
+    if heatmaps.dtype == np.float16:
+        heatmaps = heatmaps.astype(np.float32)
+    if pafs.dtype == np.float16:
+        pafs = pafs.astype(np.float32)
     upsampFactor = (pafs.shape[0]/heatmaps.shape[0], pafs.shape[1]/heatmaps.shape[1])
     joint_list_per_joint_type = NMS(param, heatmaps, upsampFactor, 
                                     bool_refine_center = refine_center, 
@@ -443,4 +585,4 @@ def get_bboxes_and_lines(joint_list, person_to_joint_assoc, outsize=(1280, 720))
     return dets            
 
 if '__main__' == __name__:
-    pass 
\ No newline at end of file
+    pass
@@ -0,0 +1,141 @@
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+
+try:
+    from importlib.metadata import entry_points
+except ImportError:
+    entry_points = None
+
+# Python entry point group under which installed packages can register parsers, e.g. in setup.cfg:
+#   [options.entry_points]
+#   azda.parsers =
+#       my_model = my_package.my_parser:MyParser
+ENTRY_POINT_GROUP = "azda.parsers"
+
+# Environment variable with the path of an optional JSON parser manifest
+MANIFEST_ENV_VAR = "AI_PIPELINE_PARSER_MANIFEST"
+
+class ParserEntry:
+    """ A registered parser: 'module:ClassName' target, imported the first time the parser is created """
+    def __init__(self, name: str, target: str, source: str, path: str = None) -> None:
+        self.name = name
+        self.target = target
+        self.source = source
+        self.path = path
+        self.parser_class = None
+        self.import_time_ms = None
+        self.new_modules = None
+
+class ParserRegistry:
+    """
+    Parsers by name. Parsers are registered with the 'module:ClassName' of their class
+    and the module is only imported the first time a parser with that name is created,
+    so pipelines only carry the modules (scipy, yaml, ...) of the parsers they use.
+
+    Besides the built-in parsers, parsers can be registered through the ENTRY_POINT_GROUP
+    entry points of the installed packages, or through a JSON manifest:
+        {
+            "parsers": [
+                {"name": "my_model", "target": "my_parser:MyParser", "path": "/dir/with/my_parser", "aliases": []}
+            ]
+        }
+    """
+    def __init__(self) -> None:
+        self.entries = {}
+        self.aliases = {}
+        self.plugins_loaded = False
+
+    def register(self, name: str, target: str, aliases=(), source: str = "builtin", path: str = None):
+        if name in self.entries:
+            logging.warning(f"Parser '{name}' from {source} replaces the one from {self.entries[name].source}")
+        self.entries[name] = ParserEntry(name=name, target=target, source=source, path=path)
+        for alias in aliases:
+            self.aliases[alias] = name
+
+    def load_entry_points(self, group: str = ENTRY_POINT_GROUP):
+        if entry_points is None:
+            return
+        eps = entry_points()
+        # Python < 3.10 returns a dict of groups
+        eps = eps.select(group=group) if hasattr(eps, "select") else eps.get(group, [])
+        for ep in eps:
+            self.register(ep.name, ep.value, source=f"entry point {ep.value}")
+
+    def load_manifest(self, manifest_path: str):
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            for p in manifest["parsers"]:
+                path = p.get("path")
+                if path is not None and not os.path.isabs(path):
+                    path = os.path.join(os.path.dirname(manifest_path), path)
+                self.register(p["name"], p["target"], aliases=p.get("aliases", []),
+                              source=f"manifest {manifest_path}", path=path)
+        except Exception as e:
+            logging.error(f"Error loading parser manifest {manifest_path}: {e}")
+
+    def load_plugins(self):
+        """ Registers the parsers of the entry points and of the manifest, once """
+        if self.plugins_loaded:
+            return
+        self.plugins_loaded = True
+        try:
+            self.load_entry_points()
+        except Exception as e:
+            logging.error(f"Error loading parser entry points: {e}")
+        if MANIFEST_ENV_VAR in os.environ:
+            self.load_manifest(os.environ[MANIFEST_ENV_VAR])
+
+    def get_entry(self, name: str):
+        self.load_plugins()
+        return self.entries.get(self.aliases.get(name, name))
+
+    def get_parser_class(self, name: str):
+        entry = self.get_entry(name)
+        if entry is None:
+            return None
+        if entry.parser_class is None:
+            module_name, class_name = entry.target.split(":")
+            if entry.path is not None and entry.path not in sys.path:
+                sys.path.append(entry.path)
+            modules_before = len(sys.modules)
+            start = time.perf_counter()
+            module = importlib.import_module(module_name, package=__package__)
+            entry.import_time_ms = (time.perf_counter() - start) * 1000
+            entry.new_modules = len(sys.modules) - modules_before
+            entry.parser_class = getattr(module, class_name)
+            logging.info(f"Parser '{entry.name}' imported from {entry.target} in {entry.import_time_ms:.1f} ms ({entry.new_modules} new modules)")
+        return entry.parser_class
+
+    def create(self, name: str):
+        try:
+            parser_class = self.get_parser_class(name)
+        except Exception as e:
+            logging.error(f"Error importing parser '{name}': {e}")
+            return None
+        if parser_class is None:
+            return None
+        return parser_class()
+
+    def names(self):
+        self.load_plugins()
+        return list(self.entries)
+
+    def import_metrics(self):
+        """ Import time and number of modules pulled in by every parser imported so far """
+        return {e.name: {"importTimeMs": e.import_time_ms, "newModules": e.new_modules}
+                for e in self.entries.values() if e.parser_class is not None}
+
+parser_registry = ParserRegistry()
+parser_registry.register("yolov4", ".yolov4_parser:Yolov4Parser")
+parser_registry.register("tiny-yolov3", ".yolov3_parser:Yolov3Parser", aliases=("tiny_yolov3",))
+parser_registry.register("ssd_mobilenet_v1", ".ssd_mobilenet_v1:SSDMobilenetV1")
+parser_registry.register("bodypose2d", ".body_pose_parser:BodyPoseParser2D")
+parser_registry.register("classification", ".classification_parser:ClassificationParser")
+
+if '__main__' == __name__:
+    pass
@@ -0,0 +1,84 @@
+import time
+from collections import OrderedDict
+
+# returned by SgieResultCache.get for the objects without a valid result
+MISSING = object()
+
+class SgieResultCache:
+    """
+    Results of the secondary model parsers, keyed by (sgie unique id, tracking id): a tracked
+    object is parsed when it first shows up and its result is reused on the next frames, so the
+    parsing cost follows the number of new objects instead of the number of objects per frame.
+
+    A result is parsed again after ttl seconds, or after being reused refresh_frames times
+    (0: only the ttl applies). At most max_entries results are kept, the least recently used
+    ones are evicted first.
+    """
+    def __init__(self, ttl: float = 5.0, max_entries: int = 4096, refresh_frames: int = 0) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.refresh_frames = refresh_frames
+        # {(sgie id, tracking id): [result, expiration time, uses]}, least recently used first
+        self.entries = OrderedDict()
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.refreshed = 0
+        self.evicted = 0
+
+    def get(self, key):
+        """ :return: the cached result of key, MISSING if it must be parsed """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        if time.monotonic() >= entry[1]:
+            self.expired += 1
+        elif self.refresh_frames and entry[2] >= self.refresh_frames:
+            self.refreshed += 1
+        else:
+            entry[2] += 1
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        del self.entries[key]
+        self.misses += 1
+        return MISSING
+
+    def put(self, key, result):
+        self.entries[key] = [result, time.monotonic() + self.ttl, 0]
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+
+    def invalidate(self, sgie_id=None):
+        """ Drops the results of one sgie (e.g. when its parser is replaced), or all of them """
+        if sgie_id is None:
+            self.entries.clear()
+            return
+        for key in list(self.entries):
+            if key[0] == sgie_id:
+                self.entries.pop(key, None)
+
+    def snapshot(self, reset: bool = False):
+        """ :return: lookup counters since the last reset, and the number of cached results """
+        lookups = self.hits + self.misses
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+            "expired": self.expired,
+            "refreshed": self.refreshed,
+            "evicted": self.evicted,
+            "entries": len(self.entries),
+        }
+        if reset:
+            self.reset_counters()
+        return stats
+
+if '__main__' == __name__:
+    pass
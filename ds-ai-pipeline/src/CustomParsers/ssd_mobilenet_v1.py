@@ -1,16 +1,17 @@
 import numpy as np
-from .base_custom_parser import BoundingBox, BaseCustomParser
+from .base_custom_parser import BaseCustomParser
+from .detections import DetectionBatch
 from .common import get_labels
 import logging
 from .nms import nms
+from .kernels import warm_up
 
-def bbox2det(bbox, w: int, h: int):
-    return BoundingBox(score=bbox[4], 
-                       class_id=int(bbox[5]), 
-                       x = int(w*bbox[1]), 
-                       y = int(h*bbox[0]), 
-                       w = int((bbox[3]-bbox[1])*w), 
-                       h = int((bbox[2]-bbox[0])*h) )
+def bbox2dets(bboxes, w: int, h: int):
+    """ (ymin, xmin, ymax, xmax, score, class) boxes in [0, 1] -> DetectionBatch in image pixels """
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 6)
+    boxes = np.stack([w*bboxes[:, 1], h*bboxes[:, 0],
+                      (bboxes[:, 3]-bboxes[:, 1])*w, (bboxes[:, 2]-bboxes[:, 0])*h], axis=1)
+    return DetectionBatch.from_arrays(boxes.astype(np.int64), bboxes[:, 4], bboxes[:, 5].astype(np.int64))
 
 class SSDMobilenetV1(BaseCustomParser):
     def __init__(self) -> None:
@@ -20,6 +21,12 @@ class SSDMobilenetV1(BaseCustomParser):
         self.labels = get_labels("coco90", background_label="unlabeled")
         self.det_th = 0.5        
         self.mns_th = 0.213
+        # compiles the JIT NMS kernel (if numba is installed) before the first frame
+        warm_up("greedy_nms")
+
+    def default_class_threshold(self):
+        # the model outputs are kept whatever their score, only the classes filtered get a threshold
+        return 0.0
 
     def parse_det_model(self, raw_outputs: dict):       
         try:
@@ -29,18 +36,22 @@ class SSDMobilenetV1(BaseCustomParser):
             box_layer = raw_outputs["detection_boxes:0"]
         except:
             logging.error("SSDMobilenetV1. Error: some layers missing in output tensors")
-            return []
+            return DetectionBatch(), None
    
         num_detection = int(num_detection_layer[0])
         scores = score_layer[:num_detection, None]
         classes = class_layer[:num_detection, None].astype('int')
         boxes = box_layer[:num_detection, :].clip(0, 1)
+        if self.class_th is not None:
+            passed = scores[:, 0] >= self.get_class_thresholds(classes[:, 0])
+            scores, classes, boxes = scores[passed], classes[passed], boxes[passed]
 
         bboxes = np.concatenate((boxes, scores, classes), axis=1)
-        bboxes = nms(bboxes, self.mns_th, method='nms')
+        with self.timers.measure("nms"):
+            bboxes = nms(bboxes, self.mns_th, method='nms')
 
         w, h = self.image_size                       
-        return [bbox2det(b, w=w, h=h) for b in bboxes], None             
+        return bbox2dets(bboxes, w=w, h=h), None             
 
 if '__main__' == __name__:
     pass
@@ -0,0 +1,134 @@
+import time
+
+# stages of the parsing of a frame, in pipeline order:
+#   fetch:   numpy views (or copies) of the output tensors
+#   decode:  the parser call, without the nested stages measured inside it (e.g. nms)
+#   nms:     non-maximum suppression, measured by the parsers that run it
+#   message: handoff of the custom message and detection extras to IotMSGHelper
+#   meta:    insertion of the results into the frame metadata
+STAGES = ("fetch", "decode", "nms", "message", "meta")
+
+# bucket 0 counts the times under 1 us, bucket i the times in [2^(i-1), 2^i) us, the last one
+# every time over 2^(NUM_BUCKETS-2) us (~4 s)
+NUM_BUCKETS = 24
+
+class _NestedTimer:
+    def __init__(self, timers, stage: str) -> None:
+        self.timers = timers
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        nested = self.timers.nested
+        nested[self.stage] = nested.get(self.stage, 0) + time.perf_counter_ns() - self.start
+        return False
+
+class StageTimers:
+    """
+    Per-stage time histograms of a parser, with log2 microsecond buckets: recording a time is a
+    couple of integer operations, cheap enough to stay on for every frame.
+
+    The probes time the stages with start()/lap(). Parsers can measure a part of their own work
+    as a nested stage, which lap() then records on its own and subtracts from the enclosing stage:
+        with self.timers.measure("nms"):
+            bboxes = nms(bboxes, self.mns_th)
+
+    snapshot() can be called from any thread of the pipeline process.
+    """
+    def __init__(self, num_buckets: int = NUM_BUCKETS) -> None:
+        self.num_buckets = num_buckets
+        self.nested = {}
+        self.reset()
+
+    def reset(self):
+        self.counts = {stage: [0] * self.num_buckets for stage in STAGES}
+        self.total_ns = dict.fromkeys(STAGES, 0)
+        self.max_ns = dict.fromkeys(STAGES, 0)
+
+    def record(self, stage: str, elapsed_ns: int):
+        counts = self.counts.get(stage)
+        if counts is None:
+            # a nested stage of a user parser
+            counts = self.counts[stage] = [0] * self.num_buckets
+            self.total_ns[stage] = self.max_ns[stage] = 0
+        counts[min((max(elapsed_ns, 0) // 1000).bit_length(), self.num_buckets - 1)] += 1
+        self.total_ns[stage] += elapsed_ns
+        if elapsed_ns > self.max_ns[stage]:
+            self.max_ns[stage] = elapsed_ns
+
+    def measure(self, stage: str):
+        """ Context manager timing a nested stage """
+        return _NestedTimer(self, stage)
+
+    def start(self):
+        """ :return: start time for lap() or split(), discarding nested stages measured outside a lap """
+        self.nested.clear()
+        return time.perf_counter_ns()
+
+    def split(self, start_ns: int):
+        """ :return: time since start_ns without the nested stages measured since, and those nested stages """
+        elapsed = time.perf_counter_ns() - start_ns
+        nested, self.nested = self.nested, {}
+        return elapsed - sum(nested.values()), nested
+
+    def record_split(self, stage: str, split):
+        """ Records a split() (possibly taken in another process, see AsyncParsingStage) under stage """
+        elapsed, nested = split
+        for nested_stage, nested_ns in nested.items():
+            self.record(nested_stage, nested_ns)
+        self.record(stage, elapsed)
+
+    def lap(self, stage: str, start_ns: int):
+        """ Records the time since start_ns under stage. :return: start time of the next stage """
+        now = time.perf_counter_ns()
+        if self.nested:
+            self.record_split(stage, self.split(start_ns))
+        else:
+            self.record(stage, now - start_ns)
+        return now
+
+    def percentile_ms(self, counts: list, q: float):
+        """ :return: upper edge (in ms) of the bucket holding the q-th percentile """
+        rank = q / 100 * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                return (1 << i) / 1000
+        return 0.0
+
+    def snapshot(self, reset: bool = False):
+        """ :return: {stage: {"count", "meanMs", "maxMs", "p50Ms", "p90Ms", "p99Ms", "histogram"}} of the stages timed """
+        counts, total_ns, max_ns = self.counts, self.total_ns, self.max_ns
+        if reset:
+            self.reset()
+        stages = {}
+        for stage, stage_counts in counts.items():
+            count = sum(stage_counts)
+            if count == 0:
+                continue
+            max_ms = max_ns[stage] / 1e6
+            stages[stage] = {
+                "count": count,
+                "meanMs": total_ns[stage] / count / 1e6,
+                "maxMs": max_ms,
+                "p50Ms": min(self.percentile_ms(stage_counts, 50), max_ms),
+                "p90Ms": min(self.percentile_ms(stage_counts, 90), max_ms),
+                "p99Ms": min(self.percentile_ms(stage_counts, 99), max_ms),
+                "histogram": list(stage_counts),
+            }
+        return stages
+
+def format_stage_report(stages: dict):
+    """ :param stages: StageTimers.snapshot() """
+    lines = [f"{'stage':<10} {'count':>8} {'mean ms':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}"]
+    for stage, s in stages.items():
+        lines.append(f"{stage:<10} {s['count']:>8} {s['meanMs']:>9.3f} {s['p50Ms']:>9.3f} {s['p90Ms']:>9.3f} "
+                     f"{s['p99Ms']:>9.3f} {s['maxMs']:>9.3f}")
+    return "\n".join(lines)
+
+if '__main__' == __name__:
+    pass
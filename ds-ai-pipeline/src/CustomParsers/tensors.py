@@ -0,0 +1,72 @@
+try:
+    import pyds
+except ImportError:
+    # parsers also run offline, without DeepStream (see parser_benchmark)
+    pyds = None
+import numpy as np
+import ctypes
+import logging
+
+# NvDsInferDataType -> numpy dtype
+NVDSINFER_DTYPES = {
+    0: np.dtype(np.float32),  # FLOAT
+    1: np.dtype(np.float16),  # HALF
+    2: np.dtype(np.int8),     # INT8
+    3: np.dtype(np.int32),    # INT32
+}
+
+class LayerLayout:
+    """ Name, type and shape of one output layer, read once per model """
+    def __init__(self, name: str, dtype, shape) -> None:
+        self.name = name
+        self.dtype = dtype
+        self.shape = shape
+        self.buffer_type = ctypes.c_char * (int(np.prod(shape)) * dtype.itemsize)
+
+# (unique_id of the inference element, layers signature) -> list of LayerLayout (one per output layer)
+_layouts = {}
+
+def get_layers_layout(tensor_meta, layers=None):
+    """
+    :param layers: the NvDsInferLayerInfo of every output layer, read from tensor_meta if None
+    :return: the LayerLayout of every output layer, None if a layer has an unsupported type.
+    Layouts are cached by model and by name, type and dimensions of the layers, so a model
+    reloaded with other outputs (same unique_id) gets a new layout.
+    """
+    if layers is None:
+        layers = [pyds.get_nvds_LayerInfo(tensor_meta, i) for i in range(tensor_meta.num_output_layers)]
+    key = (tensor_meta.unique_id, tuple((layer.layerName, int(layer.dataType), tuple(layer.dims.d)) for layer in layers))
+    layout = _layouts.get(key)
+    if layout is not None:
+        return layout
+
+    layout = []
+    for layer in layers:
+        dtype = NVDSINFER_DTYPES.get(int(layer.dataType))
+        if dtype is None:
+            logging.error(f"Output layer '{layer.layerName}' has an unsupported data type: {layer.dataType}")
+            return None
+        shape = tuple(int(d) for d in np.trim_zeros(layer.dims.d, 'b'))
+        layout.append(LayerLayout(name=layer.layerName, dtype=dtype, shape=shape))
+    _layouts[key] = layout
+    return layout
+
+def get_numpy_layers(tensor_meta, copy=False):
+    """
+    Returns a dict {layer name: numpy array} with the output layers of tensor_meta.
+
+    With copy=False the arrays are views on the host buffers of the inference element:
+    they are only valid while the pad probe that received tensor_meta is running, so
+    anything that keeps an array after the probe returns has to copy it.
+    """
+    layers = [pyds.get_nvds_LayerInfo(tensor_meta, i) for i in range(tensor_meta.num_output_layers)]
+    layout = get_layers_layout(tensor_meta, layers)
+    if layout is None:
+        return None
+
+    result={}
+    for layer, layer_layout in zip(layers, layout):
+        buffer = layer_layout.buffer_type.from_address(pyds.get_ptr(layer.buffer))
+        arr = np.frombuffer(buffer, dtype=layer_layout.dtype).reshape(layer_layout.shape)
+        result[layer_layout.name] = arr.copy() if copy else arr
+    return result
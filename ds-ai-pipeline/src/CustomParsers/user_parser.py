@@ -1,4 +1,15 @@
-from .base_custom_parser import BaseCustomParser, BoundingBox
+from .base_custom_parser import BaseCustomParser
+from .detections import DetectionBatch
+
+def to_detection_batch(result):
+    """
+    Results of a user detection parser: either (bboxes, idxs, scores, custom_msg), with Nx4 (x,y,w,h)
+    bboxes and N idxs and scores (ndarrays or lists), or (DetectionBatch, custom_msg)
+    """
+    if len(result) == 2 and isinstance(result[0], DetectionBatch):
+        return result
+    bboxes, idxs, scores, custom_msg = result
+    return DetectionBatch.from_arrays(bboxes, scores, idxs), custom_msg
 
 class UserParser(BaseCustomParser):
     def __init__(self, user_funct) -> None:       
@@ -7,15 +18,31 @@ class UserParser(BaseCustomParser):
         self.user_funct = user_funct
         if hasattr(self.user_funct, "labels"):
             self.labels = self.user_funct.labels
+        if hasattr(self.user_funct, "copy_tensors"):
+            self.copy_tensors = self.user_funct.copy_tensors
 
     def parse_det_model(self, raw_outputs: dict):       
-        bboxes, idxs, scores, custom_msg = self.user_funct.parse_det_model(self, raw_outputs)
-        dets = [BoundingBox(x=box[0], y=box[1], w=box[2], h=box[3], score=sc, class_id=idx) for box, idx, sc in zip(bboxes, idxs, scores)]
-        return dets, custom_msg
+        return to_detection_batch(self.user_funct.parse_det_model(self, raw_outputs))
 
     def parse_custom_model(self, raw_outputs: dict):
         return self.user_funct.parse_custom_model(self, raw_outputs)
 
+    def parse_det_batch(self, raw_outputs: dict):
+        batch_results, custom_msgs = [], []
+        for result in self.user_funct.parse_det_batch(self, raw_outputs):
+            dets, custom_msg = to_detection_batch(result)
+            batch_results.append(dets)
+            custom_msgs.append(custom_msg)
+        return batch_results, custom_msgs
+
+    def parse_custom_batch(self, raw_outputs: dict):
+        return self.user_funct.parse_custom_batch(self, raw_outputs)
+
+    def has_batch_parser(self):
+        if self.model_type == BaseCustomParser.DET_MODEL:
+            return hasattr(self.user_funct, "parse_det_batch")
+        return hasattr(self.user_funct, "parse_custom_batch")
+
     def add_custom_to_meta(self, outputs, batch_meta, frame_meta):
         if hasattr(self.user_funct, "add_custom_to_meta"):
             self.user_funct.add_custom_to_meta(self, outputs, batch_meta, frame_meta)
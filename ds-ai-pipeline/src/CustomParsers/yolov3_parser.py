@@ -2,23 +2,22 @@ import numpy as np
 import logging
 
 from .nms import nms
-from .base_custom_parser import BaseCustomParser, BoundingBox
+from .kernels import warm_up
+from .base_custom_parser import BaseCustomParser
+from .detections import DetectionBatch
 from .common import get_labels
 
 MAX_OUTPUT_SIZE=20
 
 def yxyx2box(yxyx):
     yxyx = (yxyx/416).clip(0,1)
-    return [yxyx[1], yxyx[0], yxyx[3], yxyx[2]]
+    return yxyx[..., [1, 0, 3, 2]]
 
-def get_det(bbox, w: int, h: int):
-    return BoundingBox(
-        x = int(bbox[0]*w),
-        y = int(bbox[1]*h),
-        w = int((bbox[2]-bbox[0])*w),
-        h = int((bbox[3]-bbox[1])*h),
-        score=bbox[4], class_id=int(bbox[5])
-    )
+def get_dets(bboxes, w: int, h: int):
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 6)
+    boxes = np.stack([bboxes[:, 0]*w, bboxes[:, 1]*h,
+                      (bboxes[:, 2]-bboxes[:, 0])*w, (bboxes[:, 3]-bboxes[:, 1])*h], axis=1)
+    return DetectionBatch.from_arrays(boxes.astype(np.int64), bboxes[:, 4], bboxes[:, 5].astype(np.int64))
 
 class Yolov3Parser(BaseCustomParser):
     def __init__(self) -> None:
@@ -28,6 +27,11 @@ class Yolov3Parser(BaseCustomParser):
         self.labels = get_labels("coco80")
         self.det_th = 0.5        
         self.mns_th = 0.213
+        # compiles the JIT NMS kernel (if numba is installed) before the first frame
+        warm_up("greedy_nms")
+
+    def default_class_threshold(self):
+        return self.det_th
 
     def parse_det_model(self, raw_outputs: dict):       
         try:
@@ -35,19 +39,24 @@ class Yolov3Parser(BaseCustomParser):
             scores = raw_outputs['yolonms_layer_1:1']
         except:
             logging.error("Yolov3Parser. Error: some layers missing in output tensors")
-            return []
+            return DetectionBatch(), None
 
         boxes, scores = boxes[np.newaxis,...], scores[np.newaxis,...]
-        indices = (scores >= self.det_th).nonzero()   
-        box_score_class = [yxyx2box(boxes[idx[0], idx[2], :])+[scores[idx], idx[1]] for idx in zip(*indices)]   
-        box_score_class.sort(reverse=True, key=lambda x: x[4])
-        box_score_class = np.array(box_score_class[:MAX_OUTPUT_SIZE])
+        if self.class_th is None:
+            batch_idx, class_idx, box_idx = (scores >= self.det_th).nonzero()
+        else:
+            class_th = self.get_class_thresholds(np.arange(scores.shape[1]))
+            batch_idx, class_idx, box_idx = (scores >= class_th[:, np.newaxis]).nonzero()
+        box_score_class = np.concatenate([yxyx2box(boxes[batch_idx, box_idx, :]),
+                                          scores[batch_idx, class_idx, box_idx][:, np.newaxis],
+                                          class_idx[:, np.newaxis]], axis=1)
         w, h = self.image_size
         if len(box_score_class) > 0:
-            bboxes = nms(box_score_class, iou_threshold=self.det_th)
-            return [get_det(bbox=b, w=w, h=h) for b in bboxes], None 
+            with self.timers.measure("nms"):
+                bboxes = nms(box_score_class, iou_threshold=self.det_th, topk=MAX_OUTPUT_SIZE)
+            return get_dets(bboxes, w=w, h=h), None 
         else:
-            return [], None
+            return DetectionBatch(), None
 
 if '__main__' == __name__:
     pass
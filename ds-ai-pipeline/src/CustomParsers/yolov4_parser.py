@@ -1,15 +1,138 @@
 import numpy as np
-from scipy import special
 import logging
 
 from .nms import nms
-from .base_custom_parser import BaseCustomParser, BoundingBox
+from .kernels import get_kernel, warm_up
+from .base_custom_parser import BaseCustomParser
+from .detections import DetectionBatch
 from .common import get_labels
 
 XYSCALE = np.array([1.2, 1.1, 1.05])
 ANCHORS = np.array([12,16, 19,36, 40,28, 36,75, 76,55, 72,146, 142,110, 192,243, 459,401], dtype=np.float32).reshape(3, 3, 2)
 STRIDES = np.array([8, 16, 32])
 
+class Yolov4Decoder:
+    """
+    Decodes the three YOLOv4 output heads into (xmin, ymin, xmax, ymax, score, class) boxes
+    in network coordinates.
+
+    Grids, anchors and strides are built once per network/head size and kept in float32.
+    The score threshold is applied before any box transformation (first on the objectness,
+    then on objectness * class probability), so only the surviving cells pay for the class
+    argmax and the sigmoid/exp. With per-class thresholds the cells are first selected with the
+    lowest one, then every candidate is compared with the threshold of its class. When numba is installed the cell selection is a single JIT
+    kernel pass over every head (see kernels.py).
+    """
+    def __init__(self, network_size, anchors=ANCHORS, strides=STRIDES, xyscale=XYSCALE) -> None:
+        self.network_size = network_size
+        self.anchors = np.asarray(anchors, dtype=np.float32)
+        self.strides = np.asarray(strides, dtype=np.float32)
+        self.xyscale = np.asarray(xyscale, dtype=np.float32)
+        # network_size is (height, width), boxes are clipped to (x, y) <= (width - 1, height - 1)
+        self.max_xy = np.array([network_size[1] - 1, network_size[0] - 1], dtype=np.float32)
+        self.head_shapes = None
+
+    def build(self, head_shapes):
+        """ Precompute the per-cell tables for heads of shape (H, W, num_anchors) """
+        xy_gain, xy_bias, wh_gain = [], [], []
+        for i, (out_h, out_w, num_anchors) in enumerate(head_shapes):
+            shape = (out_h, out_w, num_anchors)
+            grid_x, grid_y = np.meshgrid(np.arange(out_w, dtype=np.float32), np.arange(out_h, dtype=np.float32))
+            grid = np.broadcast_to(np.stack([grid_x, grid_y], axis=-1)[:, :, np.newaxis, :], shape + (2,)).reshape(-1, 2)
+
+            # ((sigmoid(t) * scale) - 0.5 * (scale - 1) + grid) * stride == sigmoid(t) * gain + bias
+            scale, stride = self.xyscale[i], self.strides[i]
+            xy_gain.append(np.full((len(grid), 1), scale * stride, dtype=np.float32))
+            xy_bias.append((grid - 0.5 * (scale - 1)) * stride)
+            wh_gain.append(np.broadcast_to(self.anchors[i], shape + (2,)).reshape(-1, 2))
+
+        self.xy_gain = np.concatenate(xy_gain)
+        self.xy_bias = np.concatenate(xy_bias).astype(np.float32)
+        self.wh_gain = np.concatenate(wh_gain).astype(np.float32) * 0.5
+        self.offsets = np.cumsum([0] + [h * w * a for h, w, a in head_shapes])
+        self.objectness = np.empty((1, self.offsets[-1]), dtype=bool)
+        self.head_shapes = head_shapes
+
+    def decode(self, heads, score_threshold, class_thresholds=None):
+        """
+        :param heads: output layers, each one with shape ([1,] H, W, num_anchors, 5 + num_classes)
+        :return: Nx6 float32 array (xmin, ymin, xmax, ymax, score, class)
+        """
+        bboxes, _ = self.decode_batch([h.reshape((1,) + h.shape[-4:]) for h in heads], score_threshold, class_thresholds)
+        return bboxes
+
+    def decode_batch(self, heads, score_threshold, class_thresholds=None):
+        """
+        :param heads: output layers, each one with shape (B, H, W, num_anchors, 5 + num_classes)
+        :param class_thresholds: optional float32 array with the score threshold of every class, replacing score_threshold
+        :return: Nx6 float32 array (xmin, ymin, xmax, ymax, score, class) and the frame index of every box
+        """
+        batch_size = heads[0].shape[0]
+        head_shapes = tuple(tuple(h.shape[1:4]) for h in heads)
+        if head_shapes != self.head_shapes:
+            self.build(head_shapes)
+        if len(self.objectness) < batch_size:
+            self.objectness = np.empty((batch_size, self.offsets[-1]), dtype=bool)
+
+        if class_thresholds is not None:
+            score_threshold = float(class_thresholds.min())
+
+        select = get_kernel("yolo_select", heads[0].dtype)
+        cand, cand_idx, cand_frames, cand_scores, cand_classes = [], [], [], [], []
+        for head, start, end in zip(heads, self.offsets[:-1], self.offsets[1:]):
+            rows = head.reshape(batch_size, -1, head.shape[-1])
+            if select is not None:
+                # thresholds are compared in the dtype of the head, as NumPy does
+                frame_sel, sel, scores, classes = select(rows, rows.dtype.type(score_threshold))
+                if class_thresholds is not None:
+                    passed = scores > class_thresholds[classes]
+                    frame_sel, sel, scores, classes = frame_sel[passed], sel[passed], scores[passed], classes[passed]
+                cand.append(rows[frame_sel, sel, :4])
+                cand_idx.append(sel + start)
+                cand_frames.append(frame_sel)
+                cand_scores.append(scores)
+                cand_classes.append(classes)
+                continue
+
+            # class probabilities are <= 1, so only cells whose objectness passes the
+            # threshold can produce a detection
+            objectness = self.objectness[:batch_size, start:end]
+            np.greater(rows[..., 4], score_threshold, out=objectness)
+            frame_sel, sel = np.nonzero(objectness)
+            sel_rows = rows[frame_sel, sel]
+            scores = sel_rows[:, 5:].max(axis=1) * sel_rows[:, 4]
+            if class_thresholds is None:
+                passed = scores > score_threshold
+                classes = np.argmax(sel_rows[passed, 5:], axis=1)
+            else:
+                classes = np.argmax(sel_rows[:, 5:], axis=1)
+                passed = scores > class_thresholds[classes]
+                classes = classes[passed]
+            cand.append(sel_rows[passed, :4])
+            cand_idx.append(sel[passed] + start)
+            cand_frames.append(frame_sel[passed])
+            cand_scores.append(scores[passed])
+            cand_classes.append(classes)
+
+        cand = np.concatenate(cand)
+        idx = np.concatenate(cand_idx)
+        frames = np.concatenate(cand_frames)
+        if len(idx) == 0:
+            return np.zeros((0, 6), dtype=np.float32), frames
+
+        xy = 1.0 / (1.0 + np.exp(-cand[:, 0:2])) * self.xy_gain[idx] + self.xy_bias[idx]
+        half_wh = np.exp(cand[:, 2:4]) * self.wh_gain[idx]
+
+        bboxes = np.empty((len(idx), 6), dtype=np.float32)
+        np.maximum(xy - half_wh, 0., out=bboxes[:, 0:2])
+        np.minimum(xy + half_wh, self.max_xy, out=bboxes[:, 2:4])
+        bboxes[:, 4] = np.concatenate(cand_scores)
+        bboxes[:, 5] = np.concatenate(cand_classes)
+
+        # discard boxes that are empty after clipping
+        valid = (bboxes[:, 2] > bboxes[:, 0]) & (bboxes[:, 3] > bboxes[:, 1])
+        return bboxes[valid], frames[valid]
+
 class Yolov4Parser(BaseCustomParser):
     def __init__(self) -> None:
         super().__init__(model_type=BaseCustomParser.DET_MODEL, name="yolov4")
@@ -18,6 +141,12 @@ class Yolov4Parser(BaseCustomParser):
         self.labels = get_labels("coco80")
         self.det_th = 0.5        
         self.mns_th = 0.213
+        self.decoder = None
+        # compiles the JIT kernels (if numba is installed) before the first frame
+        warm_up("yolo_select", "greedy_nms")
+
+    def default_class_threshold(self):
+        return self.det_th
 
     def parse_det_model(self, raw_outputs: dict):       
         try:
@@ -26,91 +155,57 @@ class Yolov4Parser(BaseCustomParser):
             Ilayer2 = raw_outputs["Identity_2:0"]
         except:
             logging.error("Yolov4Parser. Error: some layers missing in output tensors")
-            return []
-    
-        detections = [Ilayer[np.newaxis,...], Ilayer1[np.newaxis,...], Ilayer2[np.newaxis,...]]
-        pred_bbox = postprocess_bbbox(detections, ANCHORS, STRIDES, XYSCALE)
+            return DetectionBatch(), None
 
+        bboxes = self.get_decoder().decode([Ilayer, Ilayer1, Ilayer2], score_threshold=self.det_th,
+                                           class_thresholds=self.get_head_class_thresholds(Ilayer.shape[-1] - 5))
+        with self.timers.measure("nms"):
+            bboxes = nms(bboxes, self.mns_th, method='nms')
+        return self.to_detections(bboxes), None 
 
+    def parse_det_batch(self, raw_outputs: dict):
+        try:
+            heads = [raw_outputs["Identity:0"], raw_outputs["Identity_1:0"], raw_outputs["Identity_2:0"]]
+        except:
+            logging.error("Yolov4Parser. Error: some layers missing in output tensors")
+            return [], []
+
+        batch_size = heads[0].shape[0]
+        num_classes = heads[0].shape[-1] - 5
+        bboxes, frames = self.get_decoder().decode_batch(heads, score_threshold=self.det_th,
+                                                         class_thresholds=self.get_head_class_thresholds(num_classes))
+
+        # a single NMS call for the whole batch: boxes of different frames get different class ids
+        bboxes[:, 5] += frames * num_classes
+        with self.timers.measure("nms"):
+            bboxes = nms(bboxes, self.mns_th, method='nms')
+        frames = (bboxes[:, 5] // num_classes).astype(np.int64)
+        bboxes[:, 5] -= frames * num_classes
+
+        detections = [self.to_detections(bboxes[frames == i]) for i in range(batch_size)]
+        return detections, [None] * batch_size
+
+    def get_head_class_thresholds(self, num_classes: int):
+        """ :return: threshold of every class of the output heads, None without class filter """
+        if self.class_th is None:
+            return None
+        return self.get_class_thresholds(np.arange(num_classes)).astype(np.float32)
+
+    def get_decoder(self):
+        if self.decoder is None or self.decoder.network_size != self.network_size:
+            self.decoder = Yolov4Decoder(self.network_size)
+        return self.decoder
+
+    def to_detections(self, bboxes):
+        """ Scales network-coordinate boxes to the image size """
         input_size = self.network_size[0]
-        bboxes = postprocess_boxes(pred_bbox=pred_bbox, org_img_shape=self.network_size, 
-                                   input_size=input_size, score_threshold=self.det_th)
-        bboxes = nms(bboxes, self.mns_th, method='nms') 
-    
         width, height = self.image_size
-        result=[]
-        for bb in bboxes:           
-            x = int( width *bb[0]/input_size )
-            y = int( height*bb[1]/input_size )
-            w = int( width *bb[2]/input_size ) - x + 1
-            h = int( height*bb[3]/input_size ) - y + 1
-            score = bb[4]
-            class_id = int(bb[5])
-            result.append(BoundingBox(x=x, y=y, w=w, h=h, class_id=class_id, score=score))
-        return result, None 
-
-
-def postprocess_bbbox(pred_bbox, ANCHORS, STRIDES, XYSCALE=[1,1,1]):
-    '''define anchor boxes'''
-    for i, pred in enumerate(pred_bbox):
-        conv_shape = pred.shape
-        output_size = conv_shape[1]
-        conv_raw_dxdy = pred[:, :, :, :, 0:2]
-        conv_raw_dwdh = pred[:, :, :, :, 2:4]
-        xy_grid = np.meshgrid(np.arange(output_size), np.arange(output_size))
-        xy_grid = np.expand_dims(np.stack(xy_grid, axis=-1), axis=2)
-
-        xy_grid = np.tile(np.expand_dims(xy_grid, axis=0), [1, 1, 1, 3, 1])
-        xy_grid = xy_grid.astype(np.float)
-
-        pred_xy = ((special.expit(conv_raw_dxdy) * XYSCALE[i]) - 0.5 * (XYSCALE[i] - 1) + xy_grid) * STRIDES[i]
-        pred_wh = (np.exp(conv_raw_dwdh) * ANCHORS[i])
-        pred[:, :, :, :, 0:4] = np.concatenate([pred_xy, pred_wh], axis=-1)
-
-    pred_bbox = [np.reshape(x, (-1, np.shape(x)[-1])) for x in pred_bbox]
-    pred_bbox = np.concatenate(pred_bbox, axis=0)
-    return pred_bbox
-
-def postprocess_boxes(pred_bbox, org_img_shape, input_size, score_threshold):
-    '''remove boundary boxs with a low detection probability'''
-    valid_scale=[0, np.inf]
-    pred_bbox = np.array(pred_bbox)
-
-    pred_xywh = pred_bbox[:, 0:4]
-    pred_conf = pred_bbox[:, 4]
-    pred_prob = pred_bbox[:, 5:]
-
-    # (1) (x, y, w, h) --> (xmin, ymin, xmax, ymax)
-    pred_coor = np.concatenate([pred_xywh[:, :2] - pred_xywh[:, 2:] * 0.5,
-                                pred_xywh[:, :2] + pred_xywh[:, 2:] * 0.5], axis=-1)
-    # (2) (xmin, ymin, xmax, ymax) -> (xmin_org, ymin_org, xmax_org, ymax_org)
-    org_h, org_w = org_img_shape
-    resize_ratio = min(input_size / org_w, input_size / org_h)
-
-    dw = (input_size - resize_ratio * org_w) / 2
-    dh = (input_size - resize_ratio * org_h) / 2
-
-    pred_coor[:, 0::2] = 1.0 * (pred_coor[:, 0::2] - dw) / resize_ratio
-    pred_coor[:, 1::2] = 1.0 * (pred_coor[:, 1::2] - dh) / resize_ratio
-
-    # (3) clip some boxes that are out of range
-    pred_coor = np.concatenate([np.maximum(pred_coor[:, :2], [0, 0]),
-                                np.minimum(pred_coor[:, 2:], [org_w - 1, org_h - 1])], axis=-1)
-    invalid_mask = np.logical_or((pred_coor[:, 0] > pred_coor[:, 2]), (pred_coor[:, 1] > pred_coor[:, 3]))
-    pred_coor[invalid_mask] = 0
-
-    # (4) discard some invalid boxes
-    bboxes_scale = np.sqrt(np.multiply.reduce(pred_coor[:, 2:4] - pred_coor[:, 0:2], axis=-1))
-    scale_mask = np.logical_and((valid_scale[0] < bboxes_scale), (bboxes_scale < valid_scale[1]))
-
-    # (5) discard some boxes with low scores
-    classes = np.argmax(pred_prob, axis=-1)
-    scores = pred_conf * pred_prob[np.arange(len(pred_coor)), classes]
-    score_mask = scores > score_threshold
-    mask = np.logical_and(scale_mask, score_mask)
-    coors, scores, classes = pred_coor[mask], scores[mask], classes[mask]
-
-    return np.concatenate([coors, scores[:, np.newaxis], classes[:, np.newaxis]], axis=-1)
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 6)
+        x = (width *bboxes[:, 0]/input_size).astype(np.int64)
+        y = (height*bboxes[:, 1]/input_size).astype(np.int64)
+        w = (width *bboxes[:, 2]/input_size).astype(np.int64) - x + 1
+        h = (height*bboxes[:, 3]/input_size).astype(np.int64) - y + 1
+        return DetectionBatch.from_arrays(np.stack([x, y, w, h], axis=1), bboxes[:, 4], bboxes[:, 5].astype(np.int64))
 
 
 if '__main__' == __name__:
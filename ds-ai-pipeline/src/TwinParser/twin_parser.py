@@ -1,6 +1,7 @@
 from furl import furl
-from multiprocessing import Event
+from multiprocessing import Event, Queue
 import configparser
+import copy
 import json
 import logging
 import os
@@ -38,6 +39,7 @@ class Sensor:
         self.subtype = ""
         self.endpoint = ""
         self.regions_of_interest = []
+        self.motionGatingParameters = None
 
     def from_json(self, message):
         self.name = message["name"]
@@ -46,6 +48,15 @@ class Sensor:
         self.endpoint = message["endpoint"]
         self.regions_of_interest = message["regionsOfInterest"] if "regionsOfInterest" in message.keys() else []
 
+        # skipping of the primary inference while the scene does not change
+        gatingOption = message.get("motionGating")
+        if gatingOption and gatingOption["enable"]:
+            self.motionGatingParameters={}
+            self.motionGatingParameters["threshold"] = float(gatingOption.get("threshold", 0.005))
+            self.motionGatingParameters["pixelThreshold"] = int(gatingOption.get("pixelThreshold", 20))
+            self.motionGatingParameters["maxSkipFrames"] = int(gatingOption.get("maxSkipFrames", 30))
+            self.motionGatingParameters["downscaleWidth"] = int(gatingOption.get("downscaleWidth", 160))
+
 class ModelConfig:
     """
     A ModelConfig determines the type of AI model and where its configuration file(s) is/are located,
@@ -55,6 +66,8 @@ class ModelConfig:
         self.configFile = ""
         self.pyFile = None
         self.parser = None
+        self.classes = None
+        self.classThresholds = None
         self.gieType="nvinfer"
         if isinstance(msg, str):
             self.configFile = msg
@@ -62,6 +75,9 @@ class ModelConfig:
             self.configFile = msg["configFile"]
             self.pyFile = msg["pyFile"] if "pyFile" in msg.keys() else None
             self.parser = msg["parser"] if "parser" in msg.keys() else None
+            # class filtering of the detection parsers, before NMS
+            self.classes = msg["classes"] if "classes" in msg.keys() else None
+            self.classThresholds = msg["classThresholds"] if "classThresholds" in msg.keys() else None
 
 class PipelineConfig:
     """
@@ -77,9 +93,18 @@ class PipelineConfig:
         self.deepstreamPassthrough = None
         self.dewarpParameters=None
         self.cropParameters=None
+        self.asyncParsingParameters=None
+        self.tensorCaptureParameters=None
+        self.stageTimersParameters=None
+        self.sgieCacheParameters=None
+        self.preRecordParameters=None
+        self.compactMessagesParameters=None
+        self.telemetryParameters=None
         self.osdOption = False
         self.is_valid = True
         self.startRecording = Event()
+        # new parser files for the running pipeline: [primary pyFile, secondary pyFiles...]
+        self.parserUpdates = Queue()
 
     @staticmethod
     def _determine_configfile_type(config_file) -> str:
@@ -164,6 +189,56 @@ class PipelineConfig:
             # osd
             self.osdOption = message["pipelineOptions"]["osd"]["enable"]
 
+            # off-thread parsing of the primary model outputs
+            asyncOption = message["pipelineOptions"].get("asyncParsing")
+            if asyncOption and asyncOption["enable"]:
+                self.asyncParsingParameters={}
+                self.asyncParsingParameters["workers"] = int(asyncOption.get("workers", 2))
+                self.asyncParsingParameters["latencyBudgetMs"] = int(asyncOption.get("latencyBudgetMs", 100))
+
+            # recording of the primary model outputs, for offline replay
+            captureOption = message["pipelineOptions"].get("tensorCapture")
+            if captureOption and captureOption["enable"]:
+                self.tensorCaptureParameters={}
+                self.tensorCaptureParameters["frames"] = int(captureOption.get("frames", 300))
+                self.tensorCaptureParameters["directory"] = captureOption.get("directory", "/tmp/tensor-capture")
+
+            # periodic report of the parser stage times
+            timersOption = message["pipelineOptions"].get("stageTimers")
+            if timersOption and timersOption["enable"]:
+                self.stageTimersParameters={}
+                self.stageTimersParameters["reportInterval"] = int(timersOption.get("reportInterval", 60))
+
+            # reuse of the secondary model parser results of the tracked objects
+            cacheOption = message["pipelineOptions"].get("sgieCache")
+            if cacheOption and cacheOption["enable"]:
+                self.sgieCacheParameters={}
+                self.sgieCacheParameters["ttlSeconds"] = float(cacheOption.get("ttlSeconds", 5))
+                self.sgieCacheParameters["maxEntries"] = int(cacheOption.get("maxEntries", 4096))
+                self.sgieCacheParameters["refreshFrames"] = int(cacheOption.get("refreshFrames", 0))
+                self.sgieCacheParameters["reportInterval"] = int(cacheOption.get("reportInterval", 60))
+
+            # lead-in of the recordings, kept in memory
+            preRecordOption = message["pipelineOptions"].get("preRecord")
+            if preRecordOption and preRecordOption["enable"]:
+                self.preRecordParameters={}
+                self.preRecordParameters["seconds"] = float(preRecordOption.get("seconds", 5))
+                self.preRecordParameters["maxBytes"] = int(preRecordOption.get("maxBytes", 16 * 1024 * 1024))
+
+            # columnar, compressed inference messages (schemaVersion 0.2)
+            compactOption = message["pipelineOptions"].get("compactMessages")
+            if compactOption and compactOption["enable"]:
+                self.compactMessagesParameters={}
+                self.compactMessagesParameters["contentEncoding"] = compactOption.get("contentEncoding", "gzip")
+                self.compactMessagesParameters["staticRefreshMessages"] = int(compactOption.get("staticRefreshMessages", 100))
+
+            # windowed aggregates of the detections, per sensor and region of interest
+            telemetryOption = message["pipelineOptions"].get("telemetry")
+            if telemetryOption and telemetryOption["enable"]:
+                self.telemetryParameters={}
+                self.telemetryParameters["windowSeconds"] = float(telemetryOption.get("windowSeconds", 10))
+                self.telemetryParameters["sendInferences"] = bool(telemetryOption.get("sendInferences", True))
+
 class Twin:
     """
     Singleton class for the Controller Module twin, which contains all the configuration
@@ -187,6 +262,8 @@ class Twin:
         self.streams = {}
         self.sensors = {}
         self.enable_pipelines = True
+        # deepStream section of the last message the pipelines were built from
+        self.deepstream_message = None
         # default output video length is 30 seconds
         self.output_video_length = 30
 
@@ -483,6 +560,7 @@ class Twin:
 
     def parse_twin_message(self, azda_skill: str):
         msg = json.loads(azda_skill)
+        self.deepstream_message = copy.deepcopy(msg["deepStream"])
         self.enable_pipelines = msg["deepStream"]["enable"]
         if self.enable_pipelines:
             pl_check = self.parse_pipeline_configs(azda_skill=msg)
@@ -490,6 +568,59 @@ class Twin:
             self.parse_sensors(azda_skill=msg)
             self.check_all(pl_already_checked=pl_check)
 
+    @staticmethod
+    def _split_pyfiles(deepstream):
+        """
+        :return: a copy of the deepStream section without the pyFile of the models, and
+        {pipeline config id: [pyFile of the primary model, pyFile of every secondary model]}
+        """
+        deepstream = copy.deepcopy(deepstream)
+        pyfiles = {}
+        for config in deepstream.get("pipelineConfigs", []):
+            secondary = config.get("secondaryModelConfigPaths")
+            if isinstance(secondary, (str, dict)): secondary = [secondary]
+            models = [config.get("primaryModelConfigPath")] + list(secondary or [])
+            pyfiles[config.get("id")] = [m.pop("pyFile", None) if isinstance(m, dict) else None for m in models]
+        return deepstream, pyfiles
+
+    def get_parser_updates(self, azda_skill: str):
+        """
+        If the message only changes the pyFile of some models of the running pipelines, returns
+        {pipeline config id: [primary pyFile, secondary pyFiles...]} for the pipelines whose parser files
+        changed, so the parsers can be replaced without rebuilding the pipelines. Otherwise returns None.
+        """
+        msg = json.loads(azda_skill)
+        if self.deepstream_message is None or not self.enable_pipelines or "deepStream" not in msg:
+            return None
+        new_message, new_pyfiles = self._split_pyfiles(msg["deepStream"])
+        old_message, old_pyfiles = self._split_pyfiles(self.deepstream_message)
+        if new_message != old_message or new_pyfiles == old_pyfiles:
+            return None
+
+        updates = {config_id: pyfiles for config_id, pyfiles in new_pyfiles.items() if pyfiles != old_pyfiles[config_id]}
+        for config_id, pyfiles in updates.items():
+            config = self.pipelines.get(config_id)
+            # models with a built-in parser (or none) can't switch to a pyFile in place, nor the other way round
+            if config is None or not config.is_valid or config.asyncParsingParameters is not None \
+                    or [p is None for p in pyfiles] != [p is None for p in old_pyfiles[config_id]]:
+                return None
+            for pyfile in pyfiles:
+                if pyfile is not None and not os.path.exists(pyfile):
+                    logging.error(f"Parser file '{pyfile}' doesn't exist")
+                    return None
+        return updates
+
+    def set_parser_updates(self, azda_skill: str, updates: dict):
+        """ Sends the new parser files to the running pipelines, see get_parser_updates """
+        self.deepstream_message = copy.deepcopy(json.loads(azda_skill)["deepStream"])
+        for config_id, pyfiles in updates.items():
+            config = self.pipelines[config_id]
+            models = [config.primaryModelConfigPath] + list(config.secondaryModelConfigPaths or [])
+            for model, pyfile in zip(models, pyfiles):
+                if model is not None:
+                    model.pyFile = pyfile
+            config.parserUpdates.put(pyfiles)
+
     def get_sources(self, pl_config_id):
         """
         Create a list of sources from twin streams and sensors
@@ -0,0 +1,147 @@
+import logging
+import os
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from common.utils import create_gst_element
+
+# keyframe interval (in frames) of the encoder: recordings start and change file on keyframes
+KEYFRAME_INTERVAL = 30
+# duration (ms) of the fragments of the mp4 files, which can be played before they are finalized
+FRAGMENT_DURATION_MS = 1000
+
+def set_keyframe_interval(encoder, interval: int = KEYFRAME_INTERVAL):
+    """ Regular keyframes, with the stream headers repeated on every one of them """
+    if encoder.find_property("iframeinterval") is not None:
+        # nvv4l2h264enc / nvv4l2h265enc
+        encoder.set_property("iframeinterval", interval)
+        encoder.set_property("insert-sps-pps", True)
+    elif encoder.find_property("key-int-max") is not None:
+        # x264enc / x265enc
+        encoder.set_property("key-int-max", interval)
+
+class RecordingBranch:
+    """
+    Records an encoded stream of the pipeline into mp4 files, without touching the frames:
+        encoder (or tee) -> queue (pre-record ring) -> h264parse/h265parse -> splitmuxsink (mp4mux)
+
+    While not recording, the src pad of the queue is blocked and the queue leaks its oldest
+    frames: it holds the last pre_record_seconds (at most pre_record_bytes) of the encoded
+    stream, in memory. Starting a recording unblocks it, so a clip begins with those frames,
+    from their first keyframe on. The ring is not aligned on keyframes: the lead-in of a clip is
+    up to one keyframe interval shorter than pre_record_seconds. Frames older than the window at
+    the time of the record event (the one held by the blocked pad since the previous recording
+    for instance) are dropped. set_file_name makes splitmuxsink close the current file and
+    start the next one at the next keyframe. Files are written as fragmented mp4, so the last
+    file of a recording can be played (and uploaded) while it is still open.
+
+    A pipeline with several sources has one branch per source (see rtsp_out.create_source_recorders),
+    their files are named file_name + file_suffix.
+    """
+    def __init__(self, pipeline, src_pad, directory: str, codec: str = "H264", pre_record_seconds: float = 0,
+                 pre_record_bytes: int = 0, name: str = "record", file_suffix: str = "") -> None:
+        """
+        :param src_pad: pad of the encoded stream, a request pad of a tee when the stream has other uses
+        :param name: prefix of the names of the elements of the branch
+        """
+        self.directory = directory
+        self.file_name = None
+        self.file_suffix = file_suffix
+        self.waiting_keyframe = True
+        self.files = 0
+        # PTS of the newest frame entering the ring, and of the newest one when the recording started
+        self.window = int(pre_record_seconds * Gst.SECOND) if pre_record_seconds > 0 else 0
+        self.newest_pts = None
+        self.start_pts = None
+
+        self.ring = create_gst_element("queue", f"{name}_queue")
+        self.ring.set_property("leaky", 2)
+        self.ring.set_property("max-size-buffers", 0)
+        if pre_record_seconds > 0:
+            self.ring.set_property("max-size-time", int(pre_record_seconds * Gst.SECOND))
+            self.ring.set_property("max-size-bytes", pre_record_bytes)
+        else:
+            # no lead-in: the recordings start with the frames that follow the record event
+            self.ring.set_property("max-size-time", 0)
+            self.ring.set_property("max-size-bytes", 0)
+            self.ring.set_property("max-size-buffers", 1)
+        parser = create_gst_element("h264parse" if codec == "H264" else "h265parse", f"{name}_parser")
+        muxer = create_gst_element("mp4mux", f"{name}_muxer")
+        muxer.set_property("fragment-duration", FRAGMENT_DURATION_MS)
+        self.sink = create_gst_element("splitmuxsink", f"{name}_sink")
+        self.sink.set_property("muxer", muxer)
+        # files are only split on request
+        self.sink.set_property("max-size-time", 0)
+        # nothing reaches the sink before the first recording, it must not hold the pipeline state changes
+        filesink = create_gst_element("filesink", f"{name}_filesink")
+        filesink.set_property("async", False)
+        self.sink.set_property("sink", filesink)
+        self.sink.connect("format-location", self.format_location)
+
+        for element in (self.ring, parser, self.sink):
+            pipeline.add(element)
+        self.ring.link(parser)
+        parser.link(self.sink)
+        src_pad.link(self.ring.get_static_pad("sink"))
+
+        self.block_id = None
+        self.block()
+        self.ring.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self.ring_probe, None)
+        parser.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self.keyframe_probe, None)
+
+    def block(self):
+        if self.block_id is None:
+            self.block_id = self.ring.get_static_pad("src").add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM, self.block_probe, None)
+
+    def block_probe(self, pad, info, u_data):
+        # keeps the pad blocked until the probe is removed
+        return Gst.PadProbeReturn.OK
+
+    def start(self, file_name: str):
+        """ Records into directory/file_name.mp4, from the first keyframe of the pre-record ring on """
+        self.file_name = file_name
+        self.waiting_keyframe = True
+        self.start_pts = self.newest_pts
+        if self.files > 0:
+            # the file of the previous recording is closed by the first keyframe of this one
+            self.sink.emit("split-now")
+        if self.block_id is not None:
+            self.ring.get_static_pad("src").remove_probe(self.block_id)
+            self.block_id = None
+
+    def set_file_name(self, file_name: str):
+        """ Continues the recording into directory/file_name.mp4, from the next keyframe on """
+        if file_name != self.file_name:
+            self.file_name = file_name
+            self.sink.emit("split-now")
+
+    def stop(self):
+        """ Stops the recording, the ring starts filling again """
+        self.block()
+
+    def ring_probe(self, pad, info, u_data):
+        pts = info.get_buffer().pts
+        if pts != Gst.CLOCK_TIME_NONE:
+            self.newest_pts = pts
+        return Gst.PadProbeReturn.OK
+
+    def keyframe_probe(self, pad, info, u_data):
+        """ Drops the frames that precede the pre-record window or the first keyframe of a recording """
+        if self.waiting_keyframe:
+            buffer = info.get_buffer()
+            if self.start_pts is not None and buffer.pts != Gst.CLOCK_TIME_NONE and buffer.pts + self.window < self.start_pts:
+                return Gst.PadProbeReturn.DROP
+            if buffer.has_flags(Gst.BufferFlags.DELTA_UNIT):
+                return Gst.PadProbeReturn.DROP
+            self.waiting_keyframe = False
+        return Gst.PadProbeReturn.OK
+
+    def format_location(self, splitmux, fragment_id):
+        self.files += 1
+        file_path = os.path.join(self.directory, self.file_name + self.file_suffix + ".mp4")
+        logging.info(f"New video: {file_path}")
+        return file_path
+
+if '__main__' == __name__:
+    pass
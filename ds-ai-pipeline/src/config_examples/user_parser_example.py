@@ -13,6 +13,9 @@ name         = "yolov4_parser_suplied_by_user"
 # mandatory if model_type=0
 labels       = COCO_LABELS
 
+# optional: False (the default) to receive views on the output tensors, postprocess_bbbox decodes into copies
+copy_tensors = False
+
 def parse_det_model(config, raw_outputs: dict):
     """
     This function must return 3 vector:
@@ -38,14 +41,16 @@ def parse_det_model(config, raw_outputs: dict):
     input_size = 416
     bboxes = postprocess_boxes(pred_bbox=pred_bbox, org_img_shape=(416,416), 
                                    input_size=input_size, score_threshold=config.det_th)
-    bboxes = nms(bboxes, config.mns_th, method='nms') 
+    # timed as its own stage in the parser timers (see CustomParsers/stage_timers.py)
+    with config.timers.measure("nms"):
+        bboxes = nms(bboxes, config.mns_th, method='nms')
     
     width, height = config.image_size
     bboxes = np.array(bboxes)
     bboxes[:,:4]  *= np.array([width/416.0, height/416.0, width/416.0, height/416.0])
     bboxes[:,2:4] -= bboxes[:,:2]
 
-    return bboxes[:,:4], bboxes[:,5].astype(np.int), bboxes[:,4], "USER_PARSER" 
+    return bboxes[:,:4], bboxes[:,5].astype(int), bboxes[:,4], "USER_PARSER" 
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -1,16 +1,20 @@
-from os.path import join
-import gi
-gi.require_version("Gst", "1.0")
-from gi.repository import Gst
+try:
+    import gi
+    gi.require_version("Gst", "1.0")
+    from gi.repository import Gst
+    import pyds
+except ImportError:
+    # messages can also be built offline, without DeepStream (see parser_benchmark.replay)
+    Gst = pyds = None
+from CustomParsers.tensors import get_numpy_layers
+from CustomParsers.sgie_cache import MISSING
+from CustomParsers.detections import EXTRAS_INDEX_FIELD
 from datetime import datetime
-import ctypes
 import json
 import numpy as np
-import pyds
 import queue
 import logging
 import uuid
-import cv2
 
 
 UNTRACKED_OBJECT_ID = 0xffffffffffffffff
@@ -20,7 +24,16 @@ class IotMSGHelper:
         self.nframes = nframes
         self.msg_queue = msg_queue
         self.sgie_parsers = {}
+        # optional batch-level sgie parsers, called once per batch with the outputs of all the objects
+        self.sgie_batch_parsers = {}
+        # sgie ids whose parsers receive copies of the output tensors instead of views
+        self.sgie_copy_tensors = set()
+        # copy of the outputs of the first object of every sgie, to validate a replacement parser
+        self.sgie_samples = {}
+        # SgieResultCache of the sgie parser results of the tracked objects, set from the twin
+        self.sgie_cache = None
         self.pgie_custom_msg = {}
+        self.pgie_detection_extras = {}
         self.padindex_to_srcname=[]
         self.frame_size=(1,1)
         self.config_id=""
@@ -28,14 +41,55 @@ class IotMSGHelper:
         self.ncounter = 0
         self.VIDEO_UPLOADER_DIRECTORY=""
         self.regions_of_interest=[]
-        self.video_writers=None
-
-    def register_sgie_parser(self, sgie_id, sgi_parser):
+        # MessageEncoder of the compact (schemaVersion 0.2) messages, set from the twin
+        self.message_encoder = None
+        # TelemetryWindow of the windowed aggregates, set from the twin
+        self.telemetry = None
+        # False to only send the telemetry summaries
+        self.send_raw_inferences = True
+
+    def register_sgie_parser(self, sgie_id, sgi_parser, sgi_batch_parser=None, copy_tensors=False):
         self.sgie_parsers[sgie_id] = sgi_parser
+        if copy_tensors:
+            self.sgie_copy_tensors.add(sgie_id)
+        else:
+            self.sgie_copy_tensors.discard(sgie_id)
+        if sgi_batch_parser is not None:
+            self.sgie_batch_parsers[sgie_id] = sgi_batch_parser
+        else:
+            self.sgie_batch_parsers.pop(sgie_id, None)
+
+    def swap_sgie_parser(self, sgie_id, sgi_parser, sgi_batch_parser=None, copy_tensors=False):
+        """
+        Replaces the parser of a running sgie, after checking it on the outputs of an object seen by
+        the pipeline. The objects of the current batch may still go to the previous parser.
+        :return: True if sgi_parser is now in place
+        """
+        sample = self.sgie_samples.get(sgie_id)
+        if sample is not None:
+            try:
+                json.dumps(sgi_parser(self, sample))
+                if sgi_batch_parser is not None:
+                    results = sgi_batch_parser(self, {name: arr[np.newaxis] for name, arr in sample.items()})
+                    if len(results) != 1:
+                        raise ValueError(f"{len(results)} results for 1 object")
+                    json.dumps(results[0])
+            except Exception as e:
+                logging.error(f"Parser of sgie {sgie_id} failed on a sample of the model outputs: {e}. Keeping the previous parser.")
+                return False
+        self.register_sgie_parser(sgie_id, sgi_parser, sgi_batch_parser, copy_tensors)
+        if self.sgie_cache is not None:
+            self.sgie_cache.invalidate(sgie_id)
+        logging.info(f"Parser of sgie {sgie_id} replaced")
+        return True
 
     def add_custom_msg_from_pgie(self, stream_index, frame_number, custom_msg):
         self.pgie_custom_msg[(stream_index, frame_number)] = custom_msg
 
+    def add_detections_from_pgie(self, stream_index, frame_number, detections):
+        """ Keeps the extras of the pgie detections (a DetectionBatch), by detection index """
+        self.pgie_detection_extras[(stream_index, frame_number)] = detections.extras
+
     def collect_data_for_iot_hub(self, pad, info, u_data):
         pipe_data = u_data
         gst_buffer = info.get_buffer()
@@ -44,9 +98,21 @@ class IotMSGHelper:
 
         batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(gst_buffer))
         if not batch_meta: return Gst.PadProbeReturn.OK
+
+        # the inferences are only built for the batches that are read
+        if not self.wants_batch(pipe_data):
+            self.skip_frames(batch_meta)
+            self.save_pending_data()
+            self.ncounter+=1
+            self.send_telemetry()
+            return Gst.PadProbeReturn.OK
+
+        # the frames of a batch share its timestamp
+        timestamp = datetime.now()
         l_frame = batch_meta.frame_meta_list
         inferences = []
-        frames_to_save={k:[] for k in self.padindex_to_srcname}
+        # objects waiting for a batch-level sgie parser: {sgie id: [(detection, cache key, model outputs)]}
+        pending_sgie = {}
         # iterate over frames
         while l_frame is not None:
             try: frame_meta = pyds.NvDsFrameMeta.cast(l_frame.data)
@@ -57,31 +123,11 @@ class IotMSGHelper:
             frame_width = frame_meta.source_frame_width
             frame_height = frame_meta.source_frame_height
 
-            if pipe_data.rec_file_name is not None:
-                n_frame = pyds.get_nvds_buf_surface(hash(gst_buffer), frame_meta.batch_id)
-                cpy_frame = np.array(n_frame, copy=False, order='C')
-                key = self.padindex_to_srcname[stream_index]
-                frames_to_save[key].append(cv2.cvtColor(cpy_frame, cv2.COLOR_RGBA2BGR))
-
-            sourceInfo = {
-                "id": self.padindex_to_srcname[stream_index],
-                "timestamp": datetime.now().isoformat(),
-                "width": frame_width,
-                "height": frame_height,
-                "frameId": frame_number
-            }
-            customInfo={}
-            detectionInfo={}
-            clsInfo={}
-
+            sourceInfo = self.get_source_info(stream_index, frame_number, frame_width, frame_height, timestamp)
+            if self.telemetry is not None:
+                self.aggregate_frame(frame_meta)
             # check for a pgie custom message
-            if (stream_index, frame_number) in self.pgie_custom_msg.keys():
-                customInfo["sourceInfo"]=sourceInfo
-                customInfo["type"]="custom"
-                customInfo["id"]=self.config_id
-                customInfo["detections"] = [self.pgie_custom_msg[(stream_index, frame_number)]]
-                inferences.append(customInfo)
-                del self.pgie_custom_msg[(stream_index, frame_number)]
+            inferences += self.get_custom_inferences(sourceInfo, stream_index, frame_number)
 
             # iterate over frame_user_meta_list
             l_user = frame_meta.frame_user_meta_list
@@ -99,6 +145,10 @@ class IotMSGHelper:
                 try: l_user = l_user.next
                 except StopIteration: break
 
+            # extras of the pgie detections, matched to the objects by the detection index the
+            # pgie parser set in their metadata
+            detection_extras = self.pgie_detection_extras.pop((stream_index, frame_number), None)
+
             # iterate over obj_meta_list
             l_obj = frame_meta.obj_meta_list
             obj_detections=[]
@@ -108,17 +158,15 @@ class IotMSGHelper:
                 except StopIteration: continue
 
                 obj_detections.append(
-                    {
-                        "classId": obj_meta.class_id,
-                        "confidence": obj_meta.confidence,
-                        "rect": [obj_meta.rect_params.left/W, obj_meta.rect_params.top/H,
-                                 obj_meta.rect_params.width/W, obj_meta.rect_params.height/H],
-                        "label": obj_meta.obj_label,
-                        "id": str(uuid.uuid4()),
-                        "unique_component_id": obj_meta.unique_component_id,
-                        "tracking_id": obj_meta.object_id if obj_meta.object_id  != UNTRACKED_OBJECT_ID else -1
-                    }
+                    self.get_detection(obj_meta.class_id, obj_meta.confidence,
+                                       [obj_meta.rect_params.left/W, obj_meta.rect_params.top/H,
+                                        obj_meta.rect_params.width/W, obj_meta.rect_params.height/H],
+                                       obj_meta.obj_label, obj_meta.unique_component_id, obj_meta.object_id)
                 )
+                if detection_extras:
+                    index = int(obj_meta.misc_obj_info[EXTRAS_INDEX_FIELD]) - 1
+                    if 0 <= index < len(detection_extras):
+                        obj_detections[-1]["extras"] = detection_extras[index]
 
                 l_cls = obj_meta.classifier_meta_list
                 # iterate over classifier_meta_list
@@ -141,8 +189,27 @@ class IotMSGHelper:
                         tensor_meta = pyds.NvDsInferTensorMeta.cast(user_meta.user_meta_data)
                         sgieid = tensor_meta.unique_id
                         if sgieid in self.sgie_parsers.keys():
-                            model_outputs = self.get_numpy_layers(tensor_meta)
-                            obj_detections[-1]["customInfo"] = self.sgie_parsers[sgieid](self, model_outputs)
+                            # tracked objects are only parsed again when their cached result expires
+                            cache_key = None
+                            custom_info = MISSING
+                            if self.sgie_cache is not None and obj_meta.object_id != UNTRACKED_OBJECT_ID:
+                                cache_key = (sgieid, obj_meta.object_id)
+                                custom_info = self.sgie_cache.get(cache_key)
+                            if custom_info is MISSING:
+                                model_outputs = self.get_numpy_layers(tensor_meta, copy=sgieid in self.sgie_copy_tensors)
+                                if model_outputs is not None and sgieid not in self.sgie_samples:
+                                    self.sgie_samples[sgieid] = {name: np.array(arr, copy=True) for name, arr in model_outputs.items()}
+                                if model_outputs is None:
+                                    # output layers of an unsupported data type, the object gets no customInfo
+                                    pass
+                                elif sgieid in self.sgie_batch_parsers:
+                                    pending_sgie.setdefault(sgieid, []).append((obj_detections[-1], cache_key, model_outputs))
+                                else:
+                                    custom_info = self.sgie_parsers[sgieid](self, model_outputs)
+                                    if cache_key is not None:
+                                        self.sgie_cache.put(cache_key, custom_info)
+                            if custom_info is not MISSING:
+                                obj_detections[-1]["customInfo"] = custom_info
 
                     try: l_user = l_user.next
                     except StopIteration: break
@@ -150,23 +217,19 @@ class IotMSGHelper:
                 try: l_obj = l_obj.next
                 except StopIteration: break
 
-            detectionInfo["sourceInfo"]=sourceInfo
-            detectionInfo["type"]="detection"
-            detectionInfo["id"]=self.config_id
-            detectionInfo["detections"]=obj_detections
-            inferences.append(detectionInfo)
+            inferences.append(self.get_detection_inference(sourceInfo, obj_detections))
 
             try: l_frame = l_frame.next
             except StopIteration: break
 
+        if pending_sgie:
+            self.parse_sgie_batches(pending_sgie)
+
+        # the video itself is recorded by the RecordingBranch of the pipeline
         if pipe_data.rec_file_name is not None:
             if self.data_to_save is None:
                 # start collecting data (json)
                 self.data_to_save=[pipe_data.rec_file_name, inferences]
-
-                # start collecting data (video)
-                self.init_video_writers(pipe_data.rec_file_name, batch_meta)
-                self.record_frames(dd=frames_to_save)
             else:
                 if pipe_data.rec_file_name != self.data_to_save[0]:
                     # save collected data
@@ -174,39 +237,179 @@ class IotMSGHelper:
 
                     # start collecting new data (json)
                     self.data_to_save=[pipe_data.rec_file_name, inferences]
-
-                    # start collecting data (video)
-                    self.init_video_writers(pipe_data.rec_file_name, batch_meta)
-                    self.record_frames(dd=frames_to_save)
                 else:
                     # continue collecting new data (json)
                     self.data_to_save[1]+=inferences
-                    # continue collecting data (video)
-                    self.record_frames(dd=frames_to_save)
         else:
             self.save_pending_data()
 
-        #Put message in queue to send to IoT Hub
-        if self.ncounter%self.nframes == 0:
-            message={
-                "schemaVersion": "0.1",
-                "events": [],
-                "regionsOfInterest": self.regions_of_interest,
-                "inferences": inferences
-            }
+        self.send_inferences(inferences)
+        self.send_telemetry()
+        return Gst.PadProbeReturn.OK
+
+    def wants_batch(self, pipe_data):
+        """ True if the inferences of the batch are read: sent to IoT Hub (one batch every nframes) or recorded """
+        return pipe_data.rec_file_name is not None or (self.send_raw_inferences and self.ncounter%self.nframes == 0)
+
+    def skip_frames(self, batch_meta):
+        """
+        Frames of a batch that is not read: forgets their pgie custom messages and detection extras,
+        and only adds them to the telemetry aggregates
+        """
+        l_frame = batch_meta.frame_meta_list
+        while l_frame is not None:
+            try: frame_meta = pyds.NvDsFrameMeta.cast(l_frame.data)
+            except StopIteration: break
+
+            key = (frame_meta.pad_index, frame_meta.frame_num)
+            self.pgie_custom_msg.pop(key, None)
+            self.pgie_detection_extras.pop(key, None)
+            if self.telemetry is not None:
+                self.aggregate_frame(frame_meta)
+
+            try: l_frame = l_frame.next
+            except StopIteration: break
+
+    def aggregate_frame(self, frame_meta):
+        """ Adds the objects of the frame to the telemetry aggregates """
+        W, H = self.frame_size
+        class_ids, labels, confidences, centers, track_ids = [], [], [], [], []
+        l_obj = frame_meta.obj_meta_list
+        while l_obj is not None:
+            try: obj_meta = pyds.NvDsObjectMeta.cast(l_obj.data)
+            except StopIteration: break
+
+            rect = obj_meta.rect_params
+            class_ids.append(obj_meta.class_id)
+            labels.append(obj_meta.obj_label)
+            confidences.append(obj_meta.confidence)
+            centers.append(((rect.left + 0.5*rect.width)/W, (rect.top + 0.5*rect.height)/H))
+            track_ids.append(obj_meta.object_id if obj_meta.object_id != UNTRACKED_OBJECT_ID else -1)
+
+            try: l_obj = l_obj.next
+            except StopIteration: break
+        self.telemetry.add_frame(frame_meta.pad_index, class_ids, labels, confidences, centers, track_ids)
+
+    def send_telemetry(self, force=False):
+        """ Puts the telemetry summary in the queue to send to IoT Hub once its window is over """
+        if self.telemetry is None or not (force or self.telemetry.due()):
+            return
+        summary = self.telemetry.summary()
+        summary["configId"] = self.config_id
+        summary["windowSeconds"] = self.telemetry.window_seconds
+        message={
+            "schemaVersion": "0.1",
+            "events": [],
+            "inferences": [],
+            "telemetry": summary
+        }
+        if self.message_encoder is not None:
+            self.msg_queue.put(self.message_encoder.encode_json(message))
+        else:
             self.msg_queue.put(message)
-        self.ncounter+=1
 
-        return Gst.PadProbeReturn.OK
+    def parse_sgie_batches(self, pending_sgie):
+        """
+        Parses the objects of the batch with a single call per sgie: the outputs of all the objects
+        are stacked along a new first axis, and the results are scattered back to their detections.
+        """
+        for sgieid, objects in pending_sgie.items():
+            batch_parser = self.sgie_batch_parsers.get(sgieid)
+            results = None
+            if batch_parser is not None:
+                try:
+                    layer_names = objects[0][2].keys()
+                    raw_outputs = {name: np.stack([obj[2][name] for obj in objects]) for name in layer_names}
+                    results = batch_parser(self, raw_outputs)
+                    if len(results) != len(objects):
+                        raise ValueError(f"{len(results)} results for {len(objects)} objects")
+                except Exception as e:
+                    logging.error(f"Batch parser of sgie {sgieid} failed: {e}. Parsing the objects one by one.")
+                    results = None
+            if results is None:
+                results = [self.sgie_parsers[sgieid](self, model_outputs) for _, _, model_outputs in objects]
+
+            for (detection, cache_key, _), custom_info in zip(objects, results):
+                detection["customInfo"] = custom_info
+                if cache_key is not None:
+                    self.sgie_cache.put(cache_key, custom_info)
+
+    def get_source_info(self, stream_index, frame_number, frame_width, frame_height, timestamp=None):
+        return {
+            "id": self.padindex_to_srcname[stream_index],
+            "timestamp": (timestamp or datetime.now()).isoformat(),
+            "width": frame_width,
+            "height": frame_height,
+            "frameId": frame_number
+        }
+
+    def get_custom_inferences(self, sourceInfo, stream_index, frame_number):
+        """ The custom inference of the pgie custom message of the frame, if any """
+        custom_msg = self.pgie_custom_msg.pop((stream_index, frame_number), None)
+        if custom_msg is None:
+            return []
+        return [{
+            "sourceInfo": sourceInfo,
+            "type": "custom",
+            "id": self.config_id,
+            "detections": [custom_msg]
+        }]
 
-    def record_frames(self, dd):
-        keys = self.video_writers.keys()&dd.keys()
-        for k in keys:
-            for frame in dd[k]:
-                self.video_writers[k].write(frame)
+    @staticmethod
+    def get_detection(class_id, confidence, rect, label, unique_component_id, object_id):
+        """ :param rect: (left, top, width, height) relative to the frame size """
+        return {
+            "classId": class_id,
+            "confidence": confidence,
+            "rect": rect,
+            "label": label,
+            "id": str(uuid.uuid4()),
+            "unique_component_id": unique_component_id,
+            "tracking_id": object_id if object_id != UNTRACKED_OBJECT_ID else -1
+        }
+
+    def get_detection_inference(self, sourceInfo, obj_detections):
+        return {
+            "sourceInfo": sourceInfo,
+            "type": "detection",
+            "id": self.config_id,
+            "detections": obj_detections
+        }
+
+    def get_pgie_detections(self, detections, labels, stream_index, frame_number, unique_component_id=1):
+        """
+        The detections of a frame as collect_data_for_iot_hub reports the objects added by the
+        pgie parser, built from the parser results (a DetectionBatch) instead of the metadata.
+        Used to replay captured tensors without GStreamer.
+        """
+        data = detections.data
+        W, H = self.frame_size
+        detection_extras = self.pgie_detection_extras.pop((stream_index, frame_number), None)
+        obj_detections = []
+        for index, (x, y, w, h, score, class_id) in enumerate(zip(data["x"].tolist(), data["y"].tolist(), data["w"].tolist(), data["h"].tolist(),
+                                                                  data["score"].tolist(), data["class_id"].tolist())):
+            label = labels[class_id] if 0 <= class_id < len(labels) else "---"
+            obj_detections.append(self.get_detection(class_id, score, [x/W, y/H, w/W, h/H], label, unique_component_id, UNTRACKED_OBJECT_ID))
+            if detection_extras:
+                obj_detections[-1]["extras"] = detection_extras[index]
+        return obj_detections
+
+    def send_inferences(self, inferences):
+        """ Puts a message in the queue to send to IoT Hub, once every nframes calls """
+        if self.send_raw_inferences and self.ncounter%self.nframes == 0:
+            if self.message_encoder is not None:
+                self.msg_queue.put(self.message_encoder.encode(inferences, self.regions_of_interest))
+            else:
+                message={
+                    "schemaVersion": "0.1",
+                    "events": [],
+                    "regionsOfInterest": self.regions_of_interest,
+                    "inferences": inferences
+                }
+                self.msg_queue.put(message)
+        self.ncounter+=1
 
     def save_pending_data(self):
-        self.save_pending_data_video()
         self.save_pending_data_json()
 
     def save_pending_data_json(self):
@@ -223,59 +426,10 @@ class IotMSGHelper:
                 f.write(json.dumps(message))
             self.data_to_save=None
 
-    def save_pending_data_video(self):
-        if self.video_writers is not None:
-            for key in self.video_writers.keys():
-                self.video_writers[key].release()
-            self.video_writers = None
-
-    def init_video_writers(self, fname, batch_meta):
-        self.video_writers={}
-        l_frame = batch_meta.frame_meta_list
-        while l_frame is not None:
-            try: frame_meta = pyds.NvDsFrameMeta.cast(l_frame.data)
-            except StopIteration: continue
-            stream_index = frame_meta.pad_index
-            key  =  self.padindex_to_srcname[stream_index]
-            if len(self.padindex_to_srcname)==1:
-                file_path = join(self.VIDEO_UPLOADER_DIRECTORY,  fname+".mp4")
-            else:
-                file_path = join(self.VIDEO_UPLOADER_DIRECTORY,  fname+"_"+key+".mp4")
-            #fourcc = cv2.VideoWriter_fourcc('m','p', '4', 'v')
-            #fourcc = cv2.VideoWriter_fourcc('M', 'J', 'P', 'G')
-            fourcc = cv2.VideoWriter_fourcc(*'avc1')
-            fps = 30
-            self.video_writers[key] = cv2.VideoWriter(file_path, fourcc, fps, self.frame_size)
-            failed = not self.video_writers[key].isOpened()
-
-            if failed == False:
-                logging.info("New video: {}".format(file_path))
-            else:
-                logging.warn("Error. VideoWriter() failed to create the video file '{}' for writing".format(file_path))
-                del self.video_writers[key]
-
-            try: l_frame = l_frame.next
-            except StopIteration: break
-        if len(self.video_writers)==0:
-            self.video_writers=None
-
     @staticmethod
-    def get_numpy_layers(tensor_meta):
-        result={}
-        for i in range(tensor_meta.num_output_layers):
-            layer = pyds.get_nvds_LayerInfo(tensor_meta, i)
-
-            dtype=None
-            if layer.dataType == 0: dtype = ctypes.c_float
-            elif layer.dataType == 2: dtype = ctypes.c_int8
-            elif layer.dataType == 3: dtype = ctypes.c_int32
-            else: return None
-
-            dims = np.trim_zeros(layer.dims.d, 'b')
-            ptr = ctypes.cast(pyds.get_ptr(layer.buffer), ctypes.POINTER(dtype))
-            arr = np.ctypeslib.as_array(ptr, shape=dims)
-            result[layer.layerName] = arr.copy() if arr is not None else None
-        return result
+    def get_numpy_layers(tensor_meta, copy=False):
+        """ Views on the output tensors (see CustomParsers.tensors), copies with copy=True """
+        return get_numpy_layers(tensor_meta, copy=copy)
 
 if __name__ == "__main__":
     pass
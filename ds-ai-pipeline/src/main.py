@@ -9,8 +9,10 @@ import sys
 import threading
 import time
 from azure.iot.device.aio import IoTHubModuleClient
+from azure.iot.device import Message
 from multiprocessing import Queue
 from TwinParser import Twin
+from message_encoding import EncodedMessage
 from opentelemetry.sdk._logs import (
     LogEmitterProvider,
     LoggingHandler,
@@ -59,6 +61,14 @@ def set_new_pipeline(message_json, message):
     Attempt to set a new pipeline based on the controller module's message.
     """
     if "deepStream" in message_json:
+        # a change of parser files only is applied to the running pipelines
+        message_text = message.data.decode('utf-8-sig')
+        updates = twin.get_parser_updates(message_text)
+        if updates:
+            logging.info(f"Only the parser files of {list(updates)} changed. Replacing the parsers of the running pipelines.")
+            twin.set_parser_updates(message_text, updates)
+            return
+
         logging.info("Updating pipeline configurations.")
         twin.parse_twin_message(message.data.decode('utf-8-sig'))
         twin.updated = True
@@ -146,10 +156,14 @@ async def send_messages_to_iot_hub(client, msg_queue):
     while True:
         # Block until we get a message
         msg = msg_queue.get()
-        json_msg = json.dumps(msg)
+        if isinstance(msg, EncodedMessage):
+            # schemaVersion 0.2, already encoded by the pipeline
+            iot_msg = Message(msg.body, content_encoding=msg.content_encoding, content_type="application/json")
+        else:
+            iot_msg = json.dumps(msg)
         try:
-            logging.debug("Sending message to inference output:", msg)
-            await client.send_message_to_output(json_msg, "inference")
+            logging.debug(f"Sending message to inference output: {msg}")
+            await client.send_message_to_output(iot_msg, "inference")
         except Exception as e:
             logging.exception(f"Unexpected error {e}")
             raise
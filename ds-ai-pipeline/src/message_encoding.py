@@ -0,0 +1,122 @@
+import gzip
+import json
+import logging
+try:
+    import zstandard
+except ImportError:
+    # zstd is optional, messages fall back to gzip without it
+    zstandard = None
+
+SCHEMA_VERSION = "0.2"
+CONTENT_ENCODINGS = ("identity", "gzip", "zstd")
+# boxes are sent as integers relative to the frame size, RECT_SCALE being the whole frame
+RECT_SCALE = 10000
+# confidences are sent as integers, CONFIDENCE_SCALE being 1.0
+CONFIDENCE_SCALE = 1000
+
+class EncodedMessage:
+    """ Body of an IoT Hub message, as sent: JSON compressed with content_encoding """
+    def __init__(self, body: bytes, content_encoding: str) -> None:
+        self.body = body
+        self.content_encoding = content_encoding
+
+def columnar_detections(detections: list):
+    """
+    :param detections: detections of a frame, as built by IotMSGHelper.get_detection
+    :return: the detections as columns: labels (the distinct labels of the frame), columns and the
+    sparse customInfo / extras of the detections that have them, keyed by their index
+    """
+    labels, label_index = [], {}
+    class_ids, confidences, rects, label_ids, tracking_ids, component_ids = [], [], [], [], [], []
+    custom_info, extras = {}, {}
+    for i, d in enumerate(detections):
+        class_ids.append(d["classId"])
+        confidences.append(round(d["confidence"] * CONFIDENCE_SCALE))
+        rects.extend(round(v * RECT_SCALE) for v in d["rect"])
+        label = d["label"]
+        if label not in label_index:
+            label_index[label] = len(labels)
+            labels.append(label)
+        label_ids.append(label_index[label])
+        tracking_ids.append(d["tracking_id"])
+        component_ids.append(d["unique_component_id"])
+        if "customInfo" in d:
+            custom_info[str(i)] = d["customInfo"]
+        if "extras" in d:
+            extras[str(i)] = d["extras"]
+
+    columns = {
+        "classId": class_ids,
+        "confidence": confidences,
+        "rect": rects,
+        "label": label_ids,
+    }
+    # untracked frames and single-model pipelines do not repeat the same value for every detection
+    if any(t != -1 for t in tracking_ids):
+        columns["trackingId"] = tracking_ids
+    columns["componentId"] = component_ids[0] if component_ids and len(set(component_ids)) == 1 else component_ids
+    columnar = {"count": len(detections), "labels": labels, "columns": columns}
+    if custom_info:
+        columnar["customInfo"] = custom_info
+    if extras:
+        columnar["extras"] = extras
+    return columnar
+
+def columnar_inference(inference: dict):
+    """ :return: the inference with its detections as columns, for the detection inferences """
+    if inference["type"] != "detection":
+        return inference
+    columnar = {"sourceInfo": inference["sourceInfo"], "type": "detection", "id": inference["id"]}
+    columnar.update(columnar_detections(inference["detections"]))
+    return columnar
+
+class MessageEncoder:
+    """
+    Encodes the inference messages of a pipeline with schemaVersion 0.2: the detections of every
+    frame are columns of quantized values, and the regions of interest are only sent when they
+    change (and every static_refresh messages, 0 for never, so that a restarted reader gets them
+    back). The JSON is compressed with content_encoding: identity, gzip or zstd.
+    """
+    def __init__(self, config_id: str, content_encoding: str = "gzip", static_refresh: int = 100) -> None:
+        if content_encoding not in CONTENT_ENCODINGS:
+            logging.error(f"MessageEncoder: unknown content encoding {content_encoding}, using gzip")
+            content_encoding = "gzip"
+        if content_encoding == "zstd" and zstandard is None:
+            logging.warning("MessageEncoder: zstandard is not installed, using gzip")
+            content_encoding = "gzip"
+        self.config_id = config_id
+        self.content_encoding = content_encoding
+        self.static_refresh = static_refresh
+        self.compressor = zstandard.ZstdCompressor() if content_encoding == "zstd" else None
+        self.last_static = None
+        self.messages = 0
+
+    def encode(self, inferences: list, regions_of_interest: list, events: list = None):
+        """ :return: EncodedMessage of the inferences """
+        message = {
+            "schemaVersion": SCHEMA_VERSION,
+            "configId": self.config_id,
+            "quantization": {"rect": RECT_SCALE, "confidence": CONFIDENCE_SCALE},
+            "events": events or [],
+            "inferences": [columnar_inference(inference) for inference in inferences]
+        }
+        static = json.dumps(regions_of_interest, sort_keys=True)
+        if static != self.last_static or (self.static_refresh and self.messages % self.static_refresh == 0):
+            message["regionsOfInterest"] = regions_of_interest
+            self.last_static = static
+        self.messages += 1
+        return self.encode_json(message)
+
+    def encode_json(self, message: dict):
+        """ :return: EncodedMessage of message, as is """
+        return EncodedMessage(self.compress(json.dumps(message, separators=(",", ":")).encode("utf-8")), self.content_encoding)
+
+    def compress(self, body: bytes):
+        if self.content_encoding == "gzip":
+            return gzip.compress(body, compresslevel=6)
+        if self.content_encoding == "zstd":
+            return self.compressor.compress(body)
+        return body
+
+if '__main__' == __name__:
+    pass
@@ -0,0 +1,36 @@
+"""
+Offline parser benchmark: runs the parsers on recorded (or synthesized) output tensors, reports
+per-frame latency percentiles and peak allocations, and compares the results to golden outputs.
+Run from ds-ai-pipeline/src:  python3 -m parser_benchmark
+"""
+import argparse
+import json
+import logging
+import sys
+
+from .benchmark import DEFAULT_SUITE, run_suite, format_report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--suite', '-s', type=str, default=DEFAULT_SUITE, help="Suite file with the cases to run.")
+    parser.add_argument('--fixtures', type=str, default=None, help="Directory of the npz fixtures. Defaults to 'fixtures' next to the suite.")
+    parser.add_argument('--golden', type=str, default=None, help="Directory of the golden outputs. Defaults to 'golden' next to the suite.")
+    parser.add_argument('--case', '-c', action='append', default=None, help="Only run this case (can be repeated).")
+    parser.add_argument('--repeat', '-r', type=int, default=20, help="Timed passes over the frames of every fixture.")
+    parser.add_argument('--update-golden', action='store_true', help="Write the current outputs as the golden outputs.")
+    parser.add_argument('--json', type=str, default=None, help="If given, also write the results to this JSON file.")
+    parser.add_argument('--loglevel', '-l', choices=('debug', 'info', 'warning', 'error'), default='warning', help="The logging level.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()), format='[%(levelname)s]: %(message)s')
+
+    results = run_suite(args.suite, fixtures_dir=args.fixtures, golden_dir=args.golden, names=args.case,
+                        repeat=args.repeat, update_golden=args.update_golden)
+    print(format_report(results))
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump([r.summary() for r in results], f, indent=2)
+    return 1 if any(r.failed() for r in results) else 0
+
+if '__main__' == __name__:
+    sys.exit(main())
@@ -0,0 +1,290 @@
+import json
+import logging
+import os
+import time
+import tracemalloc
+import numpy as np
+
+import CustomParsers as custom_parsers
+from CustomParsers import BaseCustomParser, DetectionBatch, MotionGate
+from .fixtures import load_fixture, synthesize, SYNTHESIZERS
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SUITE = os.path.join(BENCHMARK_DIR, "suite.json")
+
+# default golden-output tolerances
+BOX_ATOL = 1.0      # pixels, boxes are truncated to integers
+SCORE_ATOL = 1e-4
+CUSTOM_ATOL = 1e-4
+
+class CaseResult:
+    """ Latencies (ms), peak traced memory per frame (bytes) and golden comparison of one case """
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.frames = 0
+        self.latencies = None
+        self.peak_bytes = None
+        self.golden = "skipped"
+        self.error = None
+        self.import_metrics = None
+
+    def failed(self):
+        return self.error is not None or self.golden == "mismatch"
+
+    def summary(self):
+        result = {"name": self.name, "frames": self.frames, "golden": self.golden, "error": self.error}
+        if self.latencies is not None and len(self.latencies):
+            p50, p90, p99 = np.percentile(self.latencies, [50, 90, 99])
+            result["latencyMs"] = {"mean": float(self.latencies.mean()), "p50": float(p50), "p90": float(p90),
+                                   "p99": float(p99), "max": float(self.latencies.max())}
+        if self.peak_bytes is not None and len(self.peak_bytes):
+            result["peakKiB"] = {"mean": float(self.peak_bytes.mean() / 1024), "max": float(self.peak_bytes.max() / 1024)}
+        if self.import_metrics is not None:
+            result["import"] = self.import_metrics
+        return result
+
+def create_parser(case: dict, suite_dir: str):
+    if "pyFile" in case:
+        return custom_parsers.create_parser_from_user_pyfile(os.path.join(suite_dir, case["pyFile"]))
+    return custom_parsers.get_parser_by_name(case["parser"])
+
+def parser_import_metrics(case: dict):
+    """ :return: import time and new modules of the registered parser of the case, None for user parser files """
+    if "pyFile" in case:
+        return None
+    entry = custom_parsers.parser_registry.get_entry(case["parser"])
+    metrics = custom_parsers.get_parser_import_metrics().get(entry.name)
+    if metrics is None:
+        raise RuntimeError(f"no import metrics for parser '{entry.name}'")
+    return metrics
+
+def parse_frame(parser, raw_outputs: dict):
+    if parser.copy_tensors:
+        raw_outputs = {name: arr.copy() for name, arr in raw_outputs.items()}
+    if parser.model_type == BaseCustomParser.DET_MODEL:
+        return parser.parse_det_model(raw_outputs=raw_outputs)
+    return parser.parse_custom_model(raw_outputs=raw_outputs)
+
+def to_json(value):
+    """ Parser outputs as JSON values: DetectionBatch, arrays and tuples become lists """
+    if isinstance(value, DetectionBatch):
+        return [list(row) for row in value.data.tolist()]
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [to_json(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): to_json(v) for k, v in value.items()}
+    return value
+
+def frame_record(parser, result):
+    outputs, custom_msg = result
+    if parser.model_type == BaseCustomParser.DET_MODEL:
+        dets = custom_parsers.detections.as_detection_batch(outputs).data
+        # the order of the detections is not part of the contract
+        order = np.lexsort((dets["y"], dets["x"], dets["class_id"]))
+        return {"detections": to_json(DetectionBatch(dets[order])), "message": to_json(custom_msg)}
+    return {"outputs": to_json(outputs), "message": to_json(custom_msg)}
+
+def compare_detections(expected, actual, box_atol, score_atol):
+    if len(expected) != len(actual):
+        return f"{len(actual)} detections instead of {len(expected)}"
+    if not expected:
+        return None
+    expected, actual = np.array(expected, dtype=np.float64), np.array(actual, dtype=np.float64)
+    if not np.array_equal(expected[:, 5], actual[:, 5]):
+        return "different classes"
+    if not np.allclose(expected[:, :4], actual[:, :4], rtol=0, atol=box_atol):
+        return f"boxes differ by up to {np.abs(expected[:, :4] - actual[:, :4]).max():g} pixels"
+    if not np.allclose(expected[:, 4], actual[:, 4], rtol=0, atol=score_atol):
+        return f"scores differ by up to {np.abs(expected[:, 4] - actual[:, 4]).max():g}"
+    return None
+
+def compare_values(expected, actual, atol, path="outputs"):
+    if isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            return f"{path}: {len(actual)} items instead of {len(expected)}"
+        for i, (e, a) in enumerate(zip(expected, actual)):
+            diff = compare_values(e, a, atol, f"{path}[{i}]")
+            if diff is not None:
+                return diff
+        return None
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        if expected.keys() != actual.keys():
+            return f"{path}: different keys"
+        for k in expected:
+            diff = compare_values(expected[k], actual[k], atol, f"{path}.{k}")
+            if diff is not None:
+                return diff
+        return None
+    if isinstance(expected, (int, float)) and isinstance(actual, (int, float)) \
+            and not isinstance(expected, bool) and not isinstance(actual, bool):
+        return None if abs(expected - actual) <= atol else f"{path}: {actual} instead of {expected}"
+    return None if expected == actual else f"{path}: {actual!r} instead of {expected!r}"
+
+def compare_golden(case: dict, golden: list, records: list):
+    """ :return: description of the first difference, None if records match golden """
+    if len(golden) != len(records):
+        return f"{len(records)} frames instead of {len(golden)}"
+    for i, (expected, actual) in enumerate(zip(golden, records)):
+        if "detections" in expected:
+            diff = compare_detections(expected["detections"], actual.get("detections", []),
+                                      case.get("boxAtol", BOX_ATOL), case.get("scoreAtol", SCORE_ATOL))
+        else:
+            diff = compare_values(expected.get("outputs"), actual.get("outputs"), case.get("atol", CUSTOM_ATOL))
+        if diff is None:
+            diff = compare_values(expected.get("message"), actual.get("message"), case.get("atol", CUSTOM_ATOL), "message")
+        if diff is not None:
+            return f"frame {i}: {diff}"
+    return None
+
+def check_object_counts(case: dict, records: list):
+    """ :return: description of the first frame without objectsPerFrame detections (or custom outputs), None if none """
+    for i, record in enumerate(records):
+        found = len(record["detections"] if "detections" in record else record["outputs"] or [])
+        if found != case["objectsPerFrame"]:
+            return f"frame {i}: {found} objects found instead of {case['objectsPerFrame']}"
+    return None
+
+def check_kept_results(case: dict, parser, frames: list):
+    """
+    Parses every frame as a motion gated pipeline does: the results are kept by a MotionGate for
+    the static frames that follow, while nvinfer reuses its output buffers for the next batches.
+    :return: description of the first kept result that changed with the buffers, None if none did
+    """
+    gate = MotionGate({})
+    for i, raw_outputs in enumerate(frames):
+        # like the layers of get_numpy_layers, arrays over memory they don't own
+        buffers = {name: np.frombuffer(bytearray(arr.tobytes()), dtype=arr.dtype).reshape(arr.shape)
+                   for name, arr in raw_outputs.items()}
+        result = parse_frame(parser, buffers)
+        expected = frame_record(parser, result)
+        gate.remember(0, *result)
+        for arr in buffers.values():
+            arr.fill(0)
+        diff = compare_golden(case, [expected], [frame_record(parser, gate.previous_results(0))])
+        if diff is not None:
+            return f"frame {i}: result kept by the motion gate changed with the output buffers ({diff[len('frame 0: '):]})"
+    return None
+
+def measure_latencies(parser, frames: list, repeat: int):
+    # one pass to warm up the caches of the parser (decoder tables, kernels, ...)
+    for raw_outputs in frames:
+        parse_frame(parser, raw_outputs)
+
+    latencies = np.empty(repeat * len(frames))
+    i = 0
+    for _ in range(repeat):
+        for raw_outputs in frames:
+            start = time.perf_counter()
+            parse_frame(parser, raw_outputs)
+            latencies[i] = (time.perf_counter() - start) * 1000
+            i += 1
+    return latencies
+
+def measure_allocations(parser, frames: list):
+    """ Peak memory allocated through Python and NumPy while parsing every frame """
+    peaks = np.empty(len(frames))
+    tracemalloc.start()
+    try:
+        for i, raw_outputs in enumerate(frames):
+            tracemalloc.clear_traces()
+            result = parse_frame(parser, raw_outputs)
+            peaks[i] = tracemalloc.get_traced_memory()[1]
+            del result
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+def run_case(case: dict, suite_dir: str, fixtures_dir: str, golden_dir: str, repeat: int, update_golden: bool):
+    result = CaseResult(case["name"])
+    fixture_path = os.path.join(fixtures_dir, case["fixture"])
+    if not os.path.exists(fixture_path):
+        fixture_name = os.path.splitext(case["fixture"])[0]
+        if fixture_name not in SYNTHESIZERS:
+            result.error = f"fixture {fixture_path} not found"
+            return result
+        os.makedirs(fixtures_dir, exist_ok=True)
+        synthesize(fixture_name, fixture_path)
+        logging.info(f"Synthesized fixture {fixture_path}")
+
+    frames, meta = load_fixture(fixture_path)
+    result.frames = len(frames)
+    try:
+        parser = create_parser(case, suite_dir)
+        if parser is None:
+            result.error = "parser could not be created"
+            return result
+        result.import_metrics = parser_import_metrics(case)
+        if "imageSize" in meta:
+            parser.image_size = tuple(meta["imageSize"])
+        if "classes" in case or "classThresholds" in case:
+            parser.set_class_filter(classes=case.get("classes"), class_thresholds=case.get("classThresholds"))
+
+        records = [frame_record(parser, parse_frame(parser, raw_outputs)) for raw_outputs in frames]
+        if "objectsPerFrame" in case:
+            result.error = check_object_counts(case, records)
+            if result.error is not None:
+                return result
+        if case.get("motionGate"):
+            result.error = check_kept_results(case, parser, frames)
+            if result.error is not None:
+                return result
+        result.latencies = measure_latencies(parser, frames, repeat)
+        result.peak_bytes = measure_allocations(parser, frames)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+        return result
+
+    golden_path = os.path.join(golden_dir, case["name"] + ".json")
+    if update_golden:
+        os.makedirs(golden_dir, exist_ok=True)
+        with open(golden_path, "w") as f:
+            json.dump({"fixture": case["fixture"], "frames": records}, f)
+        result.golden = "updated"
+    elif os.path.exists(golden_path):
+        with open(golden_path) as f:
+            diff = compare_golden(case, json.load(f)["frames"], records)
+        result.golden = "ok" if diff is None else "mismatch"
+        if diff is not None:
+            logging.error(f"{case['name']}: output differs from {golden_path}: {diff}")
+    else:
+        result.golden = "missing"
+    return result
+
+def run_suite(suite_path: str = DEFAULT_SUITE, fixtures_dir: str = None, golden_dir: str = None,
+              names=None, repeat: int = 20, update_golden: bool = False):
+    """
+    Runs the cases of a suite file:
+        {"cases": [{"name": "yolov4", "parser": "yolov4", "fixture": "yolov4.npz"},
+                   {"name": "my_parser", "pyFile": "path/to/my_parser.py", "fixture": "my_model.npz"}]}
+    pyFile paths are relative to the suite file. Optional per-case tolerances: boxAtol and scoreAtol
+    for detection parsers, atol for the outputs of custom parsers. With motionGate, the results kept
+    by a MotionGate are also checked against the reuse of the output buffers (see check_kept_results).
+    With objectsPerFrame, every frame must give that many detections (or custom outputs).
+    """
+    suite_dir = os.path.dirname(os.path.abspath(suite_path))
+    fixtures_dir = fixtures_dir or os.path.join(suite_dir, "fixtures")
+    golden_dir = golden_dir or os.path.join(suite_dir, "golden")
+    with open(suite_path) as f:
+        cases = json.load(f)["cases"]
+
+    results = []
+    for case in cases:
+        if names and case["name"] not in names:
+            continue
+        logging.info(f"Running {case['name']}")
+        results.append(run_case(case, suite_dir, fixtures_dir, golden_dir, repeat, update_golden))
+    return results
+
+def format_report(results: list):
+    lines = [f"{'case':<24}{'frames':>7}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}{'peak KiB':>10}  golden"]
+    for r in results:
+        s = r.summary()
+        if r.error is not None:
+            lines.append(f"{r.name:<24}{r.frames:>7}  error: {r.error}")
+            continue
+        lat, mem = s["latencyMs"], s["peakKiB"]
+        lines.append(f"{r.name:<24}{r.frames:>7}{lat['p50']:>9.2f}{lat['p90']:>9.2f}{lat['p99']:>9.2f}{lat['max']:>9.2f}"
+                     f"{mem['max']:>10.0f}  {r.golden}")
+    return "\n".join(lines)
@@ -0,0 +1,192 @@
+import functools
+import json
+import numpy as np
+
+# Fixture files are npz archives with one array per output layer, named as the layer, holding the
+# tensors of all the frames stacked along a new first axis. META_KEY holds a JSON string with
+# the frame size the parser scales its outputs to: {"imageSize": [width, height]}
+META_KEY = "__meta__"
+
+def save_fixture(path: str, frames: list, image_size):
+    """ :param frames: one {layer name: array} dict per frame """
+    layers = {name: np.stack([f[name] for f in frames]) for name in frames[0]}
+    layers[META_KEY] = np.array(json.dumps({"imageSize": list(image_size)}))
+    np.savez_compressed(path, **layers)
+
+def load_fixture(path: str):
+    """ :return: list of {layer name: array} dicts, one per frame, and the metadata dict """
+    with np.load(path) as data:
+        meta = json.loads(str(data[META_KEY])) if META_KEY in data.files else {}
+        layers = {name: data[name] for name in data.files if name != META_KEY}
+    nframes = len(next(iter(layers.values())))
+    frames = [{name: arr[i] for name, arr in layers.items()} for i in range(nframes)]
+    return frames, meta
+
+def synthetic_yolov4(rng, nframes):
+    """ Sigmoid-activated heads (H, W, 3, 85) of a 416x416 Yolov4 with a few objects per frame """
+    frames = []
+    for _ in range(nframes):
+        heads = []
+        for size in (52, 26, 13):
+            head = np.empty((size, size, 3, 85), dtype=np.float32)
+            head[..., 0:2] = rng.normal(0, 1, (size, size, 3, 2))
+            head[..., 2:4] = rng.normal(0, 0.5, (size, size, 3, 2))
+            head[..., 4] = rng.uniform(0, 0.3, (size, size, 3))
+            head[..., 5:] = rng.uniform(0, 0.2, (size, size, 3, 80))
+            heads.append(head)
+        for _ in range(rng.integers(3, 12)):
+            head = heads[rng.integers(0, 3)]
+            y, x, a, c = rng.integers(0, len(head)), rng.integers(0, len(head)), rng.integers(0, 3), rng.integers(0, 80)
+            head[y, x, a, 4] = rng.uniform(0.6, 1.0)
+            head[y, x, a, 5 + c] = rng.uniform(0.7, 1.0)
+            # a weaker duplicate in the next cell, for the NMS
+            x2 = min(x + 1, len(head) - 1)
+            head[y, x2, a, 4] = head[y, x, a, 4] * 0.9
+            head[y, x2, a, 5 + c] = head[y, x, a, 5 + c]
+        frames.append({"Identity:0": heads[0], "Identity_1:0": heads[1], "Identity_2:0": heads[2]})
+    return frames, (1280, 720)
+
+def synthetic_tiny_yolov3(rng, nframes, num_boxes=2535):
+    """ Outputs of the yolonms layer: boxes (N, 4) as (ymin, xmin, ymax, xmax) and scores (80, N) """
+    frames = []
+    for _ in range(nframes):
+        yx = rng.uniform(0, 380, (num_boxes, 2))
+        hw = rng.uniform(8, 120, (num_boxes, 2))
+        boxes = np.concatenate([yx, np.minimum(yx + hw, 416)], axis=1).astype(np.float32)
+        scores = rng.uniform(0, 0.05, (80, num_boxes)).astype(np.float32)
+        for i in rng.choice(num_boxes - 1, rng.integers(3, 12), replace=False):
+            c = rng.integers(0, 80)
+            scores[c, i] = rng.uniform(0.6, 1.0)
+            # an overlapping duplicate
+            boxes[i + 1] = boxes[i] + rng.uniform(-4, 4, 4)
+            scores[c, i + 1] = scores[c, i] * 0.9
+        frames.append({"yolonms_layer_1": boxes, "yolonms_layer_1:1": scores})
+    return frames, (1280, 720)
+
+def synthetic_ssd_mobilenet_v1(rng, nframes, max_detections=100):
+    """ TensorFlow detection API outputs, normalized (ymin, xmin, ymax, xmax) boxes """
+    frames = []
+    for _ in range(nframes):
+        num = rng.integers(5, 30)
+        yx = rng.uniform(0, 0.8, (max_detections, 2))
+        boxes = np.concatenate([yx, np.minimum(yx + rng.uniform(0.02, 0.3, (max_detections, 2)), 1)], axis=1)
+        frames.append({
+            "num_detections:0": np.array([num], dtype=np.float32),
+            "detection_scores:0": np.sort(rng.uniform(0.3, 1.0, max_detections))[::-1].astype(np.float32),
+            "detection_classes:0": rng.integers(1, 91, max_detections).astype(np.float32),
+            "detection_boxes:0": boxes.astype(np.float32),
+        })
+    return frames, (1280, 720)
+
+# Rough position of every joint inside a unit person box (x, y in [-0.5, 0.5])
+SKELETON = np.array([
+    [0.0, -0.42], [0.0, -0.3], [-0.15, -0.3], [-0.2, -0.1], [-0.22, 0.08], [0.15, -0.3],
+    [0.2, -0.1], [0.22, 0.08], [-0.1, 0.05], [-0.11, 0.27], [-0.12, 0.48], [0.1, 0.05],
+    [0.11, 0.27], [0.12, 0.48], [-0.04, -0.45], [0.04, -0.45], [-0.08, -0.43], [0.08, -0.43]])
+
+def paint_people(positions, heatmaps, pafs, rng, upsampling, limb_width=0, limb_strengths=None):
+    """
+    Paints a gaussian per joint on the heatmaps and the limbs on the PAFs of every person (joints in PAF pixels),
+    limb_width pixels around the segment between the joints. limb_strengths (people, limbs) scales the PAF
+    vectors, unit vectors if None
+    """
+    from CustomParsers.pose import joint_to_limb_heatmap_relationship
+
+    grid_y, grid_x = np.mgrid[0:heatmaps.shape[0], 0:heatmaps.shape[1]]
+    for i, person in enumerate(positions):
+        for joint, (x, y) in enumerate(person / upsampling):
+            blob = rng.uniform(0.5, 1.0) * np.exp(-((grid_x - x) ** 2 + (grid_y - y) ** 2) / 2.0)
+            np.maximum(heatmaps[..., joint], blob, out=heatmaps[..., joint])
+        for limb_type, (src, dst) in enumerate(joint_to_limb_heatmap_relationship):
+            vec = person[dst] - person[src]
+            length = np.linalg.norm(vec)
+            if length < 1:
+                continue
+            ext = limb_width / length
+            line = person[src] + np.linspace(-ext, 1 + ext, int(2 * (length + 2 * limb_width)))[:, np.newaxis] * vec
+            offsets = np.arange(-limb_width, limb_width + 1)[:, np.newaxis] * np.array([-vec[1], vec[0]]) / length
+            pts = np.round(line[:, np.newaxis] + offsets).reshape(-1, 2).astype(int)
+            strength = 1 if limb_strengths is None else limb_strengths[i, limb_type]
+            pafs[pts[:, 1], pts[:, 0], 2 * limb_type:2 * limb_type + 2] = strength * vec / length
+    heatmaps[..., -1] = 1 - heatmaps[..., :-1].max(axis=2)
+
+def synthetic_bodypose2d(rng, nframes, heatmap_size=(46, 80), upsampling=4):
+    """ Joint heatmaps (H, W, 19) with a gaussian per joint and PAFs (4H, 4W, 38) painted along the limbs """
+    from CustomParsers.pose import NUM_JOINTS, NUM_LIMBS
+
+    hm_h, hm_w = heatmap_size
+    height, width = hm_h * upsampling, hm_w * upsampling
+    frames = []
+    for _ in range(nframes):
+        num_people = rng.integers(1, 6)
+        heatmaps = np.zeros((hm_h, hm_w, NUM_JOINTS + 1), dtype=np.float32)
+        pafs = np.zeros((height, width, 2 * NUM_LIMBS), dtype=np.float32)
+        sizes = rng.uniform(60, 160, num_people)
+        centers = np.stack([rng.uniform(0, width, num_people), rng.uniform(0, height, num_people)], axis=1)
+        positions = np.clip(centers[:, np.newaxis] + sizes[:, np.newaxis, np.newaxis] * SKELETON, 0, [width - 1, height - 1])
+        paint_people(positions, heatmaps, pafs, rng, upsampling)
+        frames.append({"heatmap_out/BiasAdd:0": heatmaps, "conv2d_transpose_1/BiasAdd:0": pafs})
+    return frames, (1280, 720)
+
+def synthetic_bodypose2d_crowd(rng, nframes, num_people, heatmap_size=(92, 160), upsampling=4):
+    """
+    Same outputs as synthetic_bodypose2d (368x640 PAFs by default), with num_people people per frame, each one in its own cell
+    of a grid over the frame: no person overlaps another or the frame borders, and the limbs
+    are painted a few pixels wide, so that the decoder finds every person
+    """
+    from CustomParsers.pose import NUM_JOINTS, NUM_LIMBS
+
+    hm_h, hm_w = heatmap_size
+    height, width = hm_h * upsampling, hm_w * upsampling
+    # the skeleton spans 0.44 x 0.93 of the person size: as many columns as fit the people as large as possible
+    rows = max(1, int(np.round(np.sqrt(num_people * height * 0.44 / (width * 0.93)))))
+    cols = int(np.ceil(num_people / rows))
+    cell_w, cell_h = width / cols, height / rows
+    max_size = min(cell_w / 0.44, cell_h / 0.93)
+    frames = []
+    for _ in range(nframes):
+        heatmaps = np.zeros((hm_h, hm_w, NUM_JOINTS + 1), dtype=np.float32)
+        pafs = np.zeros((height, width, 2 * NUM_LIMBS), dtype=np.float32)
+        cells = rng.choice(cols * rows, num_people, replace=False)
+        # off the cell centers: a joint on a heatmap cell center has two equal maxima once upsampled
+        centers = np.stack([(cells % cols + rng.uniform(0.47, 0.53, num_people)) * cell_w,
+                            (cells // cols + rng.uniform(0.47, 0.53, num_people)) * cell_h], axis=1)
+        sizes = rng.uniform(0.55, 0.7, num_people) * max_size
+        positions = centers[:, np.newaxis] + sizes[:, np.newaxis, np.newaxis] * SKELETON
+        # limbs of different strengths: their scores don't tie, the people are grouped in the same order
+        # with and without the JIT kernels
+        strengths = rng.uniform(0.5, 1.0, (num_people, NUM_LIMBS))
+        paint_people(positions, heatmaps, pafs, rng, upsampling, limb_width=4, limb_strengths=strengths)
+        frames.append({"heatmap_out/BiasAdd:0": heatmaps, "conv2d_transpose_1/BiasAdd:0": pafs})
+    return frames, (1280, 720)
+
+def synthetic_classification(rng, nframes, num_classes=1000):
+    """ Softmax scores (num_classes,) of an ImageNet classifier, with a few likely classes per frame """
+    frames = []
+    for _ in range(nframes):
+        logits = rng.normal(0, 1, num_classes)
+        logits[rng.choice(num_classes, 3, replace=False)] += rng.uniform(4, 8, 3)
+        scores = np.exp(logits - logits.max())
+        frames.append({"Softmax:0": (scores / scores.sum()).astype(np.float32)})
+    return frames, (1280, 720)
+
+# fixture name -> function(rng, nframes) returning the frames and the image size
+SYNTHESIZERS = {
+    "yolov4": synthetic_yolov4,
+    "tiny_yolov3": synthetic_tiny_yolov3,
+    "ssd_mobilenet_v1": synthetic_ssd_mobilenet_v1,
+    "bodypose2d": synthetic_bodypose2d,
+    "classification": synthetic_classification,
+    # pose decoding time as the number of people grows
+    "bodypose2d_1_person": functools.partial(synthetic_bodypose2d_crowd, num_people=1),
+    "bodypose2d_10_people": functools.partial(synthetic_bodypose2d_crowd, num_people=10),
+    "bodypose2d_50_people": functools.partial(synthetic_bodypose2d_crowd, num_people=50),
+}
+
+def synthesize(name: str, path: str, nframes: int = 8, seed: int = 0):
+    """ Writes a deterministic fixture with the outputs a model would produce on a few objects """
+    frames, image_size = SYNTHESIZERS[name](np.random.default_rng(seed), nframes)
+    save_fixture(path, frames, image_size)
+
+if '__main__' == __name__:
+    pass
@@ -0,0 +1,16 @@
+"""
+User parser of a custom model returning (the first scores of) one of its output layers as is: with
+copy_tensors left to False, its outputs are views on the output tensors of nvinfer (see the
+motionGate case option).
+"""
+
+# mandatory
+model_type   = 1
+# mandatory
+name         = "raw_layer_parser"
+
+def parse_custom_model(config, raw_outputs: dict):
+    return raw_outputs["Softmax:0"][:5], None
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,126 @@
+"""
+Replays the output tensors captured by the pipeline (pipelineOptions.tensorCapture) through a parser
+and IotMSGHelper, without GStreamer, and reports the time spent on every frame.
+Run from ds-ai-pipeline/src:  python3 -m parser_benchmark.replay --capture DIR --parser yolov4
+"""
+import argparse
+import json
+import logging
+import queue
+import sys
+import time
+from datetime import datetime
+import numpy as np
+
+import CustomParsers as custom_parsers
+from CustomParsers import BaseCustomParser, read_capture
+from CustomParsers.detections import as_detection_batch
+from iot_messaging import IotMSGHelper
+from .benchmark import parse_frame
+from .fixtures import save_fixture
+
+class FrameTiming:
+    def __init__(self, meta: dict, parse_ms: float, message_ms: float) -> None:
+        self.meta = meta
+        self.parse_ms = parse_ms
+        self.message_ms = message_ms
+
+def replay(records: list, parser, msg_helper: IotMSGHelper):
+    """
+    Parses every captured frame and builds its inferences as the pipeline does: the detections of
+    a detection parser become the objects of the frame, the custom message a custom inference.
+    Every frame is sent as its own message (every nframes frames, as in the pipeline).
+    :return: list of FrameTiming, one per record
+    """
+    W, H = msg_helper.frame_size
+    timings = []
+    for meta, raw_outputs in records:
+        stream_index, frame_number = meta["padIndex"], meta["frameNumber"]
+
+        start = time.perf_counter()
+        outputs, custom_msg = parse_frame(parser, raw_outputs)
+        parsed = time.perf_counter()
+
+        if custom_msg:
+            msg_helper.add_custom_msg_from_pgie(stream_index, frame_number, custom_msg)
+        sourceInfo = msg_helper.get_source_info(stream_index, frame_number, W, H,
+                                                timestamp=datetime.fromtimestamp(meta["timestamp"]))
+        inferences = msg_helper.get_custom_inferences(sourceInfo, stream_index, frame_number)
+        obj_detections = []
+        if parser.model_type == BaseCustomParser.DET_MODEL:
+            detections = as_detection_batch(outputs)
+            if detections.extras is not None:
+                msg_helper.add_detections_from_pgie(stream_index, frame_number, detections)
+            obj_detections = msg_helper.get_pgie_detections(detections, parser.labels, stream_index, frame_number)
+        inferences.append(msg_helper.get_detection_inference(sourceInfo, obj_detections))
+        msg_helper.send_inferences(inferences)
+
+        timings.append(FrameTiming(meta, (parsed - start) * 1000, (time.perf_counter() - parsed) * 1000))
+    return timings
+
+def format_timings(timings: list, slowest: int):
+    total = np.array([t.parse_ms + t.message_ms for t in timings])
+    parse = np.array([t.parse_ms for t in timings])
+    lines = [f"{len(timings)} frames"]
+    for name, values in (("parse", parse), ("parse + message", total)):
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        lines.append(f"{name:<16} p50 {p50:.2f} ms  p90 {p90:.2f} ms  p99 {p99:.2f} ms  max {values.max():.2f} ms")
+    lines.append(f"slowest frames:")
+    for i in np.argsort(-total, kind="stable")[:slowest]:
+        t = timings[i]
+        captured = datetime.fromtimestamp(t.meta["timestamp"]).isoformat()
+        lines.append(f"  frame {t.meta['frameNumber']:>7} source {t.meta['padIndex']}  captured {captured}  "
+                     f"parse {t.parse_ms:.2f} ms  message {t.message_ms:.2f} ms")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--capture', type=str, required=True, help="Directory of the captured records.")
+    parser.add_argument('--parser', type=str, default=None, help="Name of a pre-built (or registered) parser.")
+    parser.add_argument('--pyFile', type=str, default=None, help="Python file of a user parser.")
+    parser.add_argument('--image-size', type=int, nargs=2, default=(1280, 720), metavar=("WIDTH", "HEIGHT"),
+                        help="Frame size the parser scales its outputs to (the pipeline's muxer output size).")
+    parser.add_argument('--nframes', type=int, default=1, help="Send a message every nframes frames.")
+    parser.add_argument('--messages', type=str, default=None, help="If given, write the messages to this file, one JSON per line.")
+    parser.add_argument('--fixture', type=str, default=None, help="If given, also save the captured tensors as a benchmark fixture.")
+    parser.add_argument('--slowest', type=int, default=10, help="Number of slowest frames to list.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='[%(levelname)s]: %(message)s')
+
+    records = read_capture(args.capture)
+    if not records:
+        print(f"No records in {args.capture}")
+        return 1
+    if args.fixture is not None:
+        save_fixture(args.fixture, [raw_outputs for _, raw_outputs in records], args.image_size)
+
+    if args.pyFile is not None:
+        pgi_parser = custom_parsers.create_parser_from_user_pyfile(args.pyFile)
+    elif args.parser is not None:
+        pgi_parser = custom_parsers.get_parser_by_name(args.parser)
+    else:
+        print("One of --parser or --pyFile is required")
+        return 1
+    if pgi_parser is None:
+        return 1
+    pgi_parser.image_size = tuple(args.image_size)
+
+    msg_queue = queue.Queue()
+    msg_helper = IotMSGHelper(nframes=args.nframes, msg_queue=msg_queue)
+    msg_helper.padindex_to_srcname = [f"source-{i}" for i in range(max(meta["padIndex"] for meta, _ in records) + 1)]
+    msg_helper.frame_size = tuple(args.image_size)
+    msg_helper.config_id = "replay"
+    pgi_parser.msg_helper = msg_helper
+
+    timings = replay(records, pgi_parser, msg_helper)
+    print(format_timings(timings, args.slowest))
+
+    if args.messages is not None:
+        with open(args.messages, "w") as f:
+            while not msg_queue.empty():
+                f.write(json.dumps(msg_queue.get()) + "\n")
+    return 0
+
+if '__main__' == __name__:
+    sys.exit(main())
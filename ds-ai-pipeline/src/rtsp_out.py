@@ -1,6 +1,7 @@
 from asyncio import subprocess
 from common.is_aarch_64 import is_aarch64
 from common.bus_call import bus_call
+from common.recording import RecordingBranch, set_keyframe_interval
 from datetime import datetime
 from dataclasses import dataclass
 from multiprocessing import Process
@@ -8,6 +9,8 @@ from TwinParser import Twin, PipelineConfig
 import common.utils as ds_utils
 import CustomParsers as custom_parsers
 import iot_messaging as iot_utils
+from message_encoding import MessageEncoder
+from telemetry import TelemetryWindow
 import gi
 gi.require_version("Gst", "1.0")
 gi.require_version("GstRtspServer", "1.0")
@@ -16,6 +19,7 @@ import logging
 import math
 import os
 import pyds
+import queue
 import subprocess
 import time
 
@@ -27,6 +31,8 @@ class PipelineData:
     rec_file_name: str
     timeout_id: int
     last_time: datetime
+    # one RecordingBranch per source (a single one for the output of single-source pipelines)
+    recorders: list = None
 
 # GLOBAL CONSTANTS
 AUTO_STOP_RECORD_TIMEOUT = 300 #Seconds to auto stop recording
@@ -45,6 +51,7 @@ SINK_SYNC = 0
 MUX_SYNC_INPUTS = 0
 DISPLAY_ON_SCREEN = False
 NFRAMES_TO_SEND_DATA = 30
+MOTION_GATE_REPORT_INTERVAL = 60 # Seconds between motion gating reports
 
 #File Sink Settings
 ONE_SECOND = 1000000000
@@ -98,6 +105,66 @@ def create_rtsp_out_branch(pipeline, encoder):
     rtsp_queue.link(rtppay)
     rtppay.link(sink)
 
+def create_encoder(pipeline, suffix: str = ""):
+    """
+    :return: the element feeding the encoder and the encoder: x264enc/x265enc on Jetson,
+    nvv4l2h264enc/nvv4l2h265enc (from NVMM I420 frames) otherwise
+    """
+    if is_aarch64():
+        caps = ds_utils.create_gst_element("queue", "filter" + suffix)
+        pipeline.add(caps)
+
+        # Make the encoder x264enc nvv4l2h264enc
+        if CODEC == "H264":
+            encoder = ds_utils.create_gst_element("x264enc", "encoder" + suffix)
+        if CODEC == "H265":
+            encoder = ds_utils.create_gst_element("x265enc", "encoder" + suffix)
+    else:
+        # Create a caps filter
+        caps = ds_utils.create_gst_element("capsfilter", "filter" + suffix)
+        pipeline.add(caps)
+        caps.set_property("caps", Gst.Caps.from_string("video/x-raw(memory:NVMM), format=I420"))
+
+        # Make the encoder x264enc nvv4l2h264enc
+        if CODEC == "H264":
+            encoder = ds_utils.create_gst_element("nvv4l2h264enc", "encoder" + suffix)
+        if CODEC == "H265":
+            encoder = ds_utils.create_gst_element("nvv4l2h265enc", "encoder" + suffix)
+
+    pipeline.add(encoder)
+    return caps, encoder
+
+def create_source_recorders(pipeline, batch_tee, sensors: list, pre_record_seconds: float = 0, pre_record_bytes: int = 0):
+    """
+    Records every source into its own files, <file name>_<sensor>.mp4, from the frames of the
+    batch before the tiler:
+        tee -> queue -> nvstreamdemux -> [queue -> nvvideoconvert -> encoder -> RecordingBranch] per source
+    :return: the RecordingBranch of every source
+    """
+    demux_queue = ds_utils.create_gst_element("queue", "record_demux_queue")
+    demux = ds_utils.create_gst_element("nvstreamdemux", "record_demux")
+    pipeline.add(demux_queue)
+    pipeline.add(demux)
+    batch_tee.link(demux_queue)
+    demux_queue.link(demux)
+
+    recorders = []
+    for i, sensor in enumerate(sensors):
+        source_queue = ds_utils.create_gst_element("queue", f"record_queue_{i}")
+        conv = ds_utils.create_gst_element("nvvideoconvert", f"record_convertor_{i}")
+        pipeline.add(source_queue)
+        pipeline.add(conv)
+        caps, encoder = create_encoder(pipeline, f"_record_{i}")
+        set_keyframe_interval(encoder)
+        demux.get_request_pad(f"src_{i}").link(source_queue.get_static_pad("sink"))
+        source_queue.link(conv)
+        conv.link(caps)
+        caps.link(encoder)
+        recorders.append(RecordingBranch(pipeline, encoder.get_static_pad("src"), VIDEO_UPLOADER_DIRECTORY, codec=CODEC,
+                                         pre_record_seconds=pre_record_seconds, pre_record_bytes=pre_record_bytes,
+                                         name=f"record_{i}", file_suffix=f"_{sensor}"))
+    return recorders
+
 def record_message_handler(data: PipelineData):
     """
     Handler for the record events
@@ -109,6 +176,8 @@ def record_message_handler(data: PipelineData):
             data.recording = True
             format_file_location(data)
             data.last_time = datetime.now()
+            for recorder in data.recorders or ():
+                recorder.start(data.rec_file_name)
         else:
             now = datetime.now()
             delta_secs = (now - data.last_time).total_seconds()
@@ -116,11 +185,79 @@ def record_message_handler(data: PipelineData):
             if delta_secs >= length:
                 format_file_location(data)
                 data.last_time = now
+                for recorder in data.recorders or ():
+                    recorder.set_file_name(data.rec_file_name)
 
     elif not data.config.startRecording.is_set() and data.recording:
         logging.debug("Recording is already in progress need to stop it")
         data.recording = False
         data.rec_file_name = None
+        for recorder in data.recorders or ():
+            recorder.stop()
+    return True
+
+def parser_update_handler(data):
+    """
+    Replaces the parsers of the running pipeline with the ones of the new parser files sent
+    by the main process (see Twin.set_parser_updates)
+    """
+    config, parser_slot, msg_helper = data
+    try: pyfiles = config.parserUpdates.get_nowait()
+    except queue.Empty: return True
+
+    primary_pyfile, secondary_pyfiles = pyfiles[0], pyfiles[1:]
+    if primary_pyfile is not None and parser_slot is not None:
+        logging.info(f"{config.id}: Loading new primary model parser {primary_pyfile}")
+        new_parser = custom_parsers.create_parser_from_user_pyfile(primary_pyfile, reload=True)
+        dd = config.primaryModelConfigPath
+        if new_parser is not None and (dd.classes is not None or dd.classThresholds):
+            # the class filter of the configuration, for the labels of the new parser
+            new_parser.set_class_filter(classes=dd.classes, class_thresholds=dd.classThresholds)
+        if new_parser is None or not parser_slot.swap(new_parser):
+            logging.error(f"{config.id}: Could not replace the primary model parser with {primary_pyfile}")
+
+    for pyfile in secondary_pyfiles:
+        if pyfile is None:
+            continue
+        logging.info(f"{config.id}: Loading new secondary model parser {pyfile}")
+        sgieId, funct, batch_funct, copy_tensors = custom_parsers.create_sgie_parser_from_user_pyfile(pyfile, reload=True)
+        if sgieId is None or not msg_helper.swap_sgie_parser(sgieId, funct, batch_funct, copy_tensors):
+            logging.error(f"{config.id}: Could not replace the secondary model parser with {pyfile}")
+    return True
+
+def stage_timers_handler(data):
+    """
+    Logs the stage times of the primary model parser since the last report, and the import time
+    of the registered parsers imported since the last report
+    """
+    config_id, parser_slot, pgi_parser, reported_imports = data
+    parser = parser_slot.parser if parser_slot is not None else pgi_parser
+    stages = parser.timers.snapshot(reset=True)
+    if stages:
+        logging.info(f"{config_id}: Stage times of parser {parser.get_name()}:\n{custom_parsers.format_stage_report(stages)}")
+    for name, metrics in custom_parsers.get_parser_import_metrics().items():
+        if name not in reported_imports:
+            reported_imports.add(name)
+            logging.info(f"{config_id}: Parser {name} imported in {metrics['importTimeMs']:.1f} ms ({metrics['newModules']} new modules)")
+    return True
+
+def motion_gate_handler(data):
+    """
+    Logs the share of the frames of every gated sensor that skipped the primary inference since the last report
+    """
+    config_id, motion_gate = data
+    for name, counters in motion_gate.snapshot(reset=True).items():
+        logging.info(f"{config_id}: Sensor {name}: motion gating skipped {counters['skipped']} of {counters['frames']} frames ({counters['skipRate']:.1%})")
+    return True
+
+def sgie_cache_handler(data):
+    """
+    Logs the hit rate of the secondary model results cache since the last report
+    """
+    config_id, sgie_cache = data
+    stats = sgie_cache.snapshot(reset=True)
+    logging.info(f"{config_id}: Secondary model results cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hitRate']:.1%}), "
+                 f"{stats['expired']} expired, {stats['refreshed']} refreshed, {stats['evicted']} evicted, {stats['entries']} entries")
     return True
 
 def format_file_location (udata):
@@ -240,6 +377,13 @@ def build_and_run(config_id, msg_queue):
     streammux = ds_utils.create_gst_element("nvstreammux", "StreamMuxer")
     pipeline.add(streammux)
 
+    # Motion gating needs a primary model with a Python parser, and reads the RGBA frames of the batches
+    primary = config.primaryModelConfigPath
+    motion_gating = primary is not None and (primary.pyFile is not None or primary.parser is not None) \
+                    and any(s.motionGatingParameters is not None for s in sensors)
+    if motion_gating and not is_aarch64():
+        streammux.set_property("nvbuf-memory-type", int(pyds.NVBUF_MEM_CUDA_UNIFIED))
+
     # For each video source, mux it together with all the other sources using the streammux
     # The output of this loop should be the start of our Gst Pipeline.
     # Something like this: [ source_bin -> nvconv -> streammux ]
@@ -304,7 +448,14 @@ def build_and_run(config_id, msg_queue):
             return
 
         # Get the output pad from the conv element
-        padO = conv.get_static_pad("src")
+        if motion_gating:
+            rgba_caps = ds_utils.create_gst_element("capsfilter", f"motion_caps_{i}")
+            rgba_caps.set_property("caps", Gst.Caps.from_string("video/x-raw(memory:NVMM), format=RGBA"))
+            pipeline.add(rgba_caps)
+            conv.link(rgba_caps)
+            padO = rgba_caps.get_static_pad("src")
+        else:
+            padO = conv.get_static_pad("src")
         if not padO:
             logging.error(f"{config_id}: Unable to create padO on conv element.")
             return
@@ -325,6 +476,18 @@ def build_and_run(config_id, msg_queue):
             cpy_roi = roi.copy()
             cpy_roi["sensor"] = s.name
             msg_helper.regions_of_interest.append(cpy_roi)
+    if config.compactMessagesParameters is not None:
+        params = config.compactMessagesParameters
+        msg_helper.message_encoder = MessageEncoder(config_id, content_encoding=params["contentEncoding"],
+                                                    static_refresh=params["staticRefreshMessages"])
+        logging.info(f"{config_id}: Sending schemaVersion 0.2 messages, {msg_helper.message_encoder.content_encoding} encoded")
+    if config.telemetryParameters is not None:
+        params = config.telemetryParameters
+        msg_helper.telemetry = TelemetryWindow(params["windowSeconds"], msg_helper.padindex_to_srcname, msg_helper.regions_of_interest)
+        msg_helper.send_raw_inferences = params["sendInferences"]
+        if not params["sendInferences"]:
+            logging.warning(f"{config_id}: telemetry.sendInferences is off, only the telemetry summaries are sent (no inference messages)")
+        logging.info(f"{config_id}: Sending telemetry summaries every {params['windowSeconds']} s")
 
     # Creating PGIE
     pgie = None
@@ -349,6 +512,12 @@ def build_and_run(config_id, msg_queue):
         if pgi_parser is not None:
             pgi_parser.image_size = (MUXER_OUTPUT_WIDTH, MUXER_OUTPUT_HEIGHT)
             pgi_parser.msg_helper = msg_helper
+            # without nvdsosd nothing draws the object styles, the parser skips them
+            pgi_parser.osd_enabled = bool(config.osdOption)
+            pgi_parser.load_model_config(dd.configFile)
+            if dd.classes is not None or dd.classThresholds:
+                pgi_parser.set_class_filter(classes=dd.classes, class_thresholds=dd.classThresholds)
+                logging.info(f"{config_id}: Class filter of the primary model: classes {dd.classes}, thresholds {dd.classThresholds}")
             logging.info(f"{config_id}: Creating parser {pgi_parser.get_name()} for primary model")
 
 
@@ -360,6 +529,39 @@ def build_and_run(config_id, msg_queue):
         pipeline.add(pgie)
     logging.info(f"{config_id}: PGIE created.")
 
+    # Skip the primary inference of the sources whose scene does not change
+    motion_gate = None
+    if pgi_parser is not None and motion_gating:
+        gates = {}
+        for i, s in enumerate(sensors):
+            params = s.motionGatingParameters
+            if params is not None:
+                gates[i] = custom_parsers.SourceGate(s.name, threshold=params["threshold"], pixel_threshold=params["pixelThreshold"],
+                                                     max_skip_frames=params["maxSkipFrames"], width=params["downscaleWidth"])
+                logging.info(f"{config_id}: Motion gating enabled for sensor {s.name} with threshold {params['threshold']}")
+        motion_gate = custom_parsers.MotionGate(gates, pgie=pgie)
+        pgi_parser.motion_gate = motion_gate
+
+    # Record the primary model outputs into a ring of files, to replay them offline
+    if pgi_parser is not None and config.tensorCaptureParameters is not None:
+        params = config.tensorCaptureParameters
+        pgi_parser.capture = custom_parsers.TensorCapture(directory=os.path.join(params["directory"], config_id),
+                                                          frames=params["frames"])
+
+    # Parse the primary model outputs in worker processes
+    async_parsing = None
+    async_queue = None
+    parser_slot = None
+    if pgi_parser is not None and config.asyncParsingParameters is not None:
+        params = config.asyncParsingParameters
+        async_parsing = custom_parsers.AsyncParsingStage(pgi_parser, workers=params["workers"],
+                                                         latency_budget_ms=params["latencyBudgetMs"],
+                                                         slots=3 * number_sources)
+        # frames wait in this queue while their outputs are being parsed
+        async_queue = ds_utils.create_gst_element("queue", "async-parsing-queue")
+        pipeline.add(async_queue)
+        logging.info(f"{config_id}: Async parsing enabled with {params['workers']} workers and a {params['latencyBudgetMs']} ms latency budget")
+
     nvtracker = None
     if config.trackerConfigPath is not None:
         nvtracker =  ds_utils.create_gst_element("nvtracker", "tracker")
@@ -379,9 +581,9 @@ def build_and_run(config_id, msg_queue):
 
             if m.pyFile is not None:
                 logging.info(f"{config_id}: Secondary model {m.configFile} using custom Python parser.")
-                sgieId, funct = custom_parsers.create_sgie_parser_from_user_pyfile(m.pyFile)
+                sgieId, funct, batch_funct, copy_tensors = custom_parsers.create_sgie_parser_from_user_pyfile(m.pyFile)
                 if sgieId is not None:
-                    msg_helper.register_sgie_parser(sgieId, funct)
+                    msg_helper.register_sgie_parser(sgieId, funct, batch_funct, copy_tensors)
                 else:
                     logging.error(f"{config_id}: Loading custom secondary model Python parser failed!. Cannot create pipeline.")
                     return
@@ -389,6 +591,15 @@ def build_and_run(config_id, msg_queue):
             sgie_list.append(sgie)
             pipeline.add(sgie)
 
+    # Reuse the results of the secondary model parsers for the tracked objects
+    if msg_helper.sgie_parsers and config.sgieCacheParameters is not None:
+        params = config.sgieCacheParameters
+        msg_helper.sgie_cache = custom_parsers.SgieResultCache(ttl=params["ttlSeconds"], max_entries=params["maxEntries"],
+                                                               refresh_frames=params["refreshFrames"])
+        if nvtracker is None:
+            logging.warning(f"{config_id}: The secondary model results cache needs a tracker, objects will be parsed on every frame")
+        logging.info(f"{config_id}: Secondary model results cache enabled with a {params['ttlSeconds']} s TTL")
+
     # Creating tiler
     tiler = ds_utils.create_gst_element("nvmultistreamtiler", "nvtiler")
     pipeline.add(tiler)
@@ -411,28 +622,7 @@ def build_and_run(config_id, msg_queue):
     nvvidconv_postosd = ds_utils.create_gst_element("nvvideoconvert", "convertor_postosd")
     pipeline.add(nvvidconv_postosd)
 
-    if is_aarch64():
-        caps = ds_utils.create_gst_element("queue", "filter")
-        pipeline.add(caps)
-
-        # Make the encoder x264enc nvv4l2h264enc
-        if CODEC == "H264":
-            encoder = ds_utils.create_gst_element("x264enc", "encoder")
-        if CODEC == "H265":
-            encoder = ds_utils.create_gst_element("x265enc", "encoder")
-    else:
-        # Create a caps filter
-        caps = ds_utils.create_gst_element("capsfilter", "filter")
-        pipeline.add(caps)
-        caps.set_property("caps", Gst.Caps.from_string("video/x-raw(memory:NVMM), format=I420"))
-
-        # Make the encoder x264enc nvv4l2h264enc
-        if CODEC == "H264":
-            encoder = ds_utils.create_gst_element("nvv4l2h264enc", "encoder")
-        if CODEC == "H265":
-            encoder = ds_utils.create_gst_element("nvv4l2h265enc", "encoder")
-
-    pipeline.add(encoder)
+    caps, encoder = create_encoder(pipeline)
 
     # Make the UDP sink
     updsink_port_num = 5400
@@ -460,12 +650,15 @@ def build_and_run(config_id, msg_queue):
     # link all elements
     if pgie:
         streammux.link(pgie)
+        last_ele = pgie
+
+        if async_queue:
+            last_ele.link(async_queue)
+            last_ele = async_queue
 
         if nvtracker:
-            pgie.link(nvtracker)
+            last_ele.link(nvtracker)
             last_ele = nvtracker
-        else:
-            last_ele = pgie
 
         for spgie in sgie_list:
             last_ele.link(spgie)
@@ -480,15 +673,22 @@ def build_and_run(config_id, msg_queue):
 
     if nvosd:
         nvvidconv.link(nvosd)
-        nvosd.link(tiler)
-        tiler.link(nvvidconv_postosd)
+        pre_tiler = nvosd
     else:
         caps_rgba = ds_utils.create_gst_element("capsfilter", "to_rgba")
         pipeline.add(caps_rgba)
         caps_rgba.set_property("caps", Gst.Caps.from_string("video/x-raw(memory:NVMM), format=RGBA"))
         nvvidconv.link(caps_rgba)
-        caps_rgba.link(tiler)
-        tiler.link(nvvidconv_postosd)
+        pre_tiler = caps_rgba
+    # with several sources, every one of them is recorded on its own, from the frames before the tiler
+    record_tee = None
+    if number_sources > 1:
+        record_tee = ds_utils.create_gst_element("tee", "record_tee")
+        pipeline.add(record_tee)
+        pre_tiler.link(record_tee)
+        pre_tiler = record_tee
+    pre_tiler.link(tiler)
+    tiler.link(nvvidconv_postosd)
 
     # DISPLAY RESULT ON THE SCREEN FOR TEST
     if DISPLAY_ON_SCREEN:
@@ -525,8 +725,24 @@ def build_and_run(config_id, msg_queue):
     else:
         nvvidconv_postosd.link(caps)
 
+    # the encoded stream goes to the RTSP output and to the recordings
+    set_keyframe_interval(encoder)
+    encoder_tee = ds_utils.create_gst_element("tee", "encoder_tee")
+    pipeline.add(encoder_tee)
     caps.link(encoder)
-    create_rtsp_out_branch(pipeline, encoder)
+    encoder.link(encoder_tee)
+    create_rtsp_out_branch(pipeline, encoder_tee)
+    pre_record_seconds, pre_record_bytes = 0, 0
+    if config.preRecordParameters is not None:
+        params = config.preRecordParameters
+        pre_record_seconds, pre_record_bytes = params["seconds"], params["maxBytes"]
+        logging.info(f"{config_id}: Recordings start with the last {params['seconds']} seconds before the record event")
+    if record_tee is None:
+        recorders = [RecordingBranch(pipeline, encoder_tee.get_request_pad("src_%u"), VIDEO_UPLOADER_DIRECTORY, codec=CODEC,
+                                     pre_record_seconds=pre_record_seconds, pre_record_bytes=pre_record_bytes)]
+    else:
+        recorders = create_source_recorders(pipeline, record_tee, msg_helper.padindex_to_srcname,
+                                            pre_record_seconds=pre_record_seconds, pre_record_bytes=pre_record_bytes)
 
     # create an event loop and feed gstreamer bus mesages to it
     loop = GLib.MainLoop()
@@ -552,12 +768,19 @@ def build_and_run(config_id, msg_queue):
     logging.info(f"{config_id}: Launched RTSP Streaming at rtsp://localhost:{rtsp_port_num}/{config.id.lower()}")
 
     # Initiate object to keep track of pipeline data in this process
-    pipeline_data = PipelineData(config, pipeline, False, None, 0, last_time=datetime.now())
+    pipeline_data = PipelineData(config, pipeline, False, None, 0, last_time=datetime.now(), recorders=recorders)
 
     # Add probes
     ds_utils.add_probe_callback(element=tiler, pad_name="sink", funct=msg_helper.collect_data_for_iot_hub, u_data=pipeline_data)
-    if pgi_parser is not None:
-        ds_utils.add_probe_callback(element=pgie, pad_name='src', funct=pgi_parser.pgie_src_pad_buffer_probe)
+    if motion_gate is not None:
+        ds_utils.add_probe_callback(element=pgie, pad_name='sink', funct=motion_gate.sink_probe)
+    if async_parsing is not None:
+        ds_utils.add_probe_callback(element=pgie, pad_name='src', funct=async_parsing.submit_probe)
+        ds_utils.add_probe_callback(element=async_queue, pad_name='src', funct=async_parsing.attach_probe)
+    elif pgi_parser is not None:
+        # the parser of a pyFile can be replaced while the pipeline runs
+        parser_slot = custom_parsers.ParserSlot(pgi_parser)
+        ds_utils.add_probe_callback(element=pgie, pad_name='src', funct=parser_slot.pgie_src_pad_buffer_probe)
 
     ############ DOT OUTPUT ##################################################
     if "GST_DEBUG_DUMP_DOT_DIR" in os.environ:
@@ -589,6 +812,14 @@ def build_and_run(config_id, msg_queue):
     pipeline.set_state(Gst.State.PLAYING)
 
     GLib.timeout_add_seconds(1, record_message_handler, pipeline_data)
+    GLib.timeout_add_seconds(1, parser_update_handler, (config, parser_slot, msg_helper))
+    if pgi_parser is not None and config.stageTimersParameters is not None:
+        GLib.timeout_add_seconds(config.stageTimersParameters["reportInterval"], stage_timers_handler,
+                                 (config_id, parser_slot, pgi_parser, set()))
+    if msg_helper.sgie_cache is not None:
+        GLib.timeout_add_seconds(config.sgieCacheParameters["reportInterval"], sgie_cache_handler, (config_id, msg_helper.sgie_cache))
+    if motion_gate is not None:
+        GLib.timeout_add_seconds(MOTION_GATE_REPORT_INTERVAL, motion_gate_handler, (config_id, motion_gate))
 
     try:
         loop.run()
@@ -597,6 +828,11 @@ def build_and_run(config_id, msg_queue):
 
     # save any pending data
     msg_helper.save_pending_data()
+    msg_helper.send_telemetry(force=True)
 
     logging.info(f"{config_id}: Cleaning up pipeline.")
     pipeline.set_state(Gst.State.NULL)
+    if async_parsing is not None:
+        async_parsing.close()
+    if pgi_parser is not None and pgi_parser.capture is not None:
+        pgi_parser.capture.close()
@@ -0,0 +1,134 @@
+import time
+from datetime import datetime
+import numpy as np
+
+def points_in_polygon(xs, ys, polygon):
+    """ :return: boolean array, True for the points (xs, ys) inside polygon (list of (x, y) vertices) """
+    inside = np.zeros(len(xs), dtype=bool)
+    x1, y1 = polygon[-1]
+    for x2, y2 in polygon:
+        # the edges crossed by the horizontal ray going right from every point
+        if y1 != y2:
+            crosses = ((y1 > ys) != (y2 > ys)) & (xs < x1 + (ys - y1) * (x2 - x1) / (y2 - y1))
+            inside ^= crosses
+        x1, y1 = x2, y2
+    return inside
+
+class ClassAggregate:
+    """ Detections of a class in a region, over a window """
+    __slots__ = ("label", "count", "min", "max", "sum", "tracks")
+
+    def __init__(self, label: str) -> None:
+        self.label = label
+        self.count = 0
+        self.min = 1.0
+        self.max = 0.0
+        self.sum = 0.0
+        self.tracks = set()
+
+    def add(self, confidence: float, track_id: int):
+        self.count += 1
+        self.sum += confidence
+        if confidence < self.min:
+            self.min = confidence
+        if confidence > self.max:
+            self.max = confidence
+        if track_id != -1:
+            self.tracks.add(track_id)
+
+    def summary(self, class_id: int):
+        return {
+            "classId": class_id,
+            "label": self.label,
+            "count": self.count,
+            "confidence": {"min": self.min, "max": self.max, "mean": self.sum / self.count},
+            "tracks": len(self.tracks)
+        }
+
+class TelemetryWindow:
+    """
+    Aggregates of the detections of a pipeline over windows of window_seconds, per sensor and
+    region of interest (the whole frame being region None): for every class, the number of
+    detections, the min / max / mean confidence and the number of distinct tracks. A detection
+    belongs to the regions of interest of its sensor that contain the center of its box.
+
+    Frames are added one by one, as they go through the pipeline; summary returns the aggregates
+    of the window and starts the next one.
+    """
+    def __init__(self, window_seconds: float, sensors: list, regions_of_interest: list) -> None:
+        """
+        :param sensors: sensor names, by pad index
+        :param regions_of_interest: regions of interest, with the name of their "sensor" and the
+        "coordinates" of their vertices relative to the frame size
+        """
+        self.window_seconds = window_seconds
+        self.sensors = sensors
+        # {pad index: [(label, vertices)]}
+        self.regions = {}
+        for roi in regions_of_interest:
+            if roi.get("sensor") in sensors and len(roi.get("coordinates", [])) >= 3:
+                self.regions.setdefault(sensors.index(roi["sensor"]), []).append(
+                    (roi["label"], [(float(x), float(y)) for x, y in roi["coordinates"]]))
+        self.start_window()
+
+    def start_window(self):
+        self.window_start = datetime.now()
+        self.window_end = time.monotonic() + self.window_seconds
+        # {(pad index, region label, class id): ClassAggregate}
+        self.aggregates = {}
+        self.frames = [0] * len(self.sensors)
+
+    def due(self):
+        """ True once the window is over """
+        return time.monotonic() >= self.window_end
+
+    def add_frame(self, stream_index: int, class_ids: list, labels: list, confidences: list, centers: list, track_ids: list):
+        """
+        :param centers: (x, y) centers of the boxes, relative to the frame size
+        :param track_ids: tracking ids of the detections, -1 for the untracked ones
+        """
+        self.frames[stream_index] += 1
+        if not class_ids:
+            return
+        self.add_region(stream_index, None, class_ids, labels, confidences, track_ids)
+        regions = self.regions.get(stream_index)
+        if regions:
+            xs, ys = np.array(centers, dtype=np.float64).T
+            for label, vertices in regions:
+                inside = points_in_polygon(xs, ys, vertices).tolist()
+                if any(inside):
+                    self.add_region(stream_index, label, *([v for v, i in zip(values, inside) if i]
+                                                           for values in (class_ids, labels, confidences, track_ids)))
+
+    def add_region(self, stream_index: int, region, class_ids: list, labels: list, confidences: list, track_ids: list):
+        aggregates = self.aggregates
+        for class_id, label, confidence, track_id in zip(class_ids, labels, confidences, track_ids):
+            key = (stream_index, region, class_id)
+            aggregate = aggregates.get(key)
+            if aggregate is None:
+                aggregate = aggregates[key] = ClassAggregate(label)
+            aggregate.add(confidence, track_id)
+
+    def summary(self):
+        """ :return: the aggregates of the window, which is then reset """
+        sensors = []
+        for stream_index, name in enumerate(self.sensors):
+            regions = {}
+            for (index, region, class_id), aggregate in self.aggregates.items():
+                if index == stream_index:
+                    regions.setdefault(region, []).append(aggregate.summary(class_id))
+            sensors.append({
+                "id": name,
+                "frames": self.frames[stream_index],
+                "regions": [{"roi": region, "classes": classes} for region, classes in regions.items()]
+            })
+        summary = {
+            "windowStart": self.window_start.isoformat(),
+            "windowEnd": datetime.now().isoformat(),
+            "sensors": sensors
+        }
+        self.start_window()
+        return summary
+
+if '__main__' == __name__:
+    pass
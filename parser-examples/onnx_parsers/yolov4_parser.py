@@ -21,6 +21,7 @@ STRIDES = np.array(STRIDES)
 
 def postprocess_bbbox(pred_bbox, ANCHORS, STRIDES, XYSCALE=[1,1,1]):
     '''define anchor boxes'''
+    decoded = []
     for i, pred in enumerate(pred_bbox):
         conv_shape = pred.shape
         output_size = conv_shape[1]
@@ -34,9 +35,10 @@ def postprocess_bbbox(pred_bbox, ANCHORS, STRIDES, XYSCALE=[1,1,1]):
 
         pred_xy = ((special.expit(conv_raw_dxdy) * XYSCALE[i]) - 0.5 * (XYSCALE[i] - 1) + xy_grid) * STRIDES[i]
         pred_wh = (np.exp(conv_raw_dwdh) * ANCHORS[i])
-        pred[:, :, :, :, 0:4] = np.concatenate([pred_xy, pred_wh], axis=-1)
+        # decoded into a new array: pred is a view on the output buffer of nvinfer
+        decoded.append(np.concatenate([pred_xy, pred_wh, pred[:, :, :, :, 4:]], axis=-1))
 
-    pred_bbox = [np.reshape(x, (-1, np.shape(x)[-1])) for x in pred_bbox]
+    pred_bbox = [np.reshape(x, (-1, np.shape(x)[-1])) for x in decoded]
     pred_bbox = np.concatenate(pred_bbox, axis=0)
     return pred_bbox
 